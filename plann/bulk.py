@@ -0,0 +1,352 @@
+"""Bulk operations towards the calendar server(s)
+
+Saving objects one by one through the caldav library means one blocking
+request per object per calendar.  The BulkWriter does the PUTs (and
+DELETEs) directly, with a configurable number of concurrent requests per server
+and retries on temporary server errors.  An UploadJournal may be used
+for making a long-running upload restartable.
+"""
+
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+import click
+from caldav.elements import dav
+
+from plann.cache import default_cache_dir, mark_stale
+from plann.ics import add_uid, as_vcalendar, generated_uid, object_uid
+
+## 429 Too Many Requests, and 5xx errors that are typically temporary.
+## Some servers (i.e. xandikos) also return 423 Locked on concurrent
+## writes to the same calendar.
+RETRY_STATUSES = {423, 429, 500, 502, 503, 504}
+
+DEFAULT_CONCURRENCY = 4
+
+def object_url(calendar, uid):
+    """
+    The URL of the object with the given UID, generated the same way
+    as in the caldav library
+    """
+    ## See https://github.com/python-caldav/caldav/issues/143 for the rationale behind double-quoting slashes
+    return calendar.url.join(quote(uid.replace("/", "%2F")) + ".ics")
+
+def object_etag(obj):
+    """
+    The ETag of a caldav object, if it was given by the server when
+    the object was fetched
+    """
+    return (getattr(obj, 'props', None) or {}).get(dav.GetEtag.tag)
+
+def _server(calendar):
+    return urlsplit(str(calendar.url)).netloc
+
+def _etag(response):
+    try:
+        return response.headers.get('ETag')
+    except AttributeError:
+        return None
+
+def _status(response):
+    return f"{response.status} {getattr(response, 'reason', '') or ''}".rstrip()
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class BulkReport:
+    """
+    Counters and the list of failures from a bulk operation.  Failures
+    are (calendar url, uid, error message) tuples.
+    """
+    def __init__(self):
+        self.stored = 0
+        self.deleted = 0
+        self.skipped = 0
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def count(self, result):
+        """
+        result is 'stored', 'deleted' or 'skipped'
+        """
+        with self._lock:
+            setattr(self, result, getattr(self, result) + 1)
+
+    def fail(self, calendar, uid, message):
+        with self._lock:
+            self.failures.append((str(calendar.url), uid, message))
+
+    def __str__(self):
+        ret = ""
+        if self.stored or not self.deleted:
+            ret += f"{self.stored} stored, "
+        if self.deleted:
+            ret += f"{self.deleted} deleted, "
+        return ret + f"{self.skipped} skipped, {len(self.failures)} failed"
+
+def default_journal_path():
+    return os.path.join(default_cache_dir(), 'add-ical.journal')
+
+def _escape(value):
+    ## Keeps tabs and newlines in the UID from breaking the journal format
+    return value.encode('unicode_escape').decode('ascii')
+
+def _unescape(value):
+    return value.encode('ascii').decode('unicode_escape')
+
+class UploadJournal:
+    """
+    A checkpoint file with the objects already stored, one line per
+    object with the calendar url, the UID and the ETag (if given by
+    the server), tab separated.  Lines are written as soon as an
+    object is stored, so an interrupted upload can be resumed.
+
+    With resume=True the existing journal is read and appended to,
+    otherwise a new journal is started.
+    """
+    def __init__(self, filename=None, resume=False):
+        self.filename = filename or default_journal_path()
+        self.stored = {}
+        if resume and os.path.exists(self.filename):
+            with open(self.filename, encoding='utf-8') as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 3:
+                        ## Probably a half-written line from an interrupted run
+                        logging.warning(f"ignoring invalid line in {self.filename}: {line!r}")
+                        continue
+                    (url, uid, etag) = fields
+                    self.stored[(url, _unescape(uid))] = etag or None
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._file = open(self.filename, 'a' if resume else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        """
+        key is a tuple (calendar url, uid)
+        """
+        return key in self.stored
+
+    def record(self, calendar, uid, etag=None):
+        url = str(calendar.url)
+        with self._lock:
+            self.stored[(url, uid)] = etag
+            self._file.write(f"{url}\t{_escape(uid)}\t{etag or ''}\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _Progress:
+    """
+    Shows the counters from the report on one line on stderr, updated
+    at most every interval seconds
+    """
+    def __init__(self, report, enabled, interval=0.5):
+        self.report = report
+        self.enabled = enabled
+        self.interval = interval
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def update(self, force=False):
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if force or now - self._last >= self.interval:
+                self._last = now
+                click.echo(f"\r{self.report}", nl=False, err=True)
+
+    def done(self):
+        if self.enabled:
+            self.update(force=True)
+            click.echo("", err=True)
+
+class BulkWriter:
+    """
+    Saves and deletes calendar objects concurrently, on one or more
+    calendars.
+
+    Up to concurrency requests are done concurrently towards each
+    server.  The work is consumed incrementally from the input, with a
+    bounded number of tasks waiting in the queue.  Requests failing
+    with a status in RETRY_STATUSES or with a connection error are
+    retried with an exponential backoff (or as given in a Retry-After
+    header).  Failures are collected in the report rather than raised.
+
+    With overwrite=False, If-None-Match: * is sent when saving, and
+    objects already existing on the server are skipped.  If an ETag is
+    given for an object, If-Match is sent, so that objects changed on
+    the server in the meantime are not overwritten or deleted.
+
+    If a journal (UploadJournal) is given, uploaded objects found in
+    it are skipped, and stored objects are recorded in it.
+    """
+    def __init__(self, calendars, concurrency=DEFAULT_CONCURRENCY, overwrite=True, retries=5, backoff=1.0, progress=None, journal=None):
+        self.calendars = list(calendars)
+        self.journal = journal
+        self.concurrency = max(concurrency, 1)
+        self.overwrite = overwrite
+        self.retries = retries
+        self.backoff = backoff
+        if progress is None:
+            progress = sys.stderr.isatty()
+        self.progress = progress
+        self.report = BulkReport()
+        self._progress = _Progress(self.report, progress)
+        self._server_slots = {}
+        self._slots_lock = threading.Lock()
+        for calendar in self.calendars:
+            self._slot(calendar)
+        self._sleep = time.sleep
+
+    def _slot(self, calendar):
+        with self._slots_lock:
+            return self._server_slots.setdefault(_server(calendar), threading.BoundedSemaphore(self.concurrency))
+
+    def _request(self, calendar, method, url, data, headers):
+        """
+        Sends the request, retrying on temporary errors.  Returns the
+        response.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = calendar.client.request(str(url), method, data, headers)
+            except OSError as e:
+                ## connection problems (requests exceptions are OSErrors)
+                if attempt >= self.retries:
+                    raise
+                delay = None
+                logging.info(f"{method} {url} failed with {e}, retrying")
+            else:
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                delay = _retry_after(response)
+                logging.info(f"{method} {url} returned {response.status}, retrying")
+            if delay is None:
+                delay = self.backoff * 2**attempt * (1 + random.random()/2)
+            self._sleep(min(delay, 300))
+            attempt += 1
+
+    def _put(self, calendar, uid, data, url=None, etag=None):
+        """
+        Returns a tuple ('stored' or 'skipped', etag), raises an
+        exception on failure
+        """
+        headers = {"Content-Type": 'text/calendar; charset="utf-8"'}
+        ## Only new objects may be skipped.  An existing object (url
+        ## given) without a known ETag is overwritten unconditionally
+        new = url is None
+        if etag:
+            headers['If-Match'] = etag
+        elif new and not self.overwrite:
+            headers['If-None-Match'] = '*'
+        url = url or object_url(calendar, uid)
+        response = self._request(calendar, 'PUT', url, data, headers)
+        if response.status in (200, 201, 204, 302):
+            return ('stored', _etag(response))
+        if response.status == 412:
+            if etag:
+                raise RuntimeError(f"PUT {url} failed: the object has been changed on the server")
+            if new and not self.overwrite:
+                return ('skipped', None)
+        raise RuntimeError(f"PUT {url} failed: {_status(response)}")
+
+    def _delete(self, calendar, uid, data, url, etag=None):
+        headers = {}
+        if etag:
+            headers['If-Match'] = etag
+        response = self._request(calendar, 'DELETE', url, '', headers)
+        if response.status in (200, 202, 204):
+            return ('deleted', None)
+        if response.status == 404:
+            ## Already gone
+            return ('skipped', None)
+        if response.status == 412:
+            raise RuntimeError(f"DELETE {url} failed: the object has been changed on the server")
+        raise RuntimeError(f"DELETE {url} failed: {_status(response)}")
+
+    def _do(self, action, calendar, uid, data=None, url=None, etag=None):
+        with self._slot(calendar):
+            try:
+                if action == 'put':
+                    (result, etag) = self._put(calendar, uid, data, url, etag)
+                else:
+                    (result, etag) = self._delete(calendar, uid, data, url, etag)
+            except Exception as e:
+                logging.debug(f"{action} {uid} on {calendar.url} failed", exc_info=True)
+                self.report.fail(calendar, uid, str(e))
+            else:
+                self.report.count(result)
+                if action == 'put' and self.journal is not None and result == 'stored':
+                    self.journal.record(calendar, uid, etag)
+        self._progress.update()
+
+    def run(self, tasks):
+        """
+        tasks is an iterable of tuples (action, calendar, uid, data,
+        url, etag), where action is 'put' or 'delete'.  url may be None
+        for new objects, etag may be None.  Returns a BulkReport.
+        """
+        for calendar in self.calendars:
+            mark_stale(calendar)
+        max_workers = self.concurrency * max(len(self._server_slots), 1)
+        ## Keeps the memory usage bounded, the input may be a huge stream
+        in_flight = threading.BoundedSemaphore(max_workers*2)
+        def release(future):
+            in_flight.release()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for task in tasks:
+                in_flight.acquire()
+                executor.submit(self._do, *task).add_done_callback(release)
+        self._progress.done()
+        return self.report
+
+    def upload(self, icals):
+        """
+        Saves every ical string (typically from ics.split_vcalendars)
+        to every calendar.  Objects without a UID are given one.
+        Returns a BulkReport.
+        """
+        def tasks():
+            for data in icals:
+                data = as_vcalendar(data)
+                uid = object_uid(data)
+                if uid is None:
+                    ## The UID is derived from the data, so a resumed
+                    ## upload will find the object in the journal
+                    uid = generated_uid(data)
+                    data = add_uid(data, uid)
+                for calendar in self.calendars:
+                    if self.journal is not None and (str(calendar.url), uid) in self.journal:
+                        self.report.count('skipped')
+                        self._progress.update()
+                        continue
+                    yield ('put', calendar, uid, data, None, None)
+        return self.run(tasks())
+
+    def delete(self, objs):
+        """
+        Deletes the caldav objects.  If-Match is sent for objects with a
+        known ETag.  Returns a BulkReport.
+        """
+        return self.run(('delete', obj.parent, object_uid(obj.data or '') or str(obj.url), None, obj.url, object_etag(obj)) for obj in objs)
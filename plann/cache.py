@@ -0,0 +1,344 @@
+"""Local on-disk cache of calendar objects
+
+Every calendar gets one cache file containing the raw icalendar data
+and the ETag of each calendar object resource, together with the
+sync-token from the last sync.  The cache is kept up to date through
+the sync-collection REPORT (RFC 6578), so on a warm cache only the
+objects that have been added, changed or deleted since the last run
+are transferred from the server.
+
+Servers not supporting sync-collection are handled by fetching the
+ETags of all the objects in the calendar through a PROPFIND, and then
+fetching only the objects with a changed ETag.  On such servers a
+sync costs one request more than with sync-tokens (the failing
+sync-collection REPORT is followed by a PROPFIND), and the PROPFIND
+response lists every object in the calendar - but the calendar data
+itself is only transferred when it has changed.
+
+The results of the calendar discovery may also be cached, see
+DiscoveryCache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from urllib.parse import quote
+
+import caldav
+from caldav.elements import cdav, dav
+from caldav.lib.url import URL
+
+## Number of objects fetched per calendar-multiget REPORT
+MULTIGET_CHUNK_SIZE = 256
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or f"{os.environ.get('HOME')}/.cache"
+    return os.path.join(cache_home, 'plann')
+
+def _cache_filename(url, cache_dir):
+    return os.path.join(cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+def mark_stale(calendar, cache_dir=None):
+    """
+    To be called when plann saves or deletes objects in the calendar.
+    If the calendar is cached, the cache is synced on the next read,
+    regardless of max_staleness.
+    """
+    if calendar is None or calendar.url is None:
+        return
+    ## canonical() changes the URL object in place
+    url = str(URL.objectify(str(calendar.url)).canonical())
+    filename = _cache_filename(url, cache_dir or default_cache_dir())
+    if not os.path.exists(filename):
+        return
+    with open(f"{filename}.stale", 'a'):
+        os.utime(f"{filename}.stale")
+
+def _uid_from_ical(data):
+    """
+    Finds the UID in raw icalendar data without parsing it.  Folded
+    lines are unfolded.
+    """
+    rx = re.search(r'^UID:(.*(?:\r?\n[ \t].*)*)', data, re.MULTILINE)
+    if not rx:
+        return None
+    return re.sub(r'\r?\n[ \t]', '', rx.group(1)).strip()
+
+def _multiget(calendar, urls):
+    """
+    Fetches calendar data and ETags for the given URLs through
+    calendar-multiget REPORTs (RFC 4791 section 7.9).
+
+    Yields (url, data, etag) for all objects found.  Objects that
+    could not be found (i.e. deleted after the sync-token was issued)
+    are silently skipped.
+    """
+    urls = list(urls)
+    for i in range(0, len(urls), MULTIGET_CHUNK_SIZE):
+        chunk = urls[i:i+MULTIGET_CHUNK_SIZE]
+        root = (
+            cdav.CalendarMultiGet()
+            + (dav.Prop() + [dav.GetEtag(), cdav.CalendarData()])
+            + [dav.Href(value=URL.objectify(u).path) for u in chunk]
+        )
+        response = calendar._query(root, 1, 'report')
+        results = response.expand_simple_props([cdav.CalendarData(), dav.GetEtag()])
+        for href in results:
+            data = results[href].get(cdav.CalendarData.tag)
+            if not data:
+                continue
+            url = URL(href)
+            if url.hostname is None:
+                url = quote(href)
+            yield (str(calendar.url.join(url).canonical()), data, results[href].get(dav.GetEtag.tag))
+
+def _etags(calendar):
+    """
+    Fetches the URLs and ETags of all objects in the calendar through
+    a PROPFIND, for servers not supporting sync-collection.  Returns
+    a dict url -> etag.
+    """
+    response = calendar._query_properties([dav.GetEtag()], depth=1)
+    properties = response.expand_simple_props([dav.GetEtag()])
+    calendar_url = str(URL.objectify(str(calendar.url)).canonical())
+    ret = {}
+    for href in properties:
+        url = URL(href)
+        if url.hostname is None:
+            url = quote(href)
+        url = str(calendar.url.join(url).canonical())
+        ## The calendar collection itself is included in the response
+        if url.rstrip('/') == calendar_url.rstrip('/'):
+            continue
+        ret[url] = properties[href].get(dav.GetEtag.tag)
+    return ret
+
+def _list_etags(calendar, sync_token=None):
+    """
+    Returns a tuple with a dict url -> etag and the new sync-token.
+
+    The dict contains the objects changed since sync_token, or all
+    objects if sync_token is None.  If the server does not support
+    sync-collection, all objects are returned and the sync-token is
+    None.  DAVError is raised if the server does not accept the
+    sync_token given.
+    """
+    try:
+        updates = calendar.objects_by_sync_token(sync_token, load_objects=False)
+    except caldav.error.DAVError:
+        if sync_token is not None:
+            raise
+        logging.info(f"sync-collection failed on {calendar.url}, comparing ETags instead")
+        return (_etags(calendar), None)
+    return ({str(obj.url.canonical()): obj.props.get(dav.GetEtag.tag) for obj in updates}, updates.sync_token)
+
+def fetch_entries(calendar):
+    """
+    Fetches all objects in the calendar, in the same format as
+    ObjectCache.entries, without storing anything.  The data is
+    fetched through calendar-multiget rather than one GET per object.
+    """
+    urls = list(_list_etags(calendar)[0])
+    return {url: {'etag': etag, 'uid': _uid_from_ical(data), 'data': data} for (url, data, etag) in _multiget(calendar, urls)}
+
+class ObjectCache:
+    """
+    Cache of all the objects in one calendar.
+
+    max_staleness is a timedelta.  If the cache has been synced more
+    recently than that, sync() will not contact the server - unless
+    the calendar has been marked as stale (see mark_stale) since the
+    last sync.
+    """
+    def __init__(self, calendar, cache_dir=None, max_staleness=timedelta(0)):
+        self.calendar = calendar
+        self.url = str(calendar.url.canonical())
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.filename = _cache_filename(self.url, self.cache_dir)
+        self.max_staleness = max_staleness
+        self.sync_token = None
+        self.synced = 0
+        ## url -> {'etag': ..., 'uid': ..., 'data': ...}
+        self.entries = {}
+        self._urls_by_uid = None
+        ## The same calendar may be searched from several threads
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as cache_file:
+                cached = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logging.error(f"cache file {self.filename} is corrupt, it will be ignored and overwritten")
+            return
+        if cached.get('url') != self.url:
+            ## Hash collision?  Very unlikely, but let's not serve objects from the wrong calendar
+            return
+        self.sync_token = cached.get('sync_token')
+        self.synced = cached.get('synced', 0)
+        self.entries = cached.get('entries', {})
+
+    def _save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmpname = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmpname, 'w') as cache_file:
+            json.dump({'url': self.url, 'sync_token': self.sync_token, 'synced': self.synced, 'entries': self.entries}, cache_file)
+        os.replace(tmpname, self.filename)
+
+    def is_fresh(self):
+        if not self.synced or time.time() - self.synced > self.max_staleness.total_seconds():
+            return False
+        try:
+            return os.path.getmtime(f"{self.filename}.stale") < self.synced
+        except FileNotFoundError:
+            return True
+
+    def sync(self, force=False):
+        """
+        Brings the cache up to date with the server.  Returns a tuple
+        with the number of updated and deleted objects.
+        """
+        with self._lock:
+            return self._sync(force)
+
+    def _sync(self, force=False):
+        if not force and self.is_fresh():
+            return (0, 0)
+        ## Changes done while syncing should be picked up on the next sync
+        started = time.time()
+        try:
+            (etags, sync_token) = _list_etags(self.calendar, self.sync_token)
+        except caldav.error.DAVError:
+            ## The server does not recognize our sync-token any longer (RFC 6578 section 3.2)
+            ## We'll have to start from scratch
+            logging.info(f"sync-token for {self.url} not accepted by the server, doing a full sync")
+            self.sync_token = None
+            return self._sync(force=True)
+
+        full_sync = self.sync_token is None
+        to_fetch = []
+        for (url, etag) in etags.items():
+            if etag and url in self.entries and self.entries[url]['etag'] == etag:
+                continue
+            to_fetch.append(url)
+
+        deleted = set()
+        if full_sync:
+            ## Anything not reported by the server does not exist anymore
+            deleted = set(self.entries) - set(etags)
+
+        fetched = set()
+        for (url, data, etag) in _multiget(self.calendar, to_fetch):
+            fetched.add(url)
+            self.entries[url] = {'etag': etag, 'uid': _uid_from_ical(data), 'data': data}
+        ## Objects in the sync report that could not be fetched have been deleted
+        deleted.update(set(to_fetch) - fetched)
+        for url in deleted:
+            self.entries.pop(url, None)
+
+        self.sync_token = sync_token
+        self.synced = started
+        self._urls_by_uid = None
+        self._save()
+        return (len(fetched), len(deleted))
+
+    def _to_object(self, url, entry):
+        data = entry['data']
+        comp_class = self.calendar._calendar_comp_class_by_data(data)
+        return comp_class(client=self.calendar.client, url=url, data=data, parent=self.calendar, props={dav.GetEtag.tag: entry['etag']})
+
+    def iter_objects(self):
+        """
+        Yields all objects in the calendar, as caldav objects.  The
+        objects are created lazily.
+        """
+        for (url, entry) in list(self.entries.items()):
+            yield self._to_object(url, entry)
+
+    def objects(self):
+        """
+        Returns all objects in the calendar, as caldav objects
+        """
+        return list(self.iter_objects())
+
+    def object_by_uid(self, uid, comp_filter=None):
+        """
+        Same semantics as caldav.Calendar.object_by_uid
+        """
+        if self._urls_by_uid is None:
+            self._urls_by_uid = defaultdict(list)
+            for url, entry in self.entries.items():
+                self._urls_by_uid[entry['uid']].append(url)
+        for url in self._urls_by_uid.get(uid, []):
+            entry = self.entries[url]
+            if comp_filter and f"BEGIN:{comp_filter}" not in entry['data']:
+                continue
+            return self._to_object(url, entry)
+        raise caldav.error.NotFoundError(f"{uid} not found in cache for {self.url}")
+
+class DiscoveryCache:
+    """
+    Cache of the calendar discovery results (calendar URLs, display
+    names and supported component types), with one entry per config
+    section.  Entries older than ttl (a timedelta) are ignored.
+
+    The key should identify the connection and calendar parameters of
+    the config section, see lib.find_calendars.
+    """
+    def __init__(self, cache_dir=None, ttl=timedelta(0)):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.filename = os.path.join(self.cache_dir, 'discovery.json')
+        self.ttl = ttl
+        ## find_calendars may be run concurrently for several config sections
+        self._lock = threading.Lock()
+        try:
+            with open(self.filename) as cache_file:
+                self.entries = json.load(cache_file)
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError:
+            logging.error(f"cache file {self.filename} is corrupt, it will be ignored and overwritten")
+            self.entries = {}
+
+    def _save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmpname = f"{self.filename}.{os.getpid()}.tmp"
+        with open(tmpname, 'w') as cache_file:
+            json.dump(self.entries, cache_file)
+        os.replace(tmpname, self.filename)
+
+    def get(self, key):
+        """
+        Returns a list of dicts with url, name and components - or None
+        if there is no fresh entry
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+        if not entry or time.time() - entry['discovered'] > self.ttl.total_seconds():
+            return None
+        return entry['calendars']
+
+    def put(self, key, calendars):
+        with self._lock:
+            self.entries[key] = {'discovered': time.time(), 'calendars': calendars}
+            self._save()
+
+    def invalidate(self, calendar_url):
+        """
+        Drops all entries containing the calendar, i.e. if it has been
+        deleted from the server
+        """
+        with self._lock:
+            for key in list(self.entries):
+                if any(x['url'] == calendar_url for x in self.entries[key]['calendars']):
+                    del self.entries[key]
+            self._save()
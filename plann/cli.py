@@ -17,11 +17,15 @@ plann is a "next generation" reimplementation of calendar-cli
 ## cli as such.  It should be moved out and made available through
 ## `from plann import ...`
 
+import io
+import itertools
 import os
 import sys
 
 import caldav
 
+from plann.bulk import DEFAULT_CONCURRENCY, BulkWriter, UploadJournal
+from plann.cache import DiscoveryCache
 from plann.commands import (
     _add_event,
     _add_todo,
@@ -29,19 +33,34 @@ from plann.commands import (
     _cats,
     _check_due,
     _check_for_panic,
+    _check_relations,
+    _copy_to,
     _dismiss_panic,
     _edit,
+    _relation_issue_text,
     _select,
     _set_task_attribs,
     _split_high_pri_tasks,
     _split_huge_tasks,
+    _target_calendars,
 )
 from plann.config import config_section, expand_config_section, read_config
+from plann.ics import insert_before_end, split_vcalendars, vcalendar_chunks
 from plann.interactive import _abort
-from plann.lib import _list, _split_vcal, _split_vcals, attr_int, attr_time, attr_txt_many, attr_txt_one, find_calendars
+from plann.lib import (
+    DEFAULT_PARALLELISM,
+    LazyDict,
+    _list,
+    _parallel_map,
+    attr_int,
+    attr_time,
+    attr_txt_many,
+    attr_txt_one,
+    find_calendars_multi,
+)
 from plann.lib import add_time_tracking as add_time_tracking_
 from plann.metadata import metadata
-from plann.timespec import _now, parse_dt, tz
+from plann.timespec import _now, parse_add_dur, parse_dt, tz
 
 __version__ = metadata["version"]
 
@@ -78,6 +97,10 @@ list_type = list
 @click.option('--calendar-url', help="Calendar id, path or URL", metavar='cal', multiple=True)
 @click.option('--calendar-name', help="Calendar name", metavar='cal', multiple=True)
 @click.option('--raise-errors/--print-errors', help="Raise errors found on calendar discovery")
+@click.option('--cache/--no-cache', default=False, help="Keep a local copy of the calendar data (under $XDG_CACHE_HOME/plann), only changes are fetched from the server")
+@click.option('--max-staleness', default='0s', help="Don't ask the server for changes if the local cache was synced more recently than this (i.e. 10m).  Only effective with --cache")
+@click.option('--discovery-ttl', default='0s', help="Cache the calendar discovery results (calendar URLs, names and supported component types) for this long (i.e. 1d).  Default is no caching")
+@click.option('--parallelism', default=DEFAULT_PARALLELISM, type=click.IntRange(min=1), help=f"Max number of concurrent requests towards the calendar server(s) (default: {DEFAULT_PARALLELISM})")
 @click.pass_context
 def cli(ctx, **kwargs):
     """
@@ -88,20 +111,38 @@ def cli(ctx, **kwargs):
     ## The cli function will prepare a context object, a dict containing the
     ## caldav_client, principal and calendar
 
-    ctx.ensure_object(dict)
+    ctx.ensure_object(LazyDict)
     ## TODO: add all relevant connection parameters for the DAVClient as options
     ## TODO: logic to read the config file and edit kwargs from config file
-    ## TODO: delayed communication with caldav server (i.e. if --help is given to subcommand)
     ## TODO: catch errors, present nice error messages
-    ctx.obj['calendars'] = find_calendars(kwargs, kwargs['raise_errors'])
     for flag in ('show_native_timezone', 'store_timezone', 'implicit_timezone'):
         setattr(tz, flag, kwargs[flag])
+    ctx.obj['cache'] = kwargs['cache']
+    ctx.obj['max_staleness'] = parse_add_dur(None, kwargs['max_staleness'])
+    ctx.obj['parallelism'] = kwargs['parallelism']
+    discovery_ttl = parse_add_dur(None, kwargs['discovery_ttl'])
+    ctx.obj['discovery_cache'] = DiscoveryCache(ttl=discovery_ttl) if discovery_ttl else None
+    args_list = [kwargs]
+    config = None
     if not kwargs['skip_config']:
         config = read_config(kwargs['config_file'])
         if config:
             for meta_section in kwargs['config_section']:
                 for section in expand_config_section(config, meta_section):
-                    ctx.obj['calendars'].extend(find_calendars(config_section(config, section), raise_errors=kwargs['raise_errors']))
+                    args_list.append(config_section(config, section))
+    ## Kept for commands connecting to other calendars, i.e. copy-to
+    ctx.obj['config'] = config
+    ctx.obj['args_list'] = args_list
+    ctx.obj['raise_errors'] = kwargs['raise_errors']
+
+    ## Calendar discovery is done concurrently, and not until the
+    ## subcommand needs the calendars
+    def discover():
+        return find_calendars_multi(args_list, kwargs['raise_errors'], kwargs['parallelism'], ctx.obj['discovery_cache'])
+    if isinstance(ctx.obj, LazyDict):
+        ctx.obj.lazy['calendars'] = discover
+    else:
+        ctx.obj['calendars'] = discover()
 
 @cli.command()
 @click.pass_context
@@ -113,7 +154,7 @@ def list_calendars(ctx):
         _abort("No calendars found!")
     else:
         output = "Accessible calendars found:\n"
-        calendar_info = [(x.get_display_name(), x.url) for x in ctx.obj['calendars']]
+        calendar_info = _parallel_map(lambda x: (x.get_display_name(), x.url), ctx.obj['calendars'], ctx.obj['parallelism'])
         max_display_name = max([len(x[0]) for x in calendar_info])
         lines = [f"{name:<{max_display_name}} {url}" for name, url in calendar_info]
         click.echo_via_pager(output + "\n".join(lines) + "\n")
@@ -164,7 +205,7 @@ def _set_attr_options(verb="", desc=""):
 @click.option('--to', 'end', help='alias for end')
 @click.option('--until', 'end', help='alias for end')
 @click.option('--timespan', help='do a time search for this interval')
-@click.option('--sort-key', help='use this attributes for sorting.  Templating can be used.  Prepend with - for reverse sort.  Special: "get_duration()" yields the duration or the distance between dtend and dtstart, or an empty timedelta', default=['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}{PRIORITY:?0?}'],  multiple=True)
+@click.option('--sort-key', help='use this attributes for sorting.  Templating can be used.  Prepend with - for reverse sort.  An empty sort key gives no sorting, then the list subcommand can output the objects as they are found.  Special: "get_duration()" yields the duration or the distance between dtend and dtstart, or an empty timedelta', default=['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}{PRIORITY:?0?}'],  multiple=True)
 @click.option('--skip-parents/--include-parents', help="Skip parents if it's children is selected.  Useful for finding tasks that can be started if parent depends on child", default=False)
 @click.option('--skip-children/--include-children', help="Skip children if it's parent is selected.  Useful for getting an overview of the big picture if children are subtasks", default=False)
 @click.option('--limit', help='Number of objects to show', type=int)
@@ -186,7 +227,8 @@ def select(*largs, **kwargs):
     allowing the common use-cases to be done in easier ways (like
     agenda and fix-tasks-interactive)
     """
-    return _select(*largs, **kwargs)
+    ## list goes through the objects once, they don't need to be collected first
+    return _select(*largs, stream=largs[0].invoked_subcommand == 'list', **kwargs)
 
 @select.command()
 @click.pass_context
@@ -251,23 +293,95 @@ def print_ical(ctx):
     """
     Dumps everything selected as an ICS feed
     """
-    for obj in ctx.obj['objs']:
-        click.echo(obj.data)
+    for chunk in vcalendar_chunks(ctx.obj['objs']):
+        click.echo(chunk, nl=False)
+
+@select.command()
+@click.option('--config-section', 'sections', multiple=True, help="Copy to the calendar(s) given in this config section")
+@click.option('--calendar-url', multiple=True, help="Copy to this calendar (overrides the calendars given in the config section)", metavar='cal')
+@click.option('--calendar-name', multiple=True, help="Copy to the calendar with this name (overrides the calendars given in the config section)", metavar='cal')
+@click.option('--delete-vanished/--keep-vanished', default=False, help="Delete objects in the target calendar(s) that are not in the selection, but matched by the selection filters")
+@click.option('--dry-run/--no-dry-run', default=False, help="Only print what would be done")
+@click.option('--concurrency', type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, help="Max number of concurrent uploads per server", show_default=True)
+@click.option('--progress/--no-progress', default=None, help="Show a progress counter (default: if stderr is a terminal)")
+@click.pass_context
+def copy_to(ctx, sections, calendar_url, calendar_name, delete_vanished, dry_run, concurrency, progress):
+    """
+    Copies the selected objects directly to other calendar(s)
+
+    Only new or changed objects are uploaded, so this can be used for
+    keeping a calendar in sync with another.  Objects with a higher
+    SEQUENCE in the target calendar are left alone.
+    """
+    targets = _target_calendars(ctx, sections, calendar_url, calendar_name)
+    ret = _copy_to(ctx, targets, delete_vanished=delete_vanished, dry_run=dry_run, concurrency=concurrency, progress=progress)
+    if dry_run:
+        verbs = {('put', False): 'add', ('put', True): 'update', ('delete', True): 'delete'}
+        for (action, target, uid, data, url, etag) in ret:
+            click.echo(f"would {verbs[(action, url is not None)]} {uid} in {target.url}")
+        return
+    click.echo(f"Summary: {ret}", err=True)
+    for (url, uid, message) in ret.failures:
+        click.echo(f"Failed to copy {uid} to {url}: {message}", err=True)
+    if ret.failures:
+        _abort(f"{len(ret.failures)} objects could not be copied")
+
+@select.command()
+@click.option('--fix/--no-fix', default=False, help="Add the missing links back")
+@click.option('--remove-dangling/--keep-dangling', default=False, help="Remove links to objects that were not found")
+@click.option('--concurrency', type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, help="Max number of concurrent saves per server", show_default=True)
+@click.option('--progress/--no-progress', default=None, help="Show a progress counter (default: if stderr is a terminal)")
+@click.pass_context
+def check_relations(ctx, fix, remove_dangling, concurrency, progress):
+    """
+    Checks the relations between the selected objects
+
+    Reports relations without a link back, links back with the wrong
+    RELTYPE, relations to objects that could not be found, and
+    relationship loops.  Use it with select --all to check the whole
+    calendar.
+    """
+    (graph, issues, report) = _check_relations(ctx, fix=fix, remove_dangling=remove_dangling, concurrency=concurrency, progress=progress)
+    for issue in issues:
+        click.echo(_relation_issue_text(graph, issue))
+    click.echo(f"{len(issues)} issues found", err=True)
+    if report is None:
+        return
+    click.echo(f"Summary: {report}", err=True)
+    for (url, uid, message) in report.failures:
+        click.echo(f"Failed to save {uid} to {url}: {message}", err=True)
+    if report.failures:
+        _abort(f"{len(report.failures)} objects could not be saved")
 
 @select.command()
 @click.option('--multi-delete/--no-multi-delete', default=None, help="Delete multiple things without confirmation prompt")
+@click.option('--dry-run/--no-dry-run', default=False, help="Only print how many items would be deleted")
+@click.option('--concurrency', type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, help="Max number of concurrent deletes per server", show_default=True)
+@click.option('--progress/--no-progress', default=None, help="Show a progress counter (default: if stderr is a terminal)")
 @click.pass_context
-def delete(ctx, multi_delete, **kwargs):
+def delete(ctx, multi_delete, dry_run, concurrency, progress, **kwargs):
     """
     Delete the selected item(s)
+
+    Items changed on the server since they were selected are not
+    deleted.
     """
     objs = ctx.obj['objs']
+    if dry_run:
+        click.echo(f"Would delete {len(objs)} items")
+        return
     if multi_delete is None and len(objs)>1:
         multi_delete = click.confirm(f"OK to delete {len(objs)} items?")
     if len(objs)>1 and not multi_delete:
         _abort(f"Not going to delete {len(objs)} items")
-    for obj in objs:
-        obj.delete()
+    writer = BulkWriter(set(obj.parent for obj in objs), concurrency=concurrency, progress=progress)
+    report = writer.delete(objs)
+    if report.failures or writer.progress:
+        click.echo(f"Summary: {report}", err=True)
+    for (url, uid, message) in report.failures:
+        click.echo(f"Failed to delete {uid} from {url}: {message}", err=True)
+    if report.failures:
+        _abort(f"{len(report.failures)} items could not be deleted")
 
 ## TODO: reconsider the naming of the attributes and functions - --mass-interactive should probably be --interactive-editor - and the interactive reprioritization function needs to be renamed
 @select.command()
@@ -275,6 +389,7 @@ def delete(ctx, multi_delete, **kwargs):
 @click.option('--add-category', default=None, help="Add a category (equivalent with --set-category, while --set-categories will overwrite existing categories))", multiple=True)
 @click.option('--postpone', help="Add something to the DTSTART and DTEND/DUE")
 @click.option('--postpone-with-children', help="Add something to the DTSTART and DTEND/DUE for this and children")
+@click.option('--dry-run/--no-dry-run', default=False, help="Only print what --postpone or --postpone-with-children would do")
 @click.option('--interactive-ical/--no-interactive-ical', help="Edit the ical interactively")
 @click.option('--interactive-relations/--no-interactive-relations', help="Edit the relationships")
 @click.option('--interactive/--no-interactive', help="Interactive edit")
@@ -314,6 +429,9 @@ def complete(ctx, **kwargs):
 @click.option('--print-timeline/--no-print-timeline', help='Print a possible timeline')
 @click.option('--fix-timeline/--no-fix-timeline', help='Make events from the tasks and pin them to the calendar')
 @click.option('--interactive-fix-timeline/--no-interactive-fix-timeline', help='Make a suggested editable time table')
+@click.option('--compact-timeline/--no-compact-timeline', help='Keep the timeline in compact arrays, using less memory for huge task lists')
+@click.option('--working-hours', multiple=True, help="Plan the tasks within working hours rather than assuming --hours-per-day, i.e. '09:00-17:00 mon-fri'.  May be prefixed with a category, i.e. 'home=18:00-22:00 mon-fri, 10:00-16:00 sat-sun', for the tasks with that category.  May be given multiple times")
+@click.option('--holiday-calendar', multiple=True, help="Name of a calendar with holidays, the time taken by the events in it is not counted as working hours.  May be given multiple times")
 @click.pass_context
 def check_for_panic(ctx, **kwargs):
     """Check if we need to panic
@@ -331,6 +449,9 @@ def check_for_panic(ctx, **kwargs):
     minimum slack (how long one may snooze before starting working on
     those tasks).
 
+    With --working-hours, the tasks are planned within the working
+    hours rather than assuming --hours-per-day.
+
     TODO: Only tasks supported so far.  It should also warn on
     overlapping events and substract time spent on events.
     """
@@ -380,27 +501,46 @@ def add(ctx, **kwargs):
 @click.pass_context
 @click.option('-d', '--ical-data', '--ical', help="ical object to be added")
 @click.option('-f', '--ical-file', type=click.File('rb'), help="file containing ical data")
-def ical(ctx, ical_data, ical_file):
-    ical = ""
+@click.option('--concurrency', type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, help="Max number of concurrent uploads per server", show_default=True)
+@click.option('--overwrite/--skip-existing', default=True, help="Overwrite objects already existing in the calendar, or skip them", show_default=True)
+@click.option('--retries', type=click.IntRange(min=0), default=5, help="Number of retries on temporary server errors", show_default=True)
+@click.option('--progress/--no-progress', default=None, help="Show a progress counter (default: if stderr is a terminal)")
+@click.option('--journal', 'journal_path', type=click.Path(dir_okay=False), help="Keep a journal of the objects stored, for resuming an interrupted upload (default: $XDG_CACHE_HOME/plann/add-ical.journal when --resume is given)")
+@click.option('--resume/--no-resume', default=False, help="Skip the objects found in the journal from an earlier run")
+def ical(ctx, ical_data, ical_file, concurrency, overwrite, retries, progress, journal_path, resume):
+    """
+    Adds icalendar data to the calendar(s).  The input may contain
+    multiple objects, they will be split by UID and uploaded
+    concurrently.
+    """
+    ## The input is read and split line by line, so huge files can be imported
+    lines = []
     if (ical_file):
-        ical = ical + ical_file.read().decode()
+        lines = io.TextIOWrapper(ical_file, encoding='utf-8')
     if (ical_data):
-        ical = ical + ical_data
-    if not ical:
-        ical = sys.stdin.read()
+        lines = itertools.chain(lines, ical_data.split("\n"))
+    if not ical_file and not ical_data:
+        lines = sys.stdin
     if ctx.obj['ical_fragment']:
-        ical = ical.replace('\nEND:', f"{ctx.obj['ical_fragment']}\nEND:")
-    if 'BEGIN:VCALENDAR' in ical:
-        if ical.count('BEGIN:VCALENDAR') > 1:
-            icals = _split_vcals(ical)
-        else:
-            icals = _split_vcal(ical)
-    else:
-        icals = [ ical ]
-    for ical in icals:
-        for c in ctx.obj['calendars']:
-            ## TODO: this may not be an event - should make a Calendar.save_object method
-            c.save_event(ical)
+        lines = insert_before_end(lines, ctx.obj['ical_fragment'])
+    journal = None
+    if journal_path or resume:
+        journal = UploadJournal(journal_path, resume=resume)
+    try:
+        uploader = BulkWriter(ctx.obj['calendars'], concurrency=concurrency, overwrite=overwrite, retries=retries, progress=progress, journal=journal)
+        report = uploader.upload(split_vcalendars(lines))
+    finally:
+        if journal:
+            journal.close()
+    if report.failures or uploader.progress:
+        click.echo(f"Summary: {report}", err=True)
+    for (url, uid, message) in report.failures:
+        click.echo(f"Failed to save {uid} to {url}: {message}", err=True)
+    if report.failures:
+        message = f"{len(report.failures)} objects could not be saved"
+        if journal:
+            message += f" - use --resume --journal={journal.filename} to retry only those"
+        _abort(message)
 
 
 @add.command()
@@ -493,9 +633,9 @@ def manage_tasks(ctx):
     click.echo("Checking if there is any missing metadata on your tasks ...")
     _set_task_attribs(ctx)
     click.echo("Checking if we should go in 'panic mode', perhaps it's needed to procrastinate some lower-priority tasks")
-    _dismiss_panic(ctx, hours_per_day=24)
+    planner = _dismiss_panic(ctx, hours_per_day=24)
     click.echo("New panic check")
-    _dismiss_panic(ctx, hours_per_day=14)
+    _dismiss_panic(ctx, hours_per_day=14, planner=planner)
     click.echo("Going through your near-due tasks")
     _check_due(ctx)
     click.echo("Stick tasks to your calendar")
@@ -1,13 +1,22 @@
 #import isodate
 import datetime
+import hashlib
+import heapq
 import logging
 import re
+import threading
 
 import caldav
 
 ## TODO: can we remove the click-dependency?
 import click
+from caldav.elements import dav
+from caldav.lib.url import URL
 
+from plann.bulk import DEFAULT_CONCURRENCY, BulkWriter, object_etag
+from plann.cache import ObjectCache, _multiget, fetch_entries, mark_stale
+from plann.config import config_section, expand_config_section
+from plann.ics import object_uid, same_content, sequence
 from plann.interactive import (
     _abort,
     _editor,
@@ -21,29 +30,38 @@ from plann.interactive import (
     interactive_split_task,
 )
 from plann.lib import (
+    DEFAULT_PARALLELISM,
     _add_category,
     _list,
+    _parallel_imap,
+    _parallel_map,
     _process_set_arg,
     _procrastinate,
     _relships_by_type,
+    _save,
+    _save_all,
     _set_something,
     _summary,
     attr_txt_many,
     childlike,
+    find_calendars_multi,
     parentlike,
 )
-from plann.panic_planning import timeline_suggestion
+from plann.panic_planning import Planner, parse_working_hours
+from plann.query import NON_FILTER_KEYS, local_search, server_filters
+from plann.relations import RelationGraph, check_relations, fix_relations, inverse
 from plann.template import Template
 from plann.timespec import _ensure_ts, _now, parse_add_dur, parse_dt, parse_timespec, tz
 
 
-def _select(ctx, interactive=False, mass_interactive=False, **kwargs):
+def _select(ctx, interactive=False, mass_interactive=False, stream=False, **kwargs):
     """
     wrapper function for __select.  Will honor the --interactive flag.
     """
-    __select(ctx, **kwargs)
+    __select(ctx, stream=stream and not interactive and not mass_interactive, **kwargs)
     ## TODO: move the rest to interactive module?
     if (interactive or mass_interactive) and ctx.obj['objs']:
+        ctx.obj['select_filters'] = None
         objs = ctx.obj['objs']
         if mass_interactive:
             ctx.obj['objs'] = []
@@ -62,24 +80,188 @@ def _select(ctx, interactive=False, mass_interactive=False, **kwargs):
                 if click.confirm(f"select {_summary(obj)}?"):
                     ctx.obj['objs'].append(obj)
 
-def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=None, sort_key=[], skip_parents=None, skip_children=None, limit=None, offset=None, freebusyhack=None, pinned_tasks=None, **kwargs_):
+_object_caches_lock = threading.Lock()
+
+def _object_cache(ctx, calendar):
+    """
+    Returns an ObjectCache for the calendar, synced with the server -
+    or None if caching is not enabled
+    """
+    if not ctx.obj.get('cache'):
+        return None
+    ## canonical() changes the URL object in place
+    url = str(URL.objectify(str(calendar.url)).canonical())
+    ## Called from the worker threads in __select
+    with _object_caches_lock:
+        caches = ctx.obj.setdefault('object_caches', {})
+        if url not in caches:
+            caches[url] = ObjectCache(calendar, ctx.obj.get('cache_dir'), ctx.obj.get('max_staleness', datetime.timedelta(0)))
+        cache = caches[url]
+    cache.sync()
+    return cache
+
+class _Reversed:
+    """
+    Wrapper inverting the ordering of a sort key component, so that
+    ascending and descending sort keys can be mixed in one key tuple
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+def _sort_key_func(sort_keys):
+    """
+    Compiles a list of sort keys (as given by --sort-key) into one
+    key function returning a tuple, so the objects can be sorted in
+    one pass.
+
+    A key starting with - gives descending order.  A key containing {}
+    is a template, "get_duration()" is the duration, everything else
+    is taken as the name of an icalendar property.  Missing values are
+    sorted first.
+    """
+    funcs = []
+    for skey in sort_keys:
+        reverse = skey[0] == '-'
+        if reverse:
+            skey = skey[1:]
+        if '{' in skey:
+            def fkey(obj, template=Template(skey)):
+                return template.format(**obj.icalendar_component)
+        elif skey == 'get_duration()':
+            def fkey(obj):
+                return obj.get_duration()
+        else:
+            def fkey(obj, skey=skey):
+                value = obj.icalendar_component.get(skey)
+                ## vDDDTypes can't be compared, and date vs datetime can't be compared
+                if hasattr(value, 'dt'):
+                    value = _ensure_ts(value)
+                return value
+        funcs.append((fkey, reverse))
+
+    def key(obj):
+        ret = []
+        for (fkey, reverse) in funcs:
+            value = fkey(obj)
+            value = (value is not None, value)
+            ret.append(_Reversed(value) if reverse else value)
+        return tuple(ret)
+    return key
+
+def _skip_calendar(calendar, todo=None, event=None):
+    """
+    Calendars known not to support the requested component type may be
+    skipped.  supported_components is set by find_calendars when the
+    discovery cache is in use.
+    """
+    components = getattr(calendar, 'supported_components', None)
+    if not components:
+        return False
+    return bool((todo and 'VTODO' not in components) or (event and 'VEVENT' not in components))
+
+def _calendar_not_found(ctx, calendar):
+    """
+    The calendar has probably been deleted from the server.  The
+    discovery cache is invalidated, so the next run will find the
+    current calendars.
+    """
+    logging.error(f"calendar {calendar.url} not found on the server - skipping it")
+    if ctx.obj.get('discovery_cache'):
+        ctx.obj['discovery_cache'].invalidate(str(calendar.url))
+
+def _server_search(calendar, **filters):
+    """
+    calendar.search, with the ETags included in the results (needed for
+    safe updates and deletes).
+
+    For pending tasks, caldav does three searches and does not pass the
+    props on to them, so we do it ourselves.  Completed tasks returned
+    by the server are filtered out afterwards through local_search.
+    As in caldav, the recurring tasks are expanded after the results
+    are merged - the occurrences share the URL.  The workaround is not
+    needed for other searches, and may be dropped when caldav passes
+    the props on to the inner searches.
+    """
+    props = [dav.GetEtag()]
+    if not filters.get('todo') or filters.get('include_completed'):
+        return calendar.search(props=props, **filters)
+    filters = {k: v for (k, v) in filters.items() if k != 'include_completed'}
+    expand = filters.pop('expand', False)
+    split_expanded = filters.pop('split_expanded', True)
+    found = {}
+    for ignore_completed in ('ignore_completed1', 'ignore_completed2', 'ignore_completed3'):
+        for obj in calendar.search(props=props, include_completed=True, **{ignore_completed: True}, **filters):
+            found.setdefault(str(obj.url) if obj.url else id(obj), obj)
+    objs = list(found.values())
+    if not expand:
+        return objs
+    for obj in objs:
+        comp = obj.icalendar_component
+        if comp is not None and any(key in comp for key in ('exdate', 'exrule', 'rdate', 'rrule')):
+            obj.expand_rrule(filters['start'], filters['end'])
+    if not split_expanded:
+        return objs
+    return [x for obj in objs for x in obj.split_expanded()]
+
+def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=None, sort_key=[], skip_parents=None, skip_children=None, limit=None, offset=None, freebusyhack=None, pinned_tasks=None, stream=False, **kwargs_):
     """
     select/search/filter tasks/events, for listing/editing/deleting, etc
+
+    With stream, ctx.obj['objs'] may be a generator yielding the
+    objects as the searches in each calendar completes, rather than a
+    list.  This is only done when no sorting, limit or relation lookups
+    are needed - and should only be asked for when the objects are to
+    be iterated through once (i.e. by select list).
     """
+    ## An empty sort key means no sorting
+    sort_key = [x for x in sort_key if x]
+    stream = stream and not extend_objects
     if extend_objects:
         objs = ctx.obj.get('objs', [])
     else:
         objs = []
     ctx.obj['objs'] = objs
+    ## The filters giving the selection, if it can be repeated on
+    ## other calendars (see _copy_to)
+    ctx.obj['select_filters'] = None
+    ## Set if the selection contains recurrences of expanded objects
+    if not extend_objects:
+        ctx.obj['select_expanded'] = False
 
     ## TODO: move all search/filter/select logic to caldav library?
 
     ## handle all/none options
     if all is False: ## means --none.
         return
+    calendars = ctx.obj['calendars']
+    parallelism = ctx.obj.get('parallelism', DEFAULT_PARALLELISM)
     if all:
-        for c in ctx.obj['calendars']:
-            objs.extend(c.objects())
+        def _objects(c):
+            try:
+                cache = _object_cache(ctx, c)
+                if cache:
+                    return cache.iter_objects() if stream else cache.objects()
+                ## loading the objects here, so it will be done in parallel
+                return list(c.objects(load_objects=True))
+            except caldav.error.NotFoundError:
+                _calendar_not_found(ctx, c)
+                return []
+        found = _parallel_imap(_objects, calendars, parallelism)
+        if not extend_objects:
+            ctx.obj['select_filters'] = {}
+        if stream:
+            ctx.obj['objs'] = (obj for found_ in found for obj in found_)
+            return
+        for found_ in found:
+            objs.extend(found_)
         return
 
     kwargs = {}
@@ -88,20 +270,30 @@ def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=N
             kwargs[kw] = kwargs_[kw]
 
     ## uid(s)
+    comp_filter=None
+    if kwargs_.get('event'):
+        comp_filter='VEVENT'
+    if kwargs_.get('todo'):
+        comp_filter='VTODO'
+    def _objects_by_uid(c):
+        ## One worker per calendar, all uids are looked up sequentially
+        found = {}
+        source = _object_cache(ctx, c) or c
+        for uid_ in uid:
+            try:
+                found[uid_] = source.object_by_uid(uid_, comp_filter=comp_filter)
+            except caldav.error.NotFoundError:
+                pass
+        return found
+    calendars_ = [c for c in calendars if not _skip_calendar(c, kwargs_.get('todo'), kwargs_.get('event'))]
+    found_by_calendar = _parallel_map(_objects_by_uid, calendars_, parallelism) if uid else []
     missing_uids = []
     for uid_ in uid:
-        comp_filter=None
-        if kwargs_['event']:
-            comp_filter='VEVENT'
-        if kwargs_['todo']:
-            comp_filter='VTODO'
         cnt = 0
-        for c in ctx.obj['calendars']:
-            try:
-                objs.append(c.object_by_uid(uid_, comp_filter=comp_filter))
+        for found in found_by_calendar:
+            if uid_ in found:
+                objs.append(found[uid_])
                 cnt += 1
-            except caldav.error.NotFoundError:
-                pass
         if not cnt:
             missing_uids.append(uid_)
     if abort_on_missing_uid and missing_uids:
@@ -131,31 +323,65 @@ def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=N
         elif kwargs_.get(attr):
             kwargs[attr] = kwargs[attr][0]
 
-    ## TODO: special handling of parent and child! (and test for that!)
-
     if 'start' in kwargs and 'end' in kwargs:
         kwargs['expand'] = True
-    for c in ctx.obj['calendars']:
-        objs.extend(c.search(**kwargs))
+        ctx.obj['select_expanded'] = True
+    ## Server side filtering is not consistent across servers, and
+    ## some filters are not supported at all, so the filters are
+    ## evaluated client side - over the cache if available, otherwise
+    ## as a post-filter on whatever the server returns.
+    post_filters = {k: v for (k, v) in kwargs.items() if k not in NON_FILTER_KEYS}
+    ## Without sorting or further filtering, there is no need to find
+    ## more than offset+limit objects in each calendar
+    search_limit = None
+    if limit is not None and not sort_key and not skip_children and not skip_parents and pinned_tasks is None:
+        search_limit = (offset or 0) + limit
+    def _search(c):
+        try:
+            cache = _object_cache(ctx, c)
+            if cache:
+                return local_search(cache.iter_objects(), limit=search_limit, **kwargs)
+            ## caldav has no limit parameter for searches, so the server
+            ## returns all matches; the limit only saves the post-filtering
+            return local_search(_server_search(c, **server_filters(kwargs)), limit=search_limit, **post_filters)
+        except caldav.error.NotFoundError:
+            _calendar_not_found(ctx, c)
+            return []
+    calendars = [c for c in calendars if not _skip_calendar(c, kwargs.get('todo'), kwargs.get('event'))]
+    found = _parallel_imap(_search, calendars, parallelism)
+    if not extend_objects and not skip_children and not skip_parents and pinned_tasks is None and limit is None and not offset:
+        ctx.obj['select_filters'] = {k: v for (k, v) in kwargs.items() if k != 'expand'}
+        if stream and not sort_key:
+            ctx.obj['objs'] = (_check_object(obj, freebusyhack) for found_ in found for obj in found_)
+            return
+    for found_ in found:
+        objs.extend(found_)
+
+    if skip_children or skip_parents or pinned_tasks is not None:
+        ## Relations are looked up in the selection, objects outside
+        ## of it are fetched in bulk when needed
+        graph = RelationGraph(objs)
 
     if skip_children or skip_parents:
         i = 0
         while i < len(objs):
             obj = objs[i]
-            if skip_children and obj.get_relatives(parentlike, fetch_objects=False):
+            if skip_children and graph.relations(obj, parentlike):
                 objs.pop(i)
                 continue
-            if skip_parents and obj.get_relatives(childlike, fetch_objects=False):
+            if skip_parents and graph.relations(obj, childlike):
                 objs.pop(i)
                 continue
             i += 1
 
     if pinned_tasks is not None:
+        ## fetching all the parents and children at once
+        graph.relatives(objs, {'PARENT', 'CHILD'})
         ret_objs = []
         for obj in ctx.obj['objs']:
             if isinstance(obj, caldav.Event):
                 if obj.icalendar_component.get('STATUS', '') != 'CANCELLED':
-                    parents = _relships_by_type(obj, 'PARENT').get('PARENT',[])
+                    parents = _relships_by_type(obj, 'PARENT', graph).get('PARENT',[])
                     if any(x for x in parents if isinstance(x, caldav.Todo) and x.icalendar_component.get('STATUS', 'NEEDS-ACTION') == 'NEEDS-ACTION') == pinned_tasks:
                         if kwargs_.get('todo'):
                             ## TODO: special handling for recurring tasks
@@ -163,62 +389,55 @@ def __select(ctx, extend_objects=False, all=None, uid=[], abort_on_missing_uid=N
                         else:
                             ret_objs.append(obj)
             if isinstance(obj, caldav.Todo) and not pinned_tasks:
-                _relships_by_type(obj, 'CHILD').get('CHILD',[])
-                if not any(x.icalendar_comp.get('STATUS', '')!='CANCELLED' for x in parents if isinstance(x, caldav.Event)):
+                children = _relships_by_type(obj, 'CHILD', graph).get('CHILD',[])
+                if not any(x.icalendar_component.get('STATUS', '')!='CANCELLED' for x in children if isinstance(x, caldav.Event)):
                     ret_objs.append(obj)
         ctx.obj['objs'] = ret_objs
 
-    ## OPTIMIZE TODO: sorting the list multiple times rather than once is a bit of brute force, if there are several sort keys and long list of objects, we should sort once and consider all sort keys while sorting
     ## TODO: Consider that an object may be expanded and contain lots of event instances.  We will then need to expand the caldav.Event object into multiple objects, each containing one recurrance instance.  This should probably be done on the caldav side of things.
-    for skey in reversed(sort_key):
-        ## If the key starts with -, sorting should be reversed
-        if skey[0] == '-':
-            reverse = True
-            skey=skey[1:]
-        else:
-            reverse = False
-        ## if the key contains {}, it should be considered to be a template
-        if '{' in skey:
-            def fkey(obj):
-                return Template(skey).format(**obj.icalendar_component)
-        elif skey == 'get_duration()':
-            def fkey(obj):
-                return obj.get_duration()
-        else:
-            def fkey(obj):
-                return obj.icalendar_component.get(skey)
-        ctx.obj['objs'].sort(key=fkey, reverse=reverse)
-
-    ## OPTIMIZE TODO: this is also suboptimal, if ctx.obj is a very long list
-    if offset is not None:
-        ctx.obj['objs'] = ctx.obj['objs'][offset:]
+    ## With a limit, only the first offset+limit objects needs to be
+    ## sorted.  heapq.nsmallest is stable, just like list.sort
     if limit is not None:
-        ctx.obj['objs'] = ctx.obj['objs'][0:limit]
+        stop = (offset or 0) + limit
+        if sort_key:
+            ctx.obj['objs'] = heapq.nsmallest(stop, ctx.obj['objs'], key=_sort_key_func(sort_key))[offset:]
+        else:
+            ctx.obj['objs'] = ctx.obj['objs'][offset:stop]
+    else:
+        if sort_key:
+            ctx.obj['objs'].sort(key=_sort_key_func(sort_key))
+        if offset:
+            del ctx.obj['objs'][:offset]
 
-    ## some sanity checks
     for obj in ctx.obj['objs']:
-        comp = obj.icalendar_component
-        dtstart = comp.get('dtstart')
-        dtend = comp.get('dtend') or comp.get('due')
-        if dtstart and dtend and isinstance(dtstart.dt, datetime.datetime) != isinstance(dtend.dt, datetime.datetime):
-            logging.error(f"task with uuid {comp['uid']} has non-matching types on dtstart and dtend/due, setting both to timestamps")
-            comp['dtstart'].dt = datetime.datetime(dtstart.dt.year, dtstart.dt.month, dtstart.dt.day)
-            comp['dtend'].dt = datetime.datetime(dtend.dt.year, dtend.dt.month, dtend.dt.day)
-        elif dtstart and dtend and dtstart.dt > dtend.dt:
-            logging.error(f"task with uuid {comp['uid']} as dtstart after dtend/due")
+        _check_object(obj, freebusyhack)
+
+def _check_object(obj, freebusyhack=None):
+    """
+    Some sanity checks on a selected object, and the freebusyhack.
+    Returns the object.
+    """
+    comp = obj.icalendar_component
+    dtstart = comp.get('dtstart')
+    dtend = comp.get('dtend') or comp.get('due')
+    if dtstart and dtend and isinstance(dtstart.dt, datetime.datetime) != isinstance(dtend.dt, datetime.datetime):
+        logging.error(f"task with uuid {comp['uid']} has non-matching types on dtstart and dtend/due, setting both to timestamps")
+        comp['dtstart'].dt = datetime.datetime(dtstart.dt.year, dtstart.dt.month, dtstart.dt.day)
+        comp['dtend'].dt = datetime.datetime(dtend.dt.year, dtend.dt.month, dtend.dt.day)
+    elif dtstart and dtend and dtstart.dt > dtend.dt:
+        logging.error(f"task with uuid {comp['uid']} as dtstart after dtend/due")
 
     ## I need a way to copy time information from one calendar to another
     ## (typically between private and work calendars) without carrying over
     ## (too much potentially) private/confidential information.
     if freebusyhack:
-        for obj in ctx.obj['objs']:
-            comp = obj.icalendar_component
-            attribs = list(comp.keys())
-            for attr in attribs:
-                if attr not in ('DUE', 'DTEND', 'DTSTART', 'DTSTAMP', 'UID', 'RRULE', 'SEQUENCE', 'EXDATE', 'STATUS', 'CLASS'):
-                    del comp[attr]
-                if attr == 'SUMMARY':
-                    comp[attr] = freebusyhack
+        attribs = list(comp.keys())
+        for attr in attribs:
+            if attr not in ('DUE', 'DTEND', 'DTSTART', 'DTSTAMP', 'UID', 'RRULE', 'SEQUENCE', 'EXDATE', 'STATUS', 'CLASS'):
+                del comp[attr]
+            if attr == 'SUMMARY':
+                comp[attr] = freebusyhack
+    return obj
 
 def _cats(ctx):
     categories = set()
@@ -228,7 +447,163 @@ def _cats(ctx):
             categories.update(cats.cats)
     return categories
 
-def _interactive_edit(obj):
+def _target_calendars(ctx, sections=(), calendar_url=(), calendar_name=()):
+    """
+    Finds the calendars to copy to.  With sections, the
+    connection and calendar details are taken from the given section(s)
+    in the config file, otherwise the same connection(s) as for the
+    selected calendars are used.  calendar_url and calendar_name
+    overrides the calendars given in the config.
+    """
+    if sections:
+        config = ctx.obj.get('config')
+        if not config:
+            _abort("Giving up: --config-section given, but no config file found")
+        args_list = [config_section(config, section) for meta_section in sections for section in expand_config_section(config, meta_section)]
+    elif calendar_url or calendar_name:
+        args_list = [dict(args) for args in ctx.obj['args_list']]
+    else:
+        _abort("Giving up: no target calendar given")
+    if calendar_url or calendar_name:
+        for args in args_list:
+            args['calendar_url'] = calendar_url
+            args['calendar_name'] = calendar_name
+    return find_calendars_multi(args_list, ctx.obj.get('raise_errors', False), ctx.obj.get('parallelism', DEFAULT_PARALLELISM), ctx.obj.get('discovery_cache'))
+
+def _selected(calendar, url, entry, filters):
+    """
+    Checks if an object (as found in ObjectCache.entries) would have
+    been selected by the filters
+    """
+    data = entry['data']
+    obj = calendar._calendar_comp_class_by_data(data)(client=calendar.client, url=url, data=data, parent=calendar)
+    return bool(local_search([obj], **filters))
+
+def _stored_data(ctx, objs):
+    """
+    Yields (url, data) for the selected objects.  If the selection was
+    expanded, the objects are recurrences - then the full objects as
+    stored in the calendars are fetched (from the cache, or in bulk
+    from the server) rather than copying the single recurrences over
+    the recurring objects.
+    """
+    if not ctx.obj.get('select_expanded'):
+        for obj in objs:
+            yield (obj.url, obj.data)
+        return
+    urls_by_calendar = {}
+    for obj in objs:
+        ## canonical() changes the URL object in place
+        url = str(URL.objectify(str(obj.url)).canonical())
+        urls_by_calendar.setdefault(id(obj.parent), (obj.parent, {}))[1][url] = None
+    for (calendar, urls) in urls_by_calendar.values():
+        cache = _object_cache(ctx, calendar)
+        if cache:
+            for url in urls:
+                if url in cache.entries:
+                    yield (url, cache.entries[url]['data'])
+        else:
+            for (url, data, etag) in _multiget(calendar, urls):
+                yield (url, data)
+
+def _copy_to(ctx, targets, delete_vanished=False, dry_run=False, concurrency=DEFAULT_CONCURRENCY, progress=None):
+    """
+    Copies the selected objects to the target calendars.  Objects
+    already in the target with the same content are left alone,
+    objects with a higher SEQUENCE in the target are not overwritten.
+    With delete_vanished, objects in the target not found in the
+    selection are deleted, if they are matched by the selection filters.
+    This requires a selection done through --all or search filters.
+
+    Objects are updated and deleted with the ETag from the target, so
+    anything changed in the target in the meantime won't be
+    overwritten.
+
+    Returns the BulkReport, or the list of planned actions if dry_run.
+    """
+    if not targets:
+        _abort("Giving up: no target calendars found")
+    filters = ctx.obj.get('select_filters')
+    if delete_vanished and filters is None:
+        _abort("Giving up: --delete-vanished needs a selection done through --all or search filters only (no uids, limit, offset, skipping of parents/children, pinned tasks or interactive selection)")
+    source_urls = set(str(c.url.canonical()) for c in ctx.obj['calendars'])
+    for target in targets:
+        if str(target.url.canonical()) in source_urls:
+            _abort(f"Giving up: {target.url} is both source and target")
+
+    source = {}
+    for (url, data) in _stored_data(ctx, ctx.obj['objs']):
+        uid = object_uid(data)
+        if uid is None:
+            logging.warning(f"skipping object without UID: {url}")
+            continue
+        source[uid] = data
+
+    def target_entries(target):
+        cache = _object_cache(ctx, target)
+        return cache.entries if cache else fetch_entries(target)
+
+    writer = BulkWriter(targets, concurrency=concurrency, progress=progress, overwrite=False)
+    actions = []
+    for (target, entries) in zip(targets, _parallel_map(target_entries, targets, ctx.obj.get('parallelism', DEFAULT_PARALLELISM))):
+        by_uid = {}
+        for (url, entry) in entries.items():
+            by_uid[entry['uid']] = (url, entry)
+        for (uid, data) in source.items():
+            if uid not in by_uid:
+                actions.append(('put', target, uid, data, None, None))
+                continue
+            (url, entry) = by_uid[uid]
+            if same_content(data, entry['data']):
+                writer.report.count('skipped')
+            elif sequence(data) < sequence(entry['data']):
+                logging.warning(f"{uid} has a higher SEQUENCE in {target.url}, not overwriting it")
+                writer.report.count('skipped')
+            else:
+                actions.append(('put', target, uid, data, url, entry['etag']))
+        if delete_vanished:
+            for (uid, (url, entry)) in by_uid.items():
+                if uid not in source and _selected(target, url, entry, filters):
+                    actions.append(('delete', target, uid, None, url, entry['etag']))
+    if dry_run:
+        return actions
+    return writer.run(actions)
+
+def _relation_issue_text(graph, issue):
+    (kind, uid, reltype, other) = issue
+    def name(uid):
+        obj = graph.get(uid)
+        return f"{_summary(obj)} ({uid})" if obj is not None else uid
+    if kind == 'loop':
+        return f"relationship loop: {', '.join(name(x) for x in uid)}"
+    text = f"{name(uid)} has {reltype} {name(other)}"
+    if kind == 'missing':
+        return f"{text}, but there is no {inverse[reltype]} pointing back"
+    if kind == 'mismatch':
+        return f"{text}, but the RELTYPE pointing back does not match"
+    return f"{text}, which was not found"
+
+def _check_relations(ctx, fix=False, remove_dangling=False, concurrency=DEFAULT_CONCURRENCY, progress=None):
+    """
+    Checks the relations of the selected objects, see
+    relations.check_relations.  With fix, missing links back are
+    added, with remove_dangling, links to objects not found are
+    removed.  All the changed objects are saved in one go, with
+    If-Match.
+
+    Returns a tuple (graph, issues, BulkReport or None)
+    """
+    graph = RelationGraph(ctx.obj['objs'])
+    issues = check_relations(graph, ctx.obj['objs'])
+    to_fix = [x for x in issues if (fix and x[0] == 'missing') or (remove_dangling and x[0] == 'dangling')]
+    if not to_fix:
+        return (graph, issues, None)
+    changed = fix_relations(graph, to_fix)
+    writer = BulkWriter(set(obj.parent for obj in changed), concurrency=concurrency, progress=progress)
+    report = writer.run(('put', obj.parent, str(obj.icalendar_component['UID']), obj.data, obj.url, object_etag(obj)) for obj in changed)
+    return (graph, issues, report)
+
+def _interactive_edit(obj, save=True):
     if 'BEGIN:VEVENT' in obj.data:
         objtype = 'event'
     elif 'BEGIN:VTODO' in obj.data:
@@ -246,13 +621,22 @@ def _interactive_edit(obj):
     due = obj.get_due()
     if not dtstart or not due:
         click.echo(f"task without dtstart or due found, please run set-task-attribs subcommand.  Ignoring {summary}")
-        return
+        return []
     dtstart = _ensure_ts(dtstart)
     click.echo(f"pri={pri} {dtstart:%F %H:%M:%S %Z} - {due:%F %H:%M:%S %Z}: {summary}")
     input = click.prompt("postpone <n>d / ignore / part(ially-complete) / complete / split / cancel / set foo=bar / edit / family / pdb?", default='ignore')
-    command_edit(obj, input, interactive=True)
+    return command_edit(obj, input, interactive=True, save=save)
 
-def _edit(ctx, add_category=None, cancel=None, interactive_ical=False, interactive_relations=False, mass_interactive_default='ignore', mass_interactive=False, interactive=False, complete=None, complete_recurrence_mode='safe', postpone=None, postpone_with_children=None, interactive_reprioritize=False, **kwargs):
+def _snapshot(obj):
+    """
+    A hash of the object contents, for checking if an object has been
+    changed.  The icalendar instance is serialized rather than using
+    obj.data, as the raw data from the server may be formatted
+    differently.
+    """
+    return hashlib.sha256(obj.icalendar_instance.to_ical()).digest()
+
+def _edit(ctx, add_category=None, cancel=None, interactive_ical=False, interactive_relations=False, mass_interactive_default='ignore', mass_interactive=False, interactive=False, complete=None, complete_recurrence_mode='safe', postpone=None, postpone_with_children=None, interactive_reprioritize=False, dry_run=False, **kwargs):
     """
     Edits a task/event/journal
     """
@@ -280,9 +664,28 @@ def _edit(ctx, add_category=None, cancel=None, interactive_ical=False, interacti
         ## TODO: should be possible to combine this with other opitions
         return
 
-    for obj in ctx.obj['objs']:
-        if interactive:
-            _interactive_edit(obj)
+    if dry_run:
+        if not (postpone or postpone_with_children):
+            _abort("--dry-run is only supported together with --postpone or --postpone-with-children")
+        plan = _procrastinate(ctx.obj['objs'], postpone or postpone_with_children, with_children=postpone_with_children and True, dry_run=True)
+        for (obj, old_due, new_due) in plan:
+            click.echo(f"{_summary(obj)}: {_ensure_ts(old_due) if old_due else '(no due)'} -> {new_due}")
+        return
+
+    if complete is not None and cancel is not None:
+        _abort("--complete/--uncomplete can't be combined with --cancel/--uncancel")
+
+    ## All changes are done before saving, so that each changed object
+    ## is saved once.  The interactive commands and caldav's complete()
+    ## save the object themselves, those objects are only saved again
+    ## if they are changed afterwards (i.e. an interactive complete
+    ## combined with --postpone).
+    objs = ctx.obj['objs']
+    befores = []
+    ## Relatives changed by the interactive commands
+    dirty = []
+    for obj in objs:
+        before = _snapshot(obj)
         comp = obj.icalendar_component
         if kwargs.get('pdb'):
             click.echo("icalendar component available as comp")
@@ -294,25 +697,61 @@ def _edit(ctx, add_category=None, cancel=None, interactive_ical=False, interacti
             _set_something(obj, arg, ctx.obj['set_args'][arg])
         if add_category:
             _add_category(obj, add_category)
-        if complete:
-            obj.complete(handle_rrule=complete_recurrence_mode, rrule_mode=complete_recurrence_mode)
-        elif complete is False:
-            obj.uncomplete()
         if cancel:
-            comp.status='CANCELLED'
+            comp['STATUS'] = 'CANCELLED'
         elif cancel is False:
-            comp.status='NEEDS-ACTION'
-        if postpone or postpone_with_children:
-            _procrastinate([obj], postpone or postpone_with_children, with_children=postpone_with_children and True)
+            comp['STATUS'] = 'NEEDS-ACTION'
+        if interactive:
+            unsaved = _interactive_edit(obj, save=False)
+            if not any(x is obj for x in unsaved):
+                before = _snapshot(obj)
+            dirty.extend(x for x in unsaved if x is not obj)
+        befores.append(before)
 
-        ## OPTIMIZE TODO: only save objects that actually have been edited
-        obj.save()
+    ## The relatives are fetched and all the tasks postponed in one go
+    plan = []
+    if postpone or postpone_with_children:
+        plan = _procrastinate(objs, postpone or postpone_with_children, with_children=postpone_with_children and True, save=False)
+    dirty.extend(obj for (obj, old_due, new_due) in plan)
 
-def _check_for_panic(ctx, hours_per_day, output=True, print_timeline=True, fix_timeline=False, interactive_fix_timeline=False, timeline_start=None, timeline_end=None, include_all_events=False):
-    if not timeline_start:
-        timeline_start = _now()
-    else:
-        timeline_start = parse_dt(timeline_start, datetime.datetime)
+    ## caldav saves the object when completing, including the changes above
+    if complete is not None:
+        for (i, obj) in enumerate(objs):
+            mark_stale(obj.parent)
+            if complete:
+                obj.complete(handle_rrule=complete_recurrence_mode, rrule_mode=complete_recurrence_mode)
+            else:
+                obj.uncomplete()
+            befores[i] = _snapshot(obj)
+
+    ## Only objects that actually have been edited are saved.
+    changed = [obj for (obj, before) in zip(objs, befores) if _snapshot(obj) != before]
+    ## Postponed relatives outside the selection should also be saved
+    changed_ids = set(id(obj) for obj in objs)
+    for obj in dirty:
+        if id(obj) not in changed_ids:
+            changed_ids.add(id(obj))
+            changed.append(obj)
+    _save_all(changed, ctx.obj.get('parallelism', DEFAULT_PARALLELISM))
+    if objs:
+        click.echo(f"{len(changed)} objects changed and saved", err=True)
+
+def _panic_planner(ctx, hours_per_day, timeline_start, timeline_end=None, include_all_events=False, compact_timeline=False, working_hours=(), holiday_calendar=()):
+    """
+    Makes a Planner (see panic_planning) for the selected objects -
+    with include_all_events, all the events from timeline_start to
+    timeline_end are selected as well.
+
+    working_hours is a list of specs like '09:00-17:00 mon-fri' (see
+    panic_planning.parse_working_hours), the time taken by the events
+    in the holiday_calendar(s) (calendar names) is not counted as
+    working hours.
+    """
+    if working_hours:
+        try:
+            working_hours = parse_working_hours(working_hours)
+        except ValueError as e:
+            _abort(f"Giving up: {e}")
     if not timeline_end:
         timeline_end = parse_add_dur(timeline_start, '+1y')
     timeline_end = parse_dt(timeline_end, datetime.datetime)
@@ -321,7 +760,22 @@ def _check_for_panic(ctx, hours_per_day, output=True, print_timeline=True, fix_t
         ctx.obj['objs'] = [x for x in ctx.obj['objs'] if 'BEGIN:VEVENT' not in x.data]
         ## ... and then add all events
         _select(ctx, event=True, start=timeline_start, end=timeline_end, extend_objects=True)
-    possible_timeline = timeline_suggestion(ctx, hours_per_day=hours_per_day, timeline_end=timeline_end)
+    holidays = []
+    if holiday_calendar:
+        for calendar in _target_calendars(ctx, calendar_name=holiday_calendar):
+            holidays.extend(_server_search(calendar, event=True, start=timeline_start, end=timeline_end))
+    return Planner(ctx.obj['objs'], hours_per_day, timeline_end, compact_timeline, working_hours or None, holidays)
+
+def _check_for_panic(ctx, hours_per_day, output=True, print_timeline=True, fix_timeline=False, interactive_fix_timeline=False, timeline_start=None, timeline_end=None, include_all_events=False, compact_timeline=False, working_hours=(), holiday_calendar=()):
+    """
+    See _panic_planner for the parameters.  Returns the timeline
+    """
+    if not timeline_start:
+        timeline_start = _now()
+    else:
+        timeline_start = parse_dt(timeline_start, datetime.datetime)
+    planner = _panic_planner(ctx, hours_per_day, timeline_start, timeline_end, include_all_events, compact_timeline, working_hours, holiday_calendar)
+    possible_timeline = planner.timeline
     def summary(obj):
         if obj is None:
             return "-- unallocated time --"
@@ -335,6 +789,12 @@ def _check_for_panic(ctx, hours_per_day, output=True, print_timeline=True, fix_t
             if 'begin' in foo:
                 click.echo(f"{foo['begin']:%FT%H:%M %Z} {summary(foo.get('obj'))}")
 
+    if output and possible_timeline.overlaps:
+        click.echo()
+        click.echo("OVERLAPPING EVENTS:")
+        for (begin, end, events) in possible_timeline.overlaps:
+            click.echo(f"{begin:%FT%H:%M %Z} - {end:%FT%H:%M %Z} {', '.join(_summary(x) for x in events)}")
+
     if output:
         click.echo()
         click.echo("THESE TASKS WILL NEED TO BE PROCRASTINATED:")
@@ -418,10 +878,11 @@ def _add_todo(ctx, **kwargs):
         duration = ctx.obj['set_args'].pop('duration')
 
     for cal in ctx.obj['calendars']:
+        mark_stale(cal)
         todo = cal.save_todo(ical=ctx.obj.get('ical_fragment', ""), **ctx.obj['set_args'], no_overwrite=True)
         if duration:
             todo.set_duration(duration)
-            todo.save()
+            _save(todo)
         click.echo(f"uid={todo.id}")
     return todo
 
@@ -429,6 +890,7 @@ def _add_event(ctx, timespec, **kwargs):
     _process_set_args(ctx, kwargs)
     for cal in ctx.obj['calendars']:
         (dtstart, dtend) = parse_timespec(timespec, for_storage=True)
+        mark_stale(cal)
         event = cal.save_event(dtstart=dtstart, dtend=dtend, **ctx.obj['set_args'], no_overwrite=True)
         click.echo(f"uid={event.id}")
 
@@ -455,21 +917,36 @@ def _check_due(ctx, limit=16, lookahead='24h'):
             continue
         _interactive_edit(obj)
 
-def _dismiss_panic(ctx, hours_per_day, lookahead='60d'):
-    ## TODO: fetch both events and tasks
-    lookahead=f"+{lookahead}"
-    _select(ctx=ctx, todo=True, end=lookahead)
-    timeline = _check_for_panic(ctx=ctx, output=False, hours_per_day=hours_per_day, timeline_end=lookahead, include_all_events=True)
+def _dismiss_panic(ctx, hours_per_day, lookahead='60d', planner=None):
+    """
+    Goes through the tasks that should have been started already
+    according to the timeline suggestion, lowest priority first, and
+    asks how to procrastinate them.  The plan is updated after every
+    change, rather than made from scratch.
+
+    A planner from an earlier run may be given, then the tasks are
+    not selected once more.  Returns the planner.
+    """
+    if planner is None:
+        ## TODO: fetch both events and tasks
+        lookahead=f"+{lookahead}"
+        _select(ctx=ctx, todo=True, end=lookahead)
+        planner = _panic_planner(ctx, hours_per_day, _now(), timeline_end=lookahead, include_all_events=True)
+    elif planner.hours_per_day != hours_per_day:
+        planner.hours_per_day = hours_per_day
+        planner.replan()
 
+    timeline = planner.timeline
     if not timeline or _ensure_ts(timeline[0]['begin'])>_now():
         click.echo("No need to panic :-)")
-        return
+        return planner
 
-    for priority in range(9,0,-1):
+    priority = 9
+    while priority > 0:
         first_low_pri_tasks = []
         other_low_pri_tasks = []
         lpt = first_low_pri_tasks
-        for item in timeline:
+        for item in planner.timeline:
             if isinstance(item.get('obj', ''), str):
                 continue
             if _ensure_ts(item['begin'])>_now():
@@ -480,6 +957,7 @@ def _dismiss_panic(ctx, hours_per_day, lookahead='60d'):
                 continue
             lpt.append(item)
         if not first_low_pri_tasks:
+            priority -= 1
             continue
 
         click.echo(f"Tasks that needs to be postponed (priority={priority}):")
@@ -497,6 +975,8 @@ def _dismiss_panic(ctx, hours_per_day, lookahead='60d'):
         if priority == 2:
             _abort("PANIC!  Those tasks cannot be postponed.  Maybe you want to cancel some of them?  (interactive cancelling not supported yet)")
 
+        objs = [x['obj'] for x in first_low_pri_tasks]
+        next_priority = priority - 1
         procrastination_time = (_now()-_ensure_ts(first_low_pri_tasks[0]['begin']))/2
         if procrastination_time.days:
             procrastination_time = f"{procrastination_time.days+1}d"
@@ -505,22 +985,30 @@ def _dismiss_panic(ctx, hours_per_day, lookahead='60d'):
         default_procrastination_time = procrastination_time
         procrastination_time = click.prompt("Push the due-date with ... (press O for one-by-one, E for edit all, P for reprioritize)", default=procrastination_time)
         if procrastination_time == 'O':
-            for item in first_low_pri_tasks:
-                _interactive_edit(item['obj'])
-        elif procrastination_time == 'P':
-            _mass_reprioritize([x['obj'] for x in first_low_pri_tasks])
-            ## TODO: after reprioritation, the whole algorithm needs to be restarted
-        elif procrastination_time == 'E':
-            ## TODO: since tasks with different priority may be affected, it's needed to restart the algorithm
-            _mass_interactive_edit([x['obj'] for x in first_low_pri_tasks], default=f"postpone {default_procrastination_time}")
+            for obj in objs:
+                _interactive_edit(obj)
+            planner.update(objs)
+        elif procrastination_time in ('P', 'E'):
+            if procrastination_time == 'P':
+                _mass_reprioritize(objs)
+            else:
+                _mass_interactive_edit(objs, default=f"postpone {default_procrastination_time}")
+            planner.update(objs)
+            ## Tasks moved to a lower priority (already gone through) should be considered once more
+            moved = [x.icalendar_component.get('priority', 0) for x in objs]
+            next_priority = max([next_priority] + [x for x in moved if x > priority])
         else:
-            _procrastinate([x['obj'] for x in first_low_pri_tasks], procrastination_time,  check_dependent='interactive', err_callback=click.echo, confirm_callback=click.confirm)
+            plan = _procrastinate(objs, procrastination_time,  check_dependent='interactive', err_callback=click.echo, confirm_callback=click.confirm)
+            planner.update([x[0] for x in plan])
 
         if other_low_pri_tasks:
             click.echo(f"There are {len(other_low_pri_tasks)} later pri>={priority} tasks selected which should maybe probably be considered to be postponed a bit as well")
             procrastination_time = click.prompt("Push the due-date for those with ...", default='0h')
             if procrastination_time not in ('0', '0h', '0m', '0d', 0):
-                _procrastinate([x['obj'] for x in other_low_pri_tasks], procrastination_time, check_dependent='interactive', err_callback=click.echo, confirm_callback=click.confirm)
+                plan = _procrastinate([x['obj'] for x in other_low_pri_tasks], procrastination_time, check_dependent='interactive', err_callback=click.echo, confirm_callback=click.confirm)
+                planner.update([x[0] for x in plan])
+        priority = next_priority
+    return planner
 
 def _split_huge_tasks(ctx, threshold='4h', max_lookahead='60d', limit_lookahead=640):
     _select(ctx=ctx, todo=True, end=f"+{max_lookahead}", limit=limit_lookahead, sort_key=['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}', '{PRIORITY:?0?}'])
@@ -533,11 +1021,10 @@ def _split_huge_tasks(ctx, threshold='4h', max_lookahead='60d', limit_lookahead=
 def _split_high_pri_tasks(ctx, threshold=2, max_lookahead='60d', limit_lookahead=640):
     _select(ctx=ctx, todo=True, end=f"+{max_lookahead}", limit=limit_lookahead, sort_key=['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}', '{PRIORITY:?0?}'])
     objs = ctx.obj['objs']
+    graph = RelationGraph(objs)
     for obj in objs:
         if obj.icalendar_component.get('PRIORITY') and obj.icalendar_component.get('PRIORITY') <= threshold:
-            ## TODO: get_relatives refactoring
-            relations = obj.get_relatives(fetch_objects=False)
-            if 'CHILD' not in relations:
+            if not graph.relations(obj, {'CHILD'}):
                 interactive_split_task(obj, too_big=False)
 
 def _set_task_attribs(ctx):
@@ -554,9 +1041,7 @@ def _set_task_attribs(ctx):
             something_ = 'dtstart'
             cond['no_dtstart'] = True
         _select(ctx=ctx, todo=True, limit=LIMIT, sort_key=['{DTSTART:?{DUE:?(0000)?}?%F %H:%M:%S}', '{PRIORITY:?0?}'], **cond)
-        ## Doing some client-side filtering due to calendar servers that don't support the RFC properly
-        ## TODO: "Incompatibility workarounds" should be moved to the caldav library
-        objs_ = [x for x in ctx.obj['objs'] if not x.icalendar_component.get(something_)]
+        objs_ = list(ctx.obj['objs'])
 
         ## add all non-duplicated objects from objs to objs_
         uids_ = {x.icalendar_component['UID'] for x in objs_}
@@ -588,7 +1073,7 @@ def _set_task_attribs(ctx):
                 value = click.prompt(summary, default=default)
                 if value == 'completed!':
                     obj.complete()
-                    obj.save()
+                    _save(obj)
                     continue
                 if something == 'category':
                     comp.add(something_, value.split(','))
@@ -601,7 +1086,7 @@ def _set_task_attribs(ctx):
                     if hasattr(comp[something], 'dt'):
                         if not comp[something].dt.tzinfo:
                             comp[something].dt = comp[something].dt.astimezone(tz.store_timezone)
-                obj.save()
+                _save(obj)
             click.echo()
         return objs
 
@@ -0,0 +1,265 @@
+"""Streaming handling of icalendar data
+
+Working line by line on the raw icalendar data rather than parsing it
+through the icalendar library, so that huge calendars can be exported
+and imported without building everything in memory.
+"""
+
+import hashlib
+import logging
+import re
+
+PRODID = "-//plann.no//plann//EN"
+
+def _lines(data):
+    """
+    Splits raw icalendar data into non-empty lines, with the line
+    endings stripped.  Folded lines are not unfolded - continuation
+    lines start with whitespace, so they can't be mistaken for
+    BEGIN/END lines.
+    """
+    ## str.splitlines would also split on i.e. \x1c and \u2028, which may appear in property values
+    for line in data.replace("\r\n", "\n").split("\n"):
+        if line:
+            yield line
+
+def components(data):
+    """
+    Yields (name, block) for every component directly below the
+    VCALENDAR in the raw icalendar data.  block is the raw text of
+    the component with CRLF line endings.  Calendar level properties
+    (VERSION, PRODID, etc) are skipped.
+    """
+    block = None
+    name = None
+    depth = 0
+    for line in _lines(data):
+        if line.startswith('BEGIN:'):
+            depth += 1
+            if depth == 2:
+                name = line[6:].strip().upper()
+                block = []
+        if block is not None:
+            block.append(line)
+        if line.startswith('END:'):
+            depth -= 1
+            if depth == 1 and block is not None:
+                yield (name, "\r\n".join(block) + "\r\n")
+                block = None
+
+def _tzid(block):
+    for line in block.split("\r\n"):
+        if line.startswith('TZID:'):
+            return line[5:]
+    return block
+
+def vcalendar_chunks(objs, filter=lambda obj: True):
+    """
+    Yields one VCALENDAR containing all the objects, as text chunks.
+
+    The components are taken from the raw data of each object.  A
+    VTIMEZONE is only output the first time it's seen.
+    """
+    yield f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:{PRODID}\r\n"
+    seen_tzids = set()
+    for obj in objs:
+        if not filter(obj):
+            continue
+        for (name, block) in components(obj.data):
+            if name == 'VTIMEZONE':
+                tzid = _tzid(block)
+                if tzid in seen_tzids:
+                    continue
+                seen_tzids.add(tzid)
+            yield block
+    yield "END:VCALENDAR\r\n"
+
+def _unfold(lines):
+    return re.sub(r'\r?\n[ \t]', '', "\n".join(lines))
+
+def _component_uid(comp):
+    """
+    Finds the UID of a component given as a list of lines.  A UID in
+    a subcomponent (i.e. VALARM) is not considered.
+    """
+    depth = 0
+    for i, line in enumerate(comp):
+        if line.startswith('BEGIN:'):
+            depth += 1
+        elif line.startswith('END:'):
+            depth -= 1
+        elif depth == 1 and line.startswith('UID:'):
+            j = i+1
+            while j < len(comp) and comp[j][:1] in (' ', '\t'):
+                j += 1
+            return _unfold(comp[i:j])[4:].strip()
+    return None
+
+def _referenced_tzids(lines):
+    return set(x[1] for x in re.findall(r';TZID=("?)([^";:]+)\1', _unfold(lines)))
+
+def insert_before_end(lines, fragment):
+    """
+    Inserts the fragment lines before every END: line
+    """
+    fragment = fragment.split("\n")
+    for line in lines:
+        if line.startswith('END:'):
+            yield from fragment
+        yield line
+
+def split_vcalendars(lines):
+    """
+    Takes an iterable of lines (i.e. an open file) with one or more
+    VCALENDARs, and yields one VCALENDAR per UID as a string, as
+    required by CalDAV.  The input is walked through incrementally.
+
+    Adjacent components with the same UID (i.e. a recurring event and
+    its exceptions) are grouped together.  Each VCALENDAR gets the
+    calendar level properties and the VTIMEZONEs referenced by the
+    components.  VTIMEZONEs should come before the components using
+    them, as they are in the output of most calendar software.
+
+    Input not starting with BEGIN:VCALENDAR is yielded unchanged as one
+    string.
+    """
+    lines = (line.rstrip("\r\n") for line in lines)
+    for first in lines:
+        if first.strip():
+            break
+    else:
+        return
+    if not first.startswith('BEGIN:VCALENDAR'):
+        yield "\n".join([first, *lines])
+        return
+
+    cal_props = []
+    timezones = {}
+    group = None
+    group_uid = None
+    ## The UIDs are kept to warn about non-adjacent duplicates
+    seen_uids = set()
+
+    def flush():
+        if group_uid is not None and group_uid in seen_uids:
+            logging.warning(f"UID {group_uid} found in non-adjacent components.  They will be saved separately, and may overwrite each other")
+        seen_uids.add(group_uid)
+        tzids = _referenced_tzids(group)
+        vtimezones = [line for tzid in timezones if tzid in tzids for line in timezones[tzid]]
+        return "\r\n".join(['BEGIN:VCALENDAR', *cal_props, *vtimezones, *group, 'END:VCALENDAR']) + "\r\n"
+
+    depth = 1
+    comp = None
+    for line in lines:
+        if not line.strip():
+            continue
+        if depth == 0:
+            if line.startswith('BEGIN:VCALENDAR'):
+                depth = 1
+                cal_props = []
+                timezones = {}
+            else:
+                logging.warning(f"ignoring line outside VCALENDAR: {line}")
+            continue
+        if depth == 1:
+            if line.startswith('END:VCALENDAR'):
+                if group:
+                    yield flush()
+                group = None
+                group_uid = None
+                depth = 0
+            elif line.startswith('BEGIN:'):
+                depth = 2
+                comp = [line]
+            else:
+                cal_props.append(line)
+            continue
+        comp.append(line)
+        if line.startswith('BEGIN:'):
+            depth += 1
+        elif line.startswith('END:'):
+            depth -= 1
+            if depth == 1:
+                if comp[0] == 'BEGIN:VTIMEZONE':
+                    tzid = _tzid("\r\n".join(comp))
+                    timezones[tzid] = comp
+                    continue
+                uid = _component_uid(comp)
+                if group and uid is not None and uid == group_uid:
+                    group.extend(comp)
+                else:
+                    if group:
+                        yield flush()
+                    group = comp
+                    group_uid = uid
+    if group:
+        ## missing END:VCALENDAR
+        yield flush()
+
+def object_uid(data):
+    """
+    Returns the UID of the first non-VTIMEZONE component in the raw
+    icalendar data, or None
+    """
+    for (name, block) in components(data):
+        if name != 'VTIMEZONE':
+            return _component_uid(block.split("\r\n"))
+    return None
+
+def generated_uid(data):
+    """
+    A UID for an object lacking one, derived from the data, so the
+    same input always gets the same UID
+    """
+    return f"plann-{hashlib.sha256(data.encode()).hexdigest()[:32]}"
+
+def as_vcalendar(data):
+    """
+    Wraps raw icalendar data in a VCALENDAR, unless it already is one
+    """
+    if data.lstrip().startswith('BEGIN:VCALENDAR'):
+        return data
+    return "\r\n".join(['BEGIN:VCALENDAR', 'VERSION:2.0', f"PRODID:{PRODID}", *_lines(data), 'END:VCALENDAR']) + "\r\n"
+
+def add_uid(data, uid):
+    """
+    Adds the UID to the first component other than VTIMEZONE in the
+    raw VCALENDAR
+    """
+    ret = []
+    depth = 0
+    added = False
+    for line in _lines(data):
+        ret.append(line)
+        if line.startswith('BEGIN:'):
+            depth += 1
+            if depth == 2 and not added and line.strip() != 'BEGIN:VTIMEZONE':
+                ret.append(f"UID:{uid}")
+                added = True
+        elif line.startswith('END:'):
+            depth -= 1
+    return "\r\n".join(ret) + "\r\n"
+
+def _content_lines(data):
+    lines = []
+    for (name, block) in components(data):
+        if name == 'VTIMEZONE':
+            continue
+        lines.extend(x for x in _unfold(block.split("\r\n")).split("\n") if x and not x.startswith('DTSTAMP'))
+    return sorted(lines)
+
+def same_content(data1, data2):
+    """
+    Compares the components in two raw icalendar objects.  The
+    VTIMEZONEs, the DTSTAMP and the order of the properties are not
+    considered, as they may be changed by a server without the object
+    being changed.
+    """
+    return _content_lines(data1) == _content_lines(data2)
+
+def sequence(data):
+    """
+    Returns the highest SEQUENCE found in the raw icalendar data, or 0
+    """
+    found = re.findall(r'^SEQUENCE[;:](?:[^:\r\n]*:)?\s*(\d+)', data, re.MULTILINE)
+    return max((int(x) for x in found), default=0)
@@ -22,6 +22,7 @@ import tempfile
 import click
 from icalendar.prop import vRecur
 
+from plann.cache import mark_stale
 from plann.lib import (
     _adjust_relations,
     _list,
@@ -29,6 +30,8 @@ from plann.lib import (
     _process_set_arg,
     _procrastinate,
     _relationship_text,
+    _save,
+    _save_all,
     _set_something,
     _split_vcal,
     _summary,
@@ -38,13 +41,23 @@ from plann.template import Template
 from plann.timespec import _ensure_ts, parse_add_dur
 
 
-def command_edit(obj, command, interactive=True):
+def command_edit(obj, command, interactive=True, save=True):
+    """
+    Edits the object according to the command.
+
+    Some of the commands save the object themselves.  The other
+    changed objects are saved - or, if save is False, returned so the
+    caller can save them (together with other changes) later.
+    """
+    dirty = [obj]
     if command == 'ignore':
-        return
+        return []
     elif command in ('part', 'partially-complete'):
         interactive_split_task(obj, partially_complete=True, too_big=False)
+        dirty = []
     elif command == 'split':
         interactive_split_task(obj, too_big=False)
+        dirty = []
     elif command.startswith('postpone'):
         with_params = {}
         commands = command.split(' ')
@@ -63,9 +76,13 @@ def command_edit(obj, command, interactive=True):
             if 'with family' in command:
                 with_params['with_family'] = true
         ## TODO: we probably shouldn't be doing this interactively here?
-        _procrastinate([obj], command.split(' ')[1], **with_params)
+        plan = _procrastinate([obj], command.split(' ')[1], save=False, **with_params)
+        dirty = [x[0] for x in plan]
     elif command == 'complete':
+        ## caldav saves the object
+        mark_stale(obj.parent)
         obj.complete(handle_rrule=True)
+        dirty = []
     elif command == 'cancel':
         obj.icalendar_component['STATUS'] = 'CANCELLED'
     elif command.lower().startswith('set rrule='):
@@ -80,11 +97,15 @@ def command_edit(obj, command, interactive=True):
             _set_something(obj, x, parsed[x])
     elif command == 'edit':
         _interactive_ical_edit([obj])
+        dirty = []
     elif command == 'family':
+        ## The relatives are looked up and saved by uid, obj is not changed
         _interactive_relation_edit([obj])
+        dirty = []
     elif command == 'start':
         ## TODO - experimental and very incomplete!
         add_time_tracking(obj)
+        dirty = []
     elif command == 'pdb':
         if interactive:
             click.echo("icalendar component available as comp")
@@ -97,8 +118,11 @@ def command_edit(obj, command, interactive=True):
             click.echo(f"unknown instruction '{command}' - ignoring")
         else:
             raise NameError(f"unknown instruction '{command}' - ignoring")
-        return
-    obj.save()
+        return []
+    if not save:
+        return dirty
+    _save_all(dirty)
+    return []
 
 def _interactive_ical_edit(objs):
     ical = "\n".join([x.data for x in objs])
@@ -110,7 +134,7 @@ def _interactive_ical_edit(objs):
         ## Should probably assert that the UID is the same ...
         ## ... or, leave it to the calendar server to handle changed UIDs
         obj.data = new
-        obj.save()
+        _save(obj)
 
 def _interactive_relation_edit(objs):
     if not objs:
@@ -205,7 +229,7 @@ def _abort(message):
     click.echo(message)
     raise click.Abort(message)
 
-def _interactive_edit(obj):
+def _interactive_edit(obj, save=True):
     if 'BEGIN:VEVENT' in obj.data:
         objtype = 'event'
     elif 'BEGIN:VTODO' in obj.data:
@@ -223,11 +247,11 @@ def _interactive_edit(obj):
     due = obj.get_due()
     if not dtstart or not due:
         click.echo(f"task without dtstart or due found, please run set-task-attribs subcommand.  Ignoring {summary}")
-        return
+        return []
     dtstart = _ensure_ts(dtstart)
     click.echo(f"pri={pri} {dtstart:%F %H:%M:%S %Z} - {due:%F %H:%M:%S %Z}: {summary}")
     input = click.prompt("postpone <n>d / ignore / part(ially-complete) / complete / split / cancel / set foo=bar / edit / family / pdb?", default='ignore')
-    command_edit(obj, input, interactive=True)
+    return command_edit(obj, input, interactive=True, save=save)
 
 def _mass_reprioritize(objs):
     text = """\
@@ -319,6 +343,7 @@ def interactive_split_task(obj, partially_complete=False, too_big=True):
             if not summary:
                 break
             cnt += 1
+            mark_stale(obj.parent)
             todo = obj.parent.save_todo(summary=summary, parent=[comp['uid']])
             obj.load()
             if partially_complete:
@@ -330,9 +355,10 @@ def interactive_split_task(obj, partially_complete=False, too_big=True):
         new_summary = click.prompt("Summary of the parent task?", default=obj.icalendar_component['SUMMARY'])
         obj.icalendar_component['SUMMARY'] = new_summary
         postpone = click.prompt("Should we postpone the parent task?", default='0h')
+        plan = []
         if postpone in ('0h', '0'): ## TODO: regexp?
-            _procrastinate([obj], postpone, check_dependent='interactive', err_callback=click.echo, confirm_callback=click.confirm)
-        obj.save()
+            plan = _procrastinate([obj], postpone, check_dependent='interactive', err_callback=click.echo, confirm_callback=click.confirm, save=False)
+        _save_all([obj] + [x[0] for x in plan if x[0] is not obj])
 
 def _editor(sometext):
     with tempfile.NamedTemporaryFile(mode='w', encoding='UTF-8', delete=False) as tmpfile:
@@ -9,14 +9,20 @@ TODO: Sort all this mess.  Split out things that are interactive?
 """
 
 import datetime
+import json
 import logging
 import subprocess
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import caldav
 import click  ## TODO - this should be removed, eventually
 import icalendar
 
+from plann.cache import mark_stale
+from plann.ics import vcalendar_chunks
+from plann.relations import RelationGraph, _loops, _uid, childlike, connected, hierarchy, parentlike, related_uids
 from plann.template import Template
 from plann.timespec import (
     _ensure_ts,
@@ -37,6 +43,54 @@ attr_txt_many = ['category', 'comment', 'contact', 'resources', 'parent', 'child
 attr_time = ['dtstamp', 'dtstart', 'due', 'dtend', 'duration']
 attr_int = ['priority']
 
+## Max number of concurrent requests towards the calendar server(s)
+DEFAULT_PARALLELISM = 8
+
+def _parallel_map(func, items, parallelism=DEFAULT_PARALLELISM):
+    """
+    Like map(func, items), but with up to parallelism calls running
+    concurrently in threads.  Used for doing requests towards several
+    calendars at the same time.
+
+    Returns a list with the results in the same order as the items.
+    The first exception raised by func is reraised.
+    """
+    return list(_parallel_imap(func, items, parallelism))
+
+def _parallel_imap(func, items, parallelism=DEFAULT_PARALLELISM):
+    """
+    Like _parallel_map, but yields each result as soon as it (and the
+    results before it) are ready.  Calls not yet started are cancelled
+    if the generator is closed early.
+    """
+    items = list(items)
+    if parallelism <= 1 or len(items) <= 1:
+        for x in items:
+            yield func(x)
+        return
+    executor = ThreadPoolExecutor(max_workers=min(parallelism, len(items)))
+    try:
+        yield from executor.map(func, items)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def _save(obj):
+    """
+    Saves the object.  A local cache of the calendar will be synced
+    on the next read (see cache.mark_stale).
+    """
+    mark_stale(obj.parent)
+    obj.save()
+
+def _save_all(objs, parallelism=DEFAULT_PARALLELISM):
+    """
+    Saves the objects concurrently, see _save
+    """
+    objs = list(objs)
+    for calendar in {id(x.parent): x.parent for x in objs}.values():
+        mark_stale(calendar)
+    _parallel_map(lambda obj: obj.save(), objs, parallelism)
+
 def _split_vcal(ical):
     """
     This method will take an ical string containing one VCALENDAR with multiple calendar resource objects and split it into one VCALENDAR per calendar resource object.
@@ -64,20 +118,82 @@ def _split_vcal(ical):
             split_by_uid[uid].add_component(subcomponent)
     return split_by_uid.values()
 
-def _split_vcals(ical):
+class LazyDict(dict):
+    """
+    dict where some of the values are computed on first access.  Used
+    for ctx.obj, so that calendar discovery is only done if the
+    subcommand actually needs the calendars (i.e. not for --help).
+
+    Usage: d.lazy['calendars'] = some_function
     """
-    This method will take a string with multiple VCALENDAR entries and
-    split it into a list
+    def __init__(self, *largs, **kwargs):
+        super().__init__(*largs, **kwargs)
+        self.lazy = {}
+
+    def __missing__(self, key):
+        if key not in self.lazy:
+            raise KeyError(key)
+        self[key] = self.lazy.pop(key)()
+        return self[key]
+
+    def get(self, key, default=None):
+        if key in self or key in self.lazy:
+            return self[key]
+        return default
+
+## Clients and principals shared between all config sections using
+## the same connection parameters (server, credentials, TLS and proxy
+## settings, etc).  json of the connection parameters -> dict
+_dav_clients = {}
+_dav_clients_lock = threading.Lock()
+
+def _dav_client(conn_params):
+    key = json.dumps(conn_params, sort_keys=True, default=repr)
+    with _dav_clients_lock:
+        if key not in _dav_clients:
+            _dav_clients[key] = {'client': caldav.DAVClient(**conn_params), 'principal': None, 'lock': threading.Lock()}
+        return _dav_clients[key]
+
+def _dav_principal(conn_params):
+    shared = _dav_client(conn_params)
+    ## Holding a per-server lock, so the principal is fetched only once
+    with shared['lock']:
+        if shared['principal'] is None:
+            shared['principal'] = shared['client'].principal()
+        return shared['principal']
+
+def _calendar_info(calendar):
     """
-    ical = ical.strip()
-    icals = []
-    while ical.startswith("BEGIN:VCALENDAR\n"):
-        pos = ical.find("\nEND:VCALENDAR") + 14
-        icals.append(ical[:pos])
-        ical = ical[pos:].lstrip()
-    return icals
+    Information about a calendar to be stored in the discovery cache.
+    Sets calendar.supported_components as a side effect.
+    """
+    try:
+        components = calendar.get_supported_components()
+    except caldav.error.DAVError:
+        components = None
+    calendar.supported_components = components
+    return {'url': str(calendar.url), 'name': calendar.name, 'components': components}
+
+def find_calendars_multi(args_list, raise_errors, parallelism=DEFAULT_PARALLELISM, discovery_cache=None):
+    """
+    Runs find_calendars concurrently for a list of argument dicts
+    (typically one per config section).  Returns one list of calendars,
+    in the same order as the arguments.
+    """
+    ret = []
+    for calendars in _parallel_map(lambda args: find_calendars(args, raise_errors, parallelism, discovery_cache), args_list, parallelism):
+        ret.extend(calendars)
+    return ret
+
+def find_calendars(args, raise_errors, parallelism=DEFAULT_PARALLELISM, discovery_cache=None):
+    """
+    Returns the calendars given by args (typically a config section).
 
-def find_calendars(args, raise_errors):
+    If a discovery_cache (cache.DiscoveryCache) is given, the calendars
+    are taken from the cache if possible, without any communication
+    with the server.  Calendars found through the cache or stored to
+    the cache will get a supported_components attribute.
+    """
     def list_(obj):
         """
         For backward compatibility, a string rather than a list can be given as
@@ -123,27 +239,42 @@ def find_calendars(args, raise_errors):
     ## https://github.com/tobixen/plann/issues/11, credits to @bergercookie
     if 'caldav_url' in conn_params:
         conn_params['url'] = conn_params.pop('caldav_url')
-    if conn_params:
-        client = caldav.DAVClient(**conn_params)
-        principal = _try(client.principal, {}, conn_params['url'])
+    calendar_urls = list_(args.get('calendar_url'))
+    calendar_names = list_(args.get('calendar_name'))
+    cache_key = json.dumps([conn_params.get('url'), conn_params.get('username'), calendar_urls, calendar_names])
+    cached = discovery_cache.get(cache_key) if discovery_cache and conn_params else None
+    if cached is not None:
+        client = _dav_client(conn_params)['client']
+        for info in cached:
+            calendar = caldav.Calendar(client=client, url=info['url'], name=info['name'])
+            calendar.supported_components = info['components']
+            calendars.append(calendar)
+    elif conn_params:
+        principal = _try(_dav_principal, {'conn_params': conn_params}, conn_params['url'])
         if not principal:
             return []
-        calendars = []
-        tries = 0
-        for calendar_url in list_(args.get('calendar_url')):
+
+        def _calendar_by_url(calendar_url):
             if '/' in calendar_url:
                 calendar = principal.calendar(cal_url=calendar_url)
             else:
                 calendar = principal.calendar(cal_id=calendar_url)
-            tries += 1
-            if _try(calendar.get_display_name, {}, calendar.url):
-                calendars.append(calendar)
-        for calendar_name in list_(args.get('calendar_name')):
-            tries += 1
-            calendar = _try(principal.calendar, {'name': calendar_name}, '{} : calendar "{}"'.format(conn_params['url'], calendar_name))
-            calendars.append(calendar)
+            name = _try(calendar.get_display_name, {}, calendar.url)
+            if name:
+                calendar.name = name
+                return calendar
+
+        def _calendar_by_name(calendar_name):
+            return _try(principal.calendar, {'name': calendar_name}, '{} : calendar "{}"'.format(conn_params['url'], calendar_name))
+
+        tries = len(calendar_urls) + len(calendar_names)
+        calendars = _parallel_map(_calendar_by_url, calendar_urls, parallelism)
+        calendars.extend(_parallel_map(_calendar_by_name, calendar_names, parallelism))
+        calendars = [x for x in calendars if x]
         if not calendars and tries == 0:
             calendars = _try(principal.calendars, {}, "conn_params['url'] - all calendars")
+        if discovery_cache and calendars:
+            discovery_cache.put(cache_key, _parallel_map(_calendar_info, calendars, parallelism))
 
     if extra_params:
         for cal in calendars:
@@ -161,13 +292,20 @@ def _icalendar_component(obj):
 def _add_category(obj, category):
     comp = _icalendar_component(obj)
     if 'categories' in comp:
-        cats = comp.pop('categories').cats
+        cats = list(comp['categories'].cats)
     else:
         cats = []
     if hasattr(category, 'split'):
         category = category.split(',')
-    cats.extend(category)
-    comp.add('categories', cats)
+    new_cats = []
+    for cat in category:
+        if cat not in cats and cat not in new_cats:
+            new_cats.append(cat)
+    ## The object is left untouched if it already has the categories
+    if not new_cats:
+        return
+    comp.pop('categories', None)
+    comp.add('categories', cats + new_cats)
 
 def add_time_tracking_timew(obj, start=None, end=None):
     comp = _icalendar_component(obj)
@@ -218,88 +356,121 @@ def _summary(obj):
     i = _icalendar_component(obj)
     return i.get('summary') or i.get('description') or i.get('uid')
 
-childlike = {'CHILD', 'NEXT', 'FINISHTOSTART'}
-parentlike = {'PARENT', 'FIRST', 'DEPENDS-ON', 'STARTTOFINISH'}
-
-def _procrastinate(objs, delay, check_dependent="error", with_children=False, with_family=False, with_parent=False, err_callback=print, confirm_callback=lambda x: False, recursivity=0):
-    if delay in ('0', '0s', '0m', '0h', '0d', datetime.timedelta(0)):
-        ## Do nothing!
-        return
-    assert recursivity<16 ## TODO: better error message.  Probably we have some kind of relationship loop here.
+def _is_postponable(obj):
+    return hasattr(obj, 'set_due') and obj.icalendar_component.get('STATUS', 'NEEDS-ACTION') != 'COMPLETED'
+
+def _new_due(obj, delay):
+    if isinstance(delay, datetime.date):
+        return delay
+    old_due = _ensure_ts(obj.get_due())
+    new_due = _now()
+    if old_due:
+        new_due = max(new_due, old_due)
+    new_due = parse_add_dur(new_due, delay, ts_allowed=True, for_storage=True)
+    ## Let's force the due to be a timestamp
+    if not isinstance(new_due, datetime.datetime):
+        new_due = datetime.datetime(new_due.year, new_due.month, new_due.day)
+    return new_due
+
+def _plan_procrastination(objs, delay, check_dependent="error", with_children=False, with_family=False, with_parent=False, err_callback=print, confirm_callback=lambda x: False):
+    """
+    Finds out what should be postponed and to when, without changing
+    anything.  Returns a list of (obj, old due, new due).
+    """
+    family = RelationGraph(objs)
+    starts = []
     for x in objs:
-        if not hasattr(x, 'set_due'):
-            continue
-        if x.icalendar_component.get('STATUS', 'NEEDS-ACTION') == 'COMPLETED':
+        if not _is_postponable(x):
             continue
         if x.icalendar_component.get('RELATED-TO'):
             if with_family == 'interactive':
                 with_family = confirm_callback("There are relations - postpone the whole family tree?")
-            if not with_family and with_parent == 'interactive' and x.get_relatives(parentlike, fetch_objects=False):
+            if not with_family and with_parent == 'interactive' and related_uids(x, parentlike):
                 with_parent = confirm_callback("There exists (a) parent(s) - postpone the parent?")
-            if not with_family and with_children == 'interactive' and x.get_relatives(childlike, fetch_objects=False):
+            if not with_family and with_children == 'interactive' and related_uids(x, childlike):
                 with_children = confirm_callback("There exists children - postpone the children?")
         if with_family:
-            ## TODO: refactor.  Make relations into a class.
-            parents_ = x.get_relatives(reltypes=parentlike)
-            parents = set()
-            for rel_type in parents_:
-                parents.update(parents_[rel_type])
-            if parents:
-                _procrastinate(parents, delay, check_dependent, with_children, with_family, with_parent, err_callback, confirm_callback, recursivity=recursivity+1)
-                continue
-            else:
-                _procrastinate([x], delay, check_dependent, with_children=True, with_family=False, with_parent=False, err_callback=err_callback, confirm_callback=confirm_callback, recursivity=recursivity+1)
-                continue
+            roots = family.roots(x)
+            if not roots:
+                err_callback(f"Relationship loop found above {_summary(x)}, postponing it with children")
+                roots = [x]
+            starts.extend((root, True) for root in roots)
+            continue
         if with_parent:
-            parents = x.get_relatives(reltypes=parentlike)
-            for rel_type in parents: ## Should only be PARENT as for now.
-                _procrastinate(parents[rel_type], delay, check_dependent, with_children=True, with_family=False, with_parent=False, err_callback=err_callback, confirm_callback=confirm_callback, recursivity=recursivity+1)
-
-        chk_parent = 'return' if check_dependent else False
-        if isinstance(delay, datetime.date):
-            new_due = delay
-        else:
-            old_due = _ensure_ts(x.get_due())
-            new_due = _now()
-            if old_due:
-                new_due = max(new_due, old_due)
-            new_due = parse_add_dur(new_due, delay, ts_allowed=True, for_storage=True)
-            ## Let's force the due to be a timestamp
-            if not isinstance(new_due, datetime.datetime):
-                new_due = datetime.datetime(new_due.year, new_due.month, new_due.day)
-        parent = x.set_due(new_due, move_dtstart=True, check_dependent=chk_parent)
-        if parent:
-            if check_dependent in ("error", "interactive"):
-                i = x.icalendar_component
-                summary = _summary(i)
-                p = parent.icalendar_component
-                if p.get('STATUS') == 'COMPLETED':
-                    _procrastinate([x], new_due, check_dependent=False, err_callback=err_callback, confirm_callback=confirm_callback, recursivity=recursivity+1)
-                else:
-                    p_postponable = check_dependent == "interactive" and p.get('priority', 9)>2
-                    p_auto_postponable = p_postponable and i.get('priority',0) <= p.get('priority', 0)
-                    if p_auto_postponable:
-                        err_callback(f"{summary} will be postponed together with parent {_summary(p)} with due {_ensure_ts(p['DUE'])} and priority {p.get('priority', 0)}")
-                    else:
-                        err_callback(f"{summary} could not be postponed due to parent {_summary(p)} with due {_ensure_ts(p['DUE'])} and priority {p.get('priority', 0)}")
-                    if p_postponable and (p_auto_postponable or confirm_callback("procrastinate parent?")):
-                        import inspect
-                        stack_depth = len(inspect.stack())
-                        if stack_depth > 13:
-                            breakpoint()
-                        _procrastinate([parent], new_due+max(parent.get_duration()+x.get_duration()+datetime.timedelta(minutes=1), datetime.timedelta(minutes=1)), check_dependent=check_dependent, err_callback=err_callback, confirm_callback=confirm_callback, recursivity=recursivity+1)
-                        _procrastinate([x], new_due, check_dependent=check_dependent, err_callback=err_callback, confirm_callback=confirm_callback, recursivity=recursivity+1)
-            elif check_dependent == "return":
+            starts.extend((parent, True) for parent in family.relatives([x], parentlike)[0])
+        starts.append((x, with_children))
+    ordered = [x for x in family.expand(starts) if _is_postponable(x)]
+    if check_dependent:
+        ## fetching all the parents at once
+        family.relatives(ordered, {'PARENT'})
+
+    plan = {}
+    def due(obj):
+        if _uid(obj) in plan:
+            return plan[_uid(obj)][2]
+        return obj.get_dtend()
+
+    def conflicting_parent(x, new_due):
+        for parent in family.relatives([x], {'PARENT'})[0]:
+            pend = due(parent)
+            if pend and _ensure_ts(pend) < _ensure_ts(new_due):
                 return parent
-        else:
-            x.save()
-        if with_children:
-            ## TODO: refactor.  Make relations into a class.
-            children_ = x.get_relatives(reltypes=childlike)
-            children = set()
-            for rel_type in children_:
-                children.update(children_[rel_type])
-            _procrastinate(children, delay, check_dependent, with_children=True, with_family=False, with_parent=False, err_callback=err_callback, confirm_callback=confirm_callback, recursivity=recursivity+1)
+        return None
+
+    def postpone(x, new_due, visiting):
+        parent = None
+        if check_dependent in ("error", "interactive"):
+            parent = conflicting_parent(x, new_due)
+        if parent is not None and parent.icalendar_component.get('STATUS') != 'COMPLETED':
+            i = x.icalendar_component
+            summary = _summary(i)
+            p = parent.icalendar_component
+            p_postponable = check_dependent == "interactive" and p.get('priority', 9)>2
+            p_auto_postponable = p_postponable and i.get('priority',0) <= p.get('priority', 0)
+            if p_auto_postponable:
+                err_callback(f"{summary} will be postponed together with parent {_summary(p)} with due {_ensure_ts(due(parent))} and priority {p.get('priority', 0)}")
+            else:
+                err_callback(f"{summary} could not be postponed due to parent {_summary(p)} with due {_ensure_ts(due(parent))} and priority {p.get('priority', 0)}")
+            if not (p_postponable and (p_auto_postponable or confirm_callback("procrastinate parent?"))):
+                return
+            if _uid(parent) in visiting:
+                err_callback(f"Relationship loop found when postponing {summary}")
+                return
+            postpone(parent, new_due+max(parent.get_duration()+x.get_duration()+datetime.timedelta(minutes=1), datetime.timedelta(minutes=1)), visiting | {_uid(x)})
+            if conflicting_parent(x, new_due) is not None:
+                return
+        old_due = plan[_uid(x)][1] if _uid(x) in plan else x.get_due()
+        plan[_uid(x)] = (x, old_due, new_due)
+
+    for x in ordered:
+        if _uid(x) not in plan:
+            postpone(x, _new_due(x, delay), set())
+    return list(plan.values())
+
+def _procrastinate(objs, delay, check_dependent="error", with_children=False, with_family=False, with_parent=False, err_callback=print, confirm_callback=lambda x: False, dry_run=False, save=True, parallelism=DEFAULT_PARALLELISM):
+    """
+    Postpones the tasks, and depending on the parameters also their
+    relatives.  delay is either a duration (added to the due, or to
+    the current time if the task is overdue) or a timestamp.
+
+    The relatives are fetched in bulk, level by level, all the new
+    timestamps are calculated before anything is changed, and the
+    changed tasks are saved concurrently (unless save is False).
+
+    Returns the plan, a list of (obj, old due, new due).  With dry_run,
+    nothing is changed.
+    """
+    if delay in ('0', '0s', '0m', '0h', '0d', datetime.timedelta(0)):
+        ## Do nothing!
+        return []
+    plan = _plan_procrastination(objs, delay, check_dependent, with_children, with_family, with_parent, err_callback, confirm_callback)
+    if dry_run:
+        return plan
+    for (obj, old_due, new_due) in plan:
+        obj.set_due(new_due, move_dtstart=True)
+    if save:
+        _save_all([x[0] for x in plan], parallelism)
+    return plan
 
 def _adjust_ical_relations(obj, relations_wanted={}):
     """
@@ -350,7 +521,7 @@ def _remove_reverse_relations(obj, removed_rels):
             for backreltype in backreltypes:
                 rels[backreltype] = rels[backreltype] - {str(obj.icalendar_component['UID'])}
             _adjust_ical_relations(rev_obj, rels)
-            rev_obj.save()
+            _save(rev_obj)
 
 ## TODO: consolidate with similar code in the caldav library
 def _adjust_relations(parent, children):
@@ -366,44 +537,47 @@ def _adjust_relations(parent, children):
             if len(old_parents['PARENT']) == 1:
                 _remove_reverse_relations(child, old_parents)
                 _adjust_ical_relations(child, {'PARENT': set()})
-                child.save()
+                _save(child)
         return
     pmutated = _adjust_ical_relations(parent, {'CHILD': {str(x.icalendar_component['UID']) for x in children}})
     for child in children:
         cmutated = _adjust_ical_relations(child, {'PARENT': {str(parent.icalendar_component['UID'])}})
         if cmutated:
             _remove_reverse_relations(child, cmutated['removed'])
-            child.save()
+            _save(child)
     if pmutated:
-        parent.save()
+        _save(parent)
         _remove_reverse_relations(parent, pmutated['removed'])
 
-## TODO: As for now, this one will throw the user into the python debugger if inconsistencies are found.
-## It for sure cannot be like that when releasing plann 1.0!
-def _relships_by_type(obj, reltype_wanted=None):
+def _relships_by_type(obj, reltype_wanted=None, graph=None):
+    """
+    Returns a dict reltype -> list of related objects.  The relations
+    are looked up in the graph (a RelationGraph) if given, related
+    objects not found there are fetched from the server.
+    """
     backreltypes = {'CHILD': 'PARENT', 'PARENT': 'CHILD', 'undefined': 'CHILD', 'SIBLING': 'SIBLING'}
-    rels_by_type = obj.get_relatives(reltype_wanted)
+    if graph is None:
+        graph = RelationGraph([obj])
+    rels_by_type = graph.relatives_by_type(obj, reltype_wanted)
+    uid = _uid(obj)
     ret = defaultdict(list)
     for reltype in rels_by_type:
         for other in rels_by_type[reltype]:
             ret[reltype].append(other)
 
             ## Consistency check ... TODO ... look more into breakages
-            ## TODO: make functionality for scanning through all relationships in the calendar
-            other_rels = other.get_relatives(fetch_objects=False)
+            other_rels = graph.related(other)
             back_rel_types = set()
             for back_rel_type in other_rels:
-                if str(obj.icalendar_component['UID']) in other_rels[back_rel_type]:
+                if uid in other_rels[back_rel_type]:
                     back_rel_types.add(back_rel_type)
 
             if len(back_rel_types) > 1:
-                logging.error(f"Inconsistency issue in relationships - has to be manually resolved (UID={obj.icalendar_component_UID}, backrels: {back_rel_types})")
+                logging.error(f"Inconsistency issue in relationships - has to be manually resolved (UID={uid}, backrels: {back_rel_types})")
                 ## Inconsistency has to be manually fixed: more than one related-to property pointing from other to obj
             if len(back_rel_types) == 0:
-                logging.error("Inconsistency issue in relationships - will be automatically fixed: no related-to property pointing from other to obj")
-                ## adding the missing back rel
-                other.icalendar_component.add('RELATED-TO', str(obj.icalendar_component['UID']), parameters={'RELTYPE': backreltypes[reltype]})
-                other.save()
+                ## Not fixed here, as saving objects while listing makes the listing slow and unpredictable
+                logging.error(f"Inconsistency issue in relationships - no related-to property pointing from {_uid(other)} back to {uid}.  Run `plann select --all check-relations --fix` to fix it")
             else:
                 if back_rel_types != { backreltypes[reltype] }:
                     logging.error("Inconsistency issue in relationships - has to be manually resolved. Object and other points to each other, but reltype does not match")
@@ -473,78 +647,99 @@ def _set_something(obj, arg, value):
 ## Use the yield method to avoid having to generate the full list prior to printing to screen
 def _list(objs, ics=False, template="{DTSTART:?{DUE:?(date missing)?}?%F %H:%M:%S %Z}: {SUMMARY:?{DESCRIPTION:?(no summary given)?}?}", top_down=False, bottom_up=False, indent=0, echo=True, uids=None, filter=lambda obj: obj.icalendar_component.get('STATUS', '') not in ('CANCELLED', 'COMPLETED')):
     """
-    Actual implementation of list
-
-    TODO: will crash if there are loops in the relationships
-    TODO: if there are parent/child-relationships that aren't bidrectionally linked, we may get problems
+    Actual implementation of list.  With echo, the lines are written
+    through the pager, otherwise a list of lines is returned.
     """
-    if indent>32:
-        raise NotImplementedError("too deep hierarchies, or circular links")
     if ics:
+        objs = list(objs)
         if not objs:
             return
-        icalendar = objs.pop(0).icalendar_instance
-        for obj in objs:
-            if not filter(obj):
-                continue
-            icalendar.subcomponents.extend(obj.icalendar_instance.subcomponents)
-        click.echo(icalendar.to_ical())
+        for chunk in vcalendar_chunks(objs, filter=filter):
+            click.echo(chunk, nl=False)
+        return
+    lines = _list_lines(objs, template, top_down=top_down, bottom_up=bottom_up, indent=indent, uids=uids, filter=filter)
+    if echo:
+        ## The lines are passed on to the pager as they are produced
+        click.echo_via_pager(f"{line}\n" for line in lines)
         return
+    return list(lines)
+
+def _format_obj(obj, template):
+    more_info = {}
+    if 'calendar_name' in template.template:
+        more_info['calendar_name'] = obj.parent.name or obj.parent.get_display_name()
+    more_info['calendar_url'] = obj.parent.url
+    return template.format(**obj.icalendar_component, **more_info)
+
+def _list_lines(objs, template, top_down=False, bottom_up=False, indent=0, uids=None, filter=lambda obj: True):
+    """
+    Generator yielding the lines for _list.  uids is a set of UIDs
+    not to be listed, the UIDs listed are added to it.
+    """
     if isinstance(template, str):
         template=Template(template)
-    output = []
     if uids is None:
         uids = set()
+    if top_down or bottom_up:
+        yield from _hierarchy_lines(objs, template, top_down, indent, uids, filter)
+        return
 
     for obj in objs:
         if isinstance(obj, str):
-            output.append(obj)
+            yield obj
             continue
 
         if not filter(obj):
             continue
 
-        uid = obj.icalendar_component['UID']
+        uid = _uid(obj)
         if uid in uids and 'RECURRENCE-ID' not in obj.icalendar_component:
             continue
-        else:
+        uids.add(uid)
+        yield " "*indent + _format_obj(obj, template)
+
+def _hierarchy_lines(objs, template, top_down, indent, uids, filter):
+    """
+    Yields the lines for a hierarchical listing.  In a top-down view
+    the (grand)*parents are listed as top-level items with the
+    children indented below them, in a bottom-up view it's the other
+    way around.  Relatives not in objs are included.
+
+    The relatives are found through a RelationGraph, fetched in bulk
+    level by level.  The listing is done iteratively (see
+    relations.hierarchy), so there is no limit on the depth, and every
+    object is listed once.  Relationship loops are logged.
+    """
+    (up, down) = ('PARENT', 'CHILD') if top_down else ('CHILD', 'PARENT')
+    objs = list(objs)
+    graph = RelationGraph(x for x in objs if not isinstance(x, str))
+    def include(obj):
+        return filter(obj) and graph.uid(obj) not in uids
+
+    ## uid -> the selected objects with this UID (several if it's recurrences)
+    selected = defaultdict(list)
+    for obj in objs:
+        if isinstance(obj, str) or not include(obj):
+            continue
+        instances = selected[graph.uid(obj)]
+        if not instances or 'RECURRENCE-ID' in obj.icalendar_component:
+            instances.append(obj)
+    family = connected(graph, [x[0] for x in selected.values()], {up, down, 'SIBLING'} if top_down else {up, down}, include)
+    for loop in _loops(graph):
+        if any(x in family for x in loop):
+            logging.warning(f"Relationship loop found: {', '.join(str(_summary(graph.get(x))) for x in loop if x in graph)}")
+
+    done = set()
+    def lines(uids_):
+        for (uid, depth) in hierarchy(graph, uids_, family.keys(), up, down, siblings=top_down, done=done):
             uids.add(uid)
+            for obj in selected.get(uid) or [family[uid]]:
+                yield " "*(indent+2*depth) + _format_obj(obj, template)
 
-        above = []
-        below = []
-        if top_down or bottom_up:
-            relations = _relships_by_type(obj)
-            parents = relations['PARENT']
-            children = relations['CHILD']
-            ## in a top-down view, the (grand)*parent should be shown as a top-level item rather than the object.
-            ## in a bottom-up view, the (grand)*child should be shown as a top-level item rather than the object.
-            if top_down:
-                above = parents
-                below = children
-            if bottom_up:
-                above = children
-                below = parents
-            if indent:
-                above = []
-        if not above:
-            ## This should be a top-level thing
-            more_info = {}
-            if 'calendar_name' in template.template:
-                more_info['calendar_name'] = obj.parent.name or obj.parent.get_display_name()
-            more_info['calendar_url'] = obj.parent.url
-            output.append(" "*indent + template.format(**obj.icalendar_component, **more_info))
-            ## Recursively add children in an indented way
-            output.extend(_list(below, template=template, top_down=top_down, bottom_up=bottom_up, indent=indent+2, echo=False, filter=filter))
-            if indent and top_down:
-                ## Include all siblings as same-level nodes
-                ## Use the top-level uids to avoid infinite recursion
-                ## TODO: siblings are probably not being handled correctly here.  Should write test code and investigate.
-                output.extend(_list(relations['SIBLING'], template=template, top_down=top_down, bottom_up=bottom_up, indent=indent, echo=False, uids=uids, filter=filter))
-        for p in above:
-            ## The item should be part of a sublist.  Find and add the top-level item, and the full indented list under there - recursively.
-            puid = p.icalendar_component['UID']
-            if puid not in uids:
-                output.extend(_list([p], template=template, top_down=top_down, bottom_up=bottom_up, indent=indent, echo=False, uids=uids, filter=filter))
-    if echo:
-        click.echo_via_pager("\n".join(output))
-    return output
+    for obj in objs:
+        if isinstance(obj, str):
+            yield obj
+        elif graph.uid(obj) in family:
+            yield from lines([graph.uid(obj)])
+    ## Relatives not below anything listed, i.e. the second parent of an object
+    yield from lines(family)
@@ -1,24 +1,166 @@
-from datetime import datetime, timedelta
+import heapq
+import random
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, time, timedelta
 
-from sortedcontainers import SortedKeyList
+import icalendar
+import recurring_ical_events
+from dateutil.rrule import rruleset, rrulestr
+from sortedcontainers import SortedKeyList, SortedList
 
 from plann.lib import _ensure_ts, _now
+from plann.query import _is_recurring, _prop_values
 
 
+class _Gap:
+    """
+    A free gap on the timeline, as a node in the _GapIndex treap
+    """
+    __slots__ = ('begin', 'end', 'duration', 'priority', 'left', 'right', 'max_duration', 'total')
+
+    def __init__(self, begin, end):
+        self.begin = begin
+        self.end = end
+        self.duration = end - begin
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_duration = self.duration
+        self.total = self.duration
+
+def _update(node):
+    node.max_duration = node.duration
+    node.total = node.duration
+    for child in (node.left, node.right):
+        if child is not None:
+            node.max_duration = max(node.max_duration, child.max_duration)
+            node.total += child.total
+    return node
+
+def _split(node, key):
+    """
+    Splits the treap in the gaps beginning before key, and the rest
+    """
+    if node is None:
+        return (None, None)
+    if node.begin < key:
+        (node.right, right) = _split(node.right, key)
+        return (_update(node), right)
+    (left, node.left) = _split(node.left, key)
+    return (left, _update(node))
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+def _latest(node, before, min_duration):
+    if node is None or node.max_duration <= min_duration:
+        return None
+    if node.begin >= before:
+        return _latest(node.left, before, min_duration)
+    found = _latest(node.right, before, min_duration)
+    if found is not None:
+        return found
+    if node.duration > min_duration:
+        return node
+    return _latest(node.left, before, min_duration)
+
+class _GapIndex:
+    """
+    The free gaps of a TimeLine in a treap (a randomized balanced
+    search tree) ordered by the beginning of the gap.  Every node
+    knows the longest gap and the total free time in its subtree, so
+    the latest gap longer than some duration before some timestamp,
+    and the total free time before some timestamp, are both found in
+    logarithmic time.
+
+    The timestamps may be datetimes or numbers, zero is the zero
+    duration and epsilon the resolution of the timestamps.
+    """
+    def __init__(self, zero=timedelta(0), epsilon=timedelta(microseconds=1)):
+        self._root = None
+        self._nodes = {}
+        self.zero = zero
+        self.epsilon = epsilon
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def insert(self, begin, end):
+        self.discard(begin)
+        node = _Gap(begin, end)
+        (left, right) = _split(self._root, begin)
+        self._root = _merge(_merge(left, node), right)
+        self._nodes[begin] = node
+
+    def discard(self, begin):
+        if self._nodes.pop(begin, None) is None:
+            return
+        (left, rest) = _split(self._root, begin)
+        (node, right) = _split(rest, begin + self.epsilon)
+        self._root = _merge(left, right)
+
+    def latest(self, before, min_duration=None):
+        """
+        The latest gap longer than min_duration (default zero)
+        beginning before the given timestamp, or None
+        """
+        return _latest(self._root, before, self.zero if min_duration is None else min_duration)
+
+    def total(self, before):
+        """
+        The total duration of the gaps beginning before the given
+        timestamp
+        """
+        ret = self.zero
+        node = self._root
+        while node is not None:
+            if node.begin < before:
+                ret += node.duration
+                if node.left is not None:
+                    ret += node.left.total
+                node = node.right
+            else:
+                node = node.left
+        return ret
+
+def _is_free(slot):
+    return all(key == 'begin' for key in slot)
+
 class TimeLine(SortedKeyList):
     """
     The TimeLine is a sorted list of dicts, the dict should as the very minimum contain the datetime key begin.
 
     The TimeLine should be without holes.  Unallocated time should be presented as a dict with only the key begin (which should correspond to the end of the previous item on the timeline)
 
-    The TimeLine should not contain overlapping events.
+    The TimeLine should not contain overlapping events.  Events are
+    merged through busy_intervals before being added, overlaps found
+    are kept in the overlaps attribute.
+
+    The free slots (except the one after the last item) are also kept
+    in a _GapIndex, so that find_opening and pad_slack don't need to
+    walk through the timeline.
     """
     def __init__(self):
         SortedKeyList.__init__(self, key=lambda x: x['begin'])
+        self._gaps = _GapIndex()
+        self.overlaps = []
 
     def count(self):
-        """Includes all real objects on the list.  Ignores start and end markers, as well as slack"""
-        return len([x for x in self if 'obj' in x and x['obj'] != 'slack'])
+        """Includes all real objects on the list, objects split over several slots are counted once.  Ignores start and end markers, as well as slack"""
+        return len({id(x['obj']) for x in self if 'obj' in x and x['obj'] != 'slack'})
+
+    def slack(self):
+        """The total duration of the slack on the timeline"""
+        return sum((y['begin']-x['begin'] for (x, y) in zip(self, self[1:]) if x.get('obj') == 'slack'), timedelta(0))
 
     def add_event(self, event):
         start = event.icalendar_component.get('dtstart')
@@ -33,6 +175,10 @@ class TimeLine(SortedKeyList):
         self.add(start, end, event)
 
     def add(self, begin, end, obj=None):
+        """
+        Puts obj on the timeline.  Returns False if nothing was added
+        (overlapping or zero-length slot)
+        """
         assert(begin.tzinfo)
         assert(end.tzinfo)
         obj_ = {'begin': begin, 'obj': obj}
@@ -40,22 +186,55 @@ class TimeLine(SortedKeyList):
             ## TODO: error message (but how?  print?  click.echo?  logging?  callback?)
             ## this doesn't work?
             #end = begin + timedelta(minutes=1)
-            return
+            return False
         i = self.bisect_right(obj_)
         if i<len(self):
             if self[i]['begin'] < end:
                 ## Possibly overlapping events.
                 ## TODO: error message - but how?  raise an error and catch it further up?
-                return
+                return False
         if i>0:
-            assert not any(key != 'begin' for key in self[i-1])
-        if i>0 and i<len(self):
-            if self[i-1]['begin'] == begin and self[i]['begin'] == end:
-                self[i-1]['obj'] = obj
-                return
-        SortedKeyList.add(self, obj_)
+            assert _is_free(self[i-1])
+        if i>0 and self[i-1]['begin'] == begin:
+            ## The object starts at the beginning of a free slot - it takes its place
+            self[i-1]['obj'] = obj
+            i -= 1
+        else:
+            SortedKeyList.add(self, obj_)
         if i+1==len(self) or self[i+1]['begin'] > end:
             SortedKeyList.add(self, {'begin': end})
+        for j in (i-1, i, i+1):
+            self._index_gap(j)
+        return True
+
+    def remove(self, begin):
+        """
+        Frees the slot beginning at begin (as added through add).  The
+        free time around it is merged into one free slot, free time
+        before the first and after the last object is dropped.
+        """
+        i = self.bisect_left({'begin': begin})
+        assert i < len(self) and self[i]['begin'] == begin and not _is_free(self[i])
+        self[i].pop('obj')
+        if i+1 < len(self) and _is_free(self[i+1]):
+            self._gaps.discard(self[i+1]['begin'])
+            del self[i+1]
+        if i == 0 or _is_free(self[i-1]):
+            self._gaps.discard(self[i]['begin'])
+            del self[i]
+        if len(self) == 1:
+            ## Only the end marker is left
+            self._gaps.discard(self[0]['begin'])
+            del self[0]
+        for j in (i-1, i):
+            self._index_gap(j)
+
+    def _index_gap(self, i):
+        if i < 0 or i >= len(self):
+            return
+        self._gaps.discard(self[i]['begin'])
+        if i+1 < len(self) and _is_free(self[i]):
+            self._gaps.insert(self[i]['begin'], self[i+1]['begin'])
 
     def get(self, ts):
         if not (len(self)):
@@ -70,82 +249,745 @@ class TimeLine(SortedKeyList):
         return foo
 
     def find_opening(self, last_possibility, duration, slack_balance=timedelta(0)):
+        """
+        Finds the latest free slot longer than duration, starting from
+        the slot at last_possibility-duration and searching backwards.
+        Returns the slot (like from get) and the slack_balance with the
+        smaller free slots passed on the way added.  If no free slot is
+        found, the (open) slot before the timeline is returned.
+        """
         end = last_possibility-duration
+        if not len(self) or end > self[-1]['begin']:
+            return (self.get(end), slack_balance)
+        gap = self._gaps.latest(end, duration)
+        slack_balance += self._gaps.total(end)
+        if gap is None:
+            return ({'end': self[0]['begin']}, slack_balance)
+        slack_balance -= self._gaps.total(gap.begin) + gap.duration
+        return ({'begin': gap.begin, 'end': gap.end}, slack_balance)
+
+    def pad_slack(self, end, duration):
+        """
+        Fills the free time before end with slack, up to duration.  If
+        there isn't enough free time, the rest of the slack is put
+        before the timeline.
+        """
+        self.fill(end, duration, 'slack')
+
+    def fill(self, end, duration, obj):
+        """
+        Fills the free time before end with obj, up to duration - the
+        latest free time first.  If there isn't enough free time, the
+        rest is put before the timeline.  Returns the list of (begin,
+        end) filled, latest first.
+        """
+        ret = []
+        if len(self):
+            end = min(end, self[-1]['begin'])
+        while duration > timedelta(0):
+            gap = self._gaps.latest(end)
+            if gap is None:
+                break
+            slot_end = min(gap.end, end)
+            slot_dur = min(duration, slot_end - gap.begin)
+            self.add(slot_end-slot_dur, slot_end, obj)
+            ret.append((slot_end-slot_dur, slot_end))
+            duration -= slot_dur
+            end = slot_end-slot_dur
+        if duration > timedelta(0):
+            if len(self):
+                end = min(end, self[0]['begin'])
+            self.add(begin=end-duration, end=end, obj=obj)
+            ret.append((end-duration, end))
+        return ret
+
+    def occupy(self, begin, end, obj):
+        """
+        Puts obj in the free time between begin and end, where it's
+        free.  Time before and after the timeline is left alone.
+        Returns the list of (begin, end) filled, latest first.
+        """
+        ret = []
         while True:
-            foo = self.get(end)
-            if len(foo) == 2:
-                if 'end' in foo and 'begin' in foo:
-                    foodur = foo['end']-foo['begin']
-                    if foodur > duration:
-                        return (foo, slack_balance)
-                    slack_balance += foodur
-            if 'begin' not in foo or 'end' not in foo:
-                return (foo, slack_balance)
-            end = foo['begin']-timedelta(seconds=1)
+            gap = self._gaps.latest(end)
+            if gap is None or gap.end <= begin:
+                return ret
+            self.add(max(gap.begin, begin), min(gap.end, end), obj)
+            ret.append((max(gap.begin, begin), min(gap.end, end)))
+            end = max(gap.begin, begin)
+
+## Object index of free slots in the ArrayTimeLine, and of the slack
+_FREE = -1
+_SLACK = 0
+
+class ArrayTimeLine:
+    """
+    Same as the TimeLine, but stored compactly in parallel arrays: the
+    beginning of every slot as epoch seconds, and the index of the
+    object in the slot (in a list of objects) or _FREE.  Timestamps are
+    stored with a resolution of one second.
+
+    The slots are given out as dicts like in the TimeLine, with the
+    timestamps in the timezone of the first timestamp added.
+    """
+    def __init__(self):
+        self._begins = array('q')
+        self._objs = array('q')
+        self._objects = ['slack']
+        ## id of the objects -> index in _objects
+        self._indexes = {}
+        self._gaps = _GapIndex(zero=0, epsilon=1)
+        self._slack = 0
+        self._tz = None
+        self.overlaps = []
+
+    def __len__(self):
+        return len(self._begins)
+
+    def _slot(self, i):
+        ret = {'begin': datetime.fromtimestamp(self._begins[i], self._tz)}
+        if self._objs[i] != _FREE:
+            ret['obj'] = self._objects[self._objs[i]]
+        return ret
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._slot(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._slot(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._slot(i)
+
+    def _ts(self, dt):
+        if self._tz is None:
+            self._tz = dt.tzinfo
+        return int(dt.timestamp())
+
+    def count(self):
+        """Includes all real objects on the list, objects split over several slots are counted once.  Ignores start and end markers, as well as slack"""
+        return len(set(self._objs) - {_FREE, _SLACK})
+
+    def slack(self):
+        """The total duration of the slack on the timeline"""
+        return timedelta(seconds=self._slack)
+
+    add_event = TimeLine.add_event
+
+    def add(self, begin, end, obj=None):
+        assert(begin.tzinfo)
+        assert(end.tzinfo)
+        return self._add(self._ts(begin), self._ts(end), self._index(obj))
+
+    def _index(self, obj):
+        if obj == 'slack':
+            return _SLACK
+        if id(obj) not in self._indexes:
+            self._indexes[id(obj)] = len(self._objects)
+            self._objects.append(obj)
+        return self._indexes[id(obj)]
+
+    def _add(self, begin, end, index):
+        if end <= begin:
+            return False
+        i = bisect_right(self._begins, begin)
+        if i<len(self) and self._begins[i] < end:
+            ## Possibly overlapping events.
+            return False
+        if i>0:
+            assert self._objs[i-1] == _FREE
+        if i>0 and self._begins[i-1] == begin:
+            self._objs[i-1] = index
+            i -= 1
+        else:
+            self._begins.insert(i, begin)
+            self._objs.insert(i, index)
+        if i+1==len(self) or self._begins[i+1] > end:
+            self._begins.insert(i+1, end)
+            self._objs.insert(i+1, _FREE)
+        if index == _SLACK:
+            self._slack += end-begin
+        for j in (i-1, i, i+1):
+            self._index_gap(j)
+        return True
+
+    def remove(self, begin):
+        """
+        See TimeLine.remove
+        """
+        i = bisect_left(self._begins, self._ts(begin))
+        assert i < len(self) and self._begins[i] == self._ts(begin) and self._objs[i] != _FREE
+        if self._objs[i] == _SLACK:
+            self._slack -= self._begins[i+1] - self._begins[i]
+        self._objs[i] = _FREE
+        if i+1 < len(self) and self._objs[i+1] == _FREE:
+            self._gaps.discard(self._begins[i+1])
+            del self._begins[i+1]
+            del self._objs[i+1]
+        if i == 0 or self._objs[i-1] == _FREE:
+            self._gaps.discard(self._begins[i])
+            del self._begins[i]
+            del self._objs[i]
+        if len(self) == 1:
+            ## Only the end marker is left
+            self._gaps.discard(self._begins[0])
+            del self._begins[0]
+            del self._objs[0]
+        for j in (i-1, i):
+            self._index_gap(j)
+
+    def _index_gap(self, i):
+        if i < 0 or i >= len(self):
+            return
+        self._gaps.discard(self._begins[i])
+        if i+1 < len(self) and self._objs[i] == _FREE:
+            self._gaps.insert(self._begins[i], self._begins[i+1])
+
+    def get(self, ts):
+        if not (len(self)):
+            return {'begin': ts}
+        i = bisect_left(self._begins, self._ts(ts))
+        if i>0:
+            foo = self._slot(i-1)
+        else:
+            foo = {}
+        if i<len(self):
+            foo['end'] = datetime.fromtimestamp(self._begins[i], self._tz)
+        return foo
+
+    def find_opening(self, last_possibility, duration, slack_balance=timedelta(0)):
+        """
+        See TimeLine.find_opening
+        """
+        end = self._ts(last_possibility-duration)
+        if not len(self) or end > self._begins[-1]:
+            return (self.get(last_possibility-duration), slack_balance)
+        gap = self._gaps.latest(end, duration.total_seconds())
+        skipped = self._gaps.total(end)
+        if gap is None:
+            return ({'end': datetime.fromtimestamp(self._begins[0], self._tz)}, slack_balance + timedelta(seconds=skipped))
+        skipped -= self._gaps.total(gap.begin) + gap.duration
+        return ({'begin': datetime.fromtimestamp(gap.begin, self._tz), 'end': datetime.fromtimestamp(gap.end, self._tz)}, slack_balance + timedelta(seconds=skipped))
 
     def pad_slack(self, end, duration):
-        i = self.bisect_left({'begin': end})-1
-        while i>=0 and duration>timedelta(0):
-            if any(key != 'begin' for key in self[i]):
-                end = self[i]['begin']
-                i -= 1
-                continue
-            slot_dur = end - self[i]['begin']
-            if slot_dur <= duration:
-                duration -= slot_dur
-                self[i]['obj'] = 'slack'
-            else:
-                self.add(end-duration, end, 'slack')
-                duration = timedelta(0)
-        if duration:
-            self.add(begin=end-duration, end=end, obj='slack')
-
-def timeline_suggestion(ctx, hours_per_day=4, timeline_end=None):
-    timeline = TimeLine()
-    objs = ctx.obj['objs']
-    events = [x for x in objs if 'BEGIN:VEVENT' in x.data]
-    event_parents = []
+        """
+        See TimeLine.pad_slack
+        """
+        self.fill(end, duration, 'slack')
+
+    def fill(self, end, duration, obj):
+        """
+        See TimeLine.fill
+        """
+        index = self._index(obj)
+        ret = []
+        end = self._ts(end)
+        duration = int(duration.total_seconds())
+        if len(self):
+            end = min(end, self._begins[-1])
+        while duration > 0:
+            gap = self._gaps.latest(end)
+            if gap is None:
+                break
+            slot_end = min(gap.end, end)
+            slot_dur = min(duration, slot_end - gap.begin)
+            self._add(slot_end-slot_dur, slot_end, index)
+            ret.append((slot_end-slot_dur, slot_end))
+            duration -= slot_dur
+            end = slot_end-slot_dur
+        if duration > 0:
+            if len(self):
+                end = min(end, self._begins[0])
+            self._add(end-duration, end, index)
+            ret.append((end-duration, end))
+        return [(datetime.fromtimestamp(x, self._tz), datetime.fromtimestamp(y, self._tz)) for (x, y) in ret]
+
+    def occupy(self, begin, end, obj):
+        """
+        See TimeLine.occupy
+        """
+        index = self._index(obj)
+        (begin, end) = (self._ts(begin), self._ts(end))
+        ret = []
+        while True:
+            gap = self._gaps.latest(end)
+            if gap is None or gap.end <= begin:
+                return [(datetime.fromtimestamp(x, self._tz), datetime.fromtimestamp(y, self._tz)) for (x, y) in ret]
+            self._add(max(gap.begin, begin), min(gap.end, end), index)
+            ret.append((max(gap.begin, begin), min(gap.end, end)))
+            end = max(gap.begin, begin)
+
+def _span(comp):
+    """
+    (begin, end) of a VEVENT component, or None if it doesn't take time
+    """
+    start = comp.get('DTSTART')
+    if start is None:
+        return None
+    ## Same as caldav's get_dtend, DUE is accepted in place of DTEND
+    end = comp.get('DTEND', comp.get('DUE'))
+    if end is not None:
+        end = end.dt
+    elif 'DURATION' in comp:
+        end = start.dt + comp['DURATION'].dt
+    elif not isinstance(start.dt, datetime):
+        end = start.dt + timedelta(days=1)
+    else:
+        return None
+    (begin, end) = (_ensure_ts(start), _ensure_ts(end))
+    if end <= begin:
+        return None
+    return (begin, end)
+
+def _expand_plain(event, comp, start, end):
+    """
+    The (begin, end) of the occurrences of a plain recurring event
+    between start and end, through dateutil - a lot faster than
+    recurring_ical_events, as no component is made per occurrence.
+
+    Returns None if the event isn't a plain one (overridden
+    occurrences, EXRULE, floating or all-day timestamps, etc).
+    """
+    span = _span(comp)
+    dtstart = comp['DTSTART'].dt
+    if (not span or 'EXRULE' in comp or not isinstance(comp.get('RRULE'), dict)
+        or not isinstance(dtstart, datetime) or not dtstart.tzinfo
+        or len(event.icalendar_instance.walk('VEVENT')) != 1):
+        return None
+    duration = span[1] - span[0]
+    rules = rruleset()
+    try:
+        rules.rrule(rrulestr(comp['RRULE'].to_ical().decode(), dtstart=dtstart))
+        for (prop, add) in (('RDATE', rules.rdate), ('EXDATE', rules.exdate)):
+            values = comp.get(prop, [])
+            for value in values if isinstance(values, list) else [values]:
+                for ts in value.dts:
+                    if not isinstance(ts.dt, datetime) or not ts.dt.tzinfo:
+                        return None
+                    add(ts.dt)
+        return [(x, x+duration) for x in rules.between(start-duration, end, inc=True) if x+duration > start]
+    except (ValueError, TypeError):
+        ## i.e. UNTIL given as a date
+        return None
+
+def _component(obj):
+    """
+    Same as obj.icalendar_component.  caldav serializes the full object
+    on every access to icalendar_component (to check if it needs to be
+    loaded), here the object is only parsed if needed.
+    """
+    return next(x for x in obj.icalendar_instance.subcomponents if not isinstance(x, icalendar.Timezone))
+
+def _occurrences(events, start, end):
+    """
+    Yields (begin, end, event) for all the events.  Recurring events
+    are expanded into the occurrences between start and end.
+    Cancelled events and occurrences are skipped.
+    """
     for event in events:
-        comp = event.icalendar_component
+        comp = _component(event)
         if comp.get('STATUS', '') == 'CANCELLED':
             continue
-        if 'RELATED-TO' in comp and event.get_dtend()>_now():
-            rels = event.get_relatives(fetch_objects=False)
-            for rel in rels['PARENT']:
-                event_parents.append(str(rel))
-    tasks = [x for x in objs if 'BEGIN:VTODO' in x.data]
-    assert len(events) + len(tasks) == len(objs)
-    tasks = [x for x in tasks if ('\nDUE' in x.data or '\nDURATION' in x.data) and '\nDTSTART' in x.data]
+        if not _is_recurring(comp):
+            spans = [_span(comp)]
+        else:
+            spans = _expand_plain(event, comp, start, end)
+            if spans is None:
+                occurrences = recurring_ical_events.of(event.icalendar_instance).between(start, end)
+                spans = [_span(x) for x in occurrences if x.get('STATUS', '') != 'CANCELLED']
+        for span in spans:
+            if span:
+                yield (*span, event)
 
-    for event in events:
-        if 'BEGIN:VEVENT' not in event.data:
+def busy_intervals(events, start, end):
+    """
+    Merges the time taken by the events into non-overlapping busy
+    intervals, through a sweep over the begin and end of all the
+    occurrences (recurring events are expanded between start and end).
+
+    Returns (intervals, overlaps).  intervals is a sorted list of
+    (begin, end, event) - where events are overlapping, the time is
+    given to the event that started first.  overlaps is a sorted list
+    of (begin, end, events) for every period where two or more events
+    overlap, events being a tuple in the order they started.
+    """
+    occurrences = sorted(_occurrences(events, start, end), key=lambda x: (x[0], x[1]))
+    ends = sorted(range(len(occurrences)), key=lambda i: occurrences[i][1])
+    times = sorted({x[0] for x in occurrences} | {x[1] for x in occurrences})
+    ## The active occurrences, by index.  The heap gives the one that
+    ## started first, ended ones are removed from it lazily.
+    active = {}
+    heap = []
+    intervals = []
+    overlaps = []
+    overlap_key = None
+    (i, j) = (0, 0)
+    for (t, next_t) in zip(times, times[1:]):
+        while j < len(ends) and occurrences[ends[j]][1] <= t:
+            active.pop(ends[j], None)
+            j += 1
+        while i < len(occurrences) and occurrences[i][0] <= t:
+            active[i] = occurrences[i][2]
+            heapq.heappush(heap, i)
+            i += 1
+        while heap and heap[0] not in active:
+            heapq.heappop(heap)
+        if not heap:
             continue
-        ## TODO ... we should handle overlapping events a bit better than just ignoring AssertionErrors
-        try:
-            timeline.add_event(event)
-        except AssertionError:
-            pass
-    tasks.sort(key=lambda x: (x.icalendar_component.get('PRIORITY',0), _now()-_ensure_ts(x.get_due())))
-    slackbalance = timedelta(0)
-    for task in tasks:
-        if str(task.icalendar_component['UID']) in event_parents:
-            ## task is presumably already included in timeline
+        owner = active[heap[0]]
+        if intervals and intervals[-1][1] == t and intervals[-1][2] is owner:
+            intervals[-1] = (intervals[-1][0], next_t, owner)
+        else:
+            intervals.append((t, next_t, owner))
+        if len(active) > 1:
+            key = sorted(active)
+            if overlaps and overlaps[-1][1] == t and key == overlap_key:
+                overlaps[-1] = (overlaps[-1][0], next_t, overlaps[-1][2])
+            else:
+                overlaps.append((t, next_t, tuple(active[x] for x in key)))
+            overlap_key = key
+    return (intervals, overlaps)
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+def _parse_clock(value):
+    try:
+        (hours, minutes) = value.split(':')
+        ret = timedelta(hours=int(hours), minutes=int(minutes))
+    except ValueError:
+        raise ValueError(f"invalid time of day: {value!r}")
+    if not timedelta(0) <= ret <= timedelta(hours=24):
+        raise ValueError(f"invalid time of day: {value!r}")
+    return ret
+
+def _parse_weekdays(value):
+    days = value.lower().split('-')
+    if len(days) > 2 or not all(x[:3] in WEEKDAYS for x in days):
+        raise ValueError(f"invalid weekdays: {value!r}")
+    (first, last) = (WEEKDAYS.index(days[0][:3]), WEEKDAYS.index(days[-1][:3]))
+    return [(first+i) % 7 for i in range((last-first) % 7 + 1)]
+
+def parse_working_hours(specs):
+    """
+    Parses working hours like '09:00-17:00 mon-fri' into a dict
+    category -> list of (weekday, begin, end).  Weekdays are numbered
+    as in datetime.weekday(), begin and end is the time since
+    midnight.
+
+    Several windows may be given in one spec separated by comma, i.e.
+    '08:00-11:00 mon-fri, 12:00-16:00 mon-thu'.  Windows without
+    weekdays apply to every day.  A spec may be prefixed with a
+    category, i.e. 'home=18:00-22:00 mon-fri, 10:00-16:00 sat-sun',
+    the working hours without a category (key None) apply to the
+    other tasks.  Raises ValueError on invalid specs.
+    """
+    ret = {}
+    for spec in specs:
+        category = None
+        if '=' in spec:
+            (category, spec) = spec.split('=', 1)
+            category = category.strip().lower()
+        windows = ret.setdefault(category, [])
+        for window in spec.split(','):
+            parts = window.split()
+            if not parts or len(parts[0].split('-')) != 2:
+                raise ValueError(f"invalid working hours: {window!r}")
+            (begin, end) = (_parse_clock(x) for x in parts[0].split('-'))
+            if end <= begin:
+                ## Working through midnight
+                end += timedelta(days=1)
+            days = [day for x in parts[1:] for day in _parse_weekdays(x)] or range(7)
+            windows.extend((day, begin, end) for day in days)
+    return ret
+
+def _union(spans):
+    """
+    Merges overlapping and adjacent (begin, end) into a sorted list
+    """
+    ret = []
+    for (begin, end) in sorted(spans):
+        if ret and begin <= ret[-1][1]:
+            ret[-1] = (ret[-1][0], max(end, ret[-1][1]))
+        else:
+            ret.append((begin, end))
+    return ret
+
+def _subtract(spans, removed):
+    """
+    The parts of the sorted non-overlapping spans not covered by the
+    sorted non-overlapping removed spans
+    """
+    ret = []
+    i = 0
+    for (begin, end) in spans:
+        while i < len(removed) and removed[i][1] <= begin:
+            i += 1
+        j = i
+        while j < len(removed) and removed[j][0] < end:
+            if removed[j][0] > begin:
+                ret.append((begin, removed[j][0]))
+            begin = max(begin, removed[j][1])
+            j += 1
+        if begin < end:
+            ret.append((begin, end))
+    return ret
+
+def available_time(windows, start, end, holidays=()):
+    """
+    The time available between start and end as a sorted list of
+    non-overlapping (begin, end), given the windows from
+    parse_working_hours.  holidays is a list of events (i.e. from a
+    holiday calendar), the time they take is not available.
+    """
+    by_weekday = [[(b, e) for (weekday, b, e) in windows if weekday == day] for day in range(7)]
+    spans = []
+    ## Windows through midnight may start the day before
+    day = start.date() - timedelta(days=1)
+    while day <= end.date():
+        midnight = datetime.combine(day, time())
+        for (begin, end_) in by_weekday[day.weekday()]:
+            spans.append((_ensure_ts(midnight+begin), _ensure_ts(midnight+end_)))
+        day += timedelta(days=1)
+    spans = [(max(b, start), min(e, end)) for (b, e) in _union(spans) if e > start and b < end]
+    return _subtract(spans, _union((b, e) for (b, e, event) in _occurrences(holidays, start, end)))
+
+def _capacity(timeline_class, working_hours, busy, start, end, holidays=()):
+    """
+    A timeline per category in working_hours, from start to end, with
+    the busy intervals and the time outside the working hours (as
+    'off') taken.  The day before start and the day after end are
+    also 'off', so the timelines always cover the full horizon.
+
+    Tasks should be filled into the timeline for their category, and
+    occupy the same time in the others.
+    """
+    ret = {}
+    for (category, windows) in working_hours.items():
+        timeline = timeline_class()
+        available = available_time(windows, start, end, holidays)
+        for (begin, end_) in _subtract([(start-timedelta(days=1), end+timedelta(days=1))], available):
+            timeline.add(begin, end_, 'off')
+        for (begin, end_, event) in busy:
+            timeline.occupy(max(begin, start), min(end_, end), event)
+        ret[category] = timeline
+    return ret
+
+def _place(timeline, capacity, own, task, end, duration, start):
+    """
+    Places the task in the available time before end (according to
+    own, the capacity timeline for the task) - in one piece if
+    possible, otherwise split over several working hour windows.
+    What doesn't fit is put on the timeline before start.
+
+    Returns a list of (timeline, begin) for every slot added.
+    """
+    ret = []
+    (slot, slack) = own.find_opening(end, duration)
+    if 'begin' in slot:
+        end = min(end, slot['end'])
+        own.add(end-duration, end, task)
+        pieces = [(end-duration, end)]
+    else:
+        pieces = own.fill(end, duration, task)
+    ret.extend((own, begin) for (begin, end) in pieces)
+    for (begin, end) in pieces:
+        if begin < start:
+            ret.extend((timeline, x) for (x, y) in timeline.fill(start, end-begin, task))
             continue
-        due = task.get_due()
+        timeline.add(begin, end, task)
+        ret.append((timeline, begin))
+        for other in capacity.values():
+            if other is not own:
+                ret.extend((other, x) for (x, y) in other.occupy(begin, end, task))
+    return ret
+
+class _Task:
+    """
+    A task in the Planner, with what's needed from the (expensive)
+    icalendar component picked out
+    """
+    __slots__ = ('obj', 'uid', 'key', 'due', 'duration', 'categories')
+
+class Planner:
+    """
+    Makes a timeline suggestion (see timeline_suggestion), and keeps
+    it up to date when tasks are changed.
+
+    The tasks are placed on the timeline one by one, ordered by
+    priority and then by due (the latest first).  The slots added
+    for each task are recorded, so that when a task is changed, only
+    the task and the tasks placed after it need to be taken off the
+    timeline and placed again.
+    """
+    def __init__(self, objs, hours_per_day=4, timeline_end=None, compact=False, working_hours=None, holidays=()):
+        self.hours_per_day = hours_per_day
+        self.timeline_end = timeline_end
+        self.start = _now()
+        self.horizon_end = timeline_end or self.start + timedelta(days=365)
+        self.timeline = ArrayTimeLine() if compact else TimeLine()
+        events = [x for x in objs if _component(x).name == 'VEVENT']
+        tasks = [x for x in objs if _component(x).name == 'VTODO']
+        assert len(events) + len(tasks) == len(objs)
+        self._event_parents = set()
+        for event in events:
+            comp = _component(event)
+            if comp.get('STATUS', '') == 'CANCELLED':
+                continue
+            if 'RELATED-TO' in comp and event.get_dtend()>_now():
+                rels = event.get_relatives(fetch_objects=False)
+                for rel in rels['PARENT']:
+                    self._event_parents.add(str(rel))
+
+        (intervals, self.timeline.overlaps) = busy_intervals(events, self.start, self.horizon_end)
+        for (begin, end, event) in intervals:
+            self.timeline.add(begin, end, event)
+        self._capacity = None
+        if working_hours:
+            ## Tasks without a category given in the working hours may be done at any time
+            working_hours = {None: [(day, timedelta(0), timedelta(days=1)) for day in range(7)], **working_hours}
+            self._capacity = _capacity(type(self.timeline), working_hours, intervals, self.start, self.horizon_end, holidays)
+
+        ## The tasks by uid, and their keys in the order they are placed
+        self._tasks = {}
+        self._order = SortedList()
+        self._by_key = {}
+        ## For each task placed (in order), the slots added and the
+        ## slack balance after it
+        self._placed = []
+        self._seq = 0
+        for task in tasks:
+            self._add_task(task)
+        self._place_from(0)
+
+    def _add_task(self, obj, seq=None):
+        """
+        Adds the task to the task index (not to the timeline).  Returns
+        the _Task, or None if the task shouldn't be planned
+        """
+        comp = _component(obj)
+        if not ('DUE' in comp or 'DURATION' in comp) or 'DTSTART' not in comp:
+            return None
+        if comp.get('STATUS', '') in ('COMPLETED', 'CANCELLED') or 'COMPLETED' in comp:
+            return None
+        task = _Task()
+        task.obj = obj
+        task.uid = str(comp['UID'])
+        if task.uid in self._event_parents:
+            ## task is presumably already included in timeline
+            return None
+        ## Same as obj.get_due() and obj.get_duration(), without
+        ## serializing and parsing the object once more
+        if 'DUE' in comp:
+            task.due = comp['DUE'].dt
+        elif 'DTEND' in comp:
+            task.due = comp['DTEND'].dt
+        else:
+            task.due = comp['DTSTART'].dt + comp['DURATION'].dt
+        task.duration = obj._get_duration(comp)
+        task.categories = [x.lower() for x in _prop_values(comp, 'categories')] if self._capacity and len(self._capacity) > 1 else []
+        ## The sequence number keeps the order of tasks with the same priority and due
+        if seq is None:
+            seq = self._seq
+            self._seq += 1
+        task.key = (comp.get('PRIORITY', 0), self.start-_ensure_ts(task.due), seq)
+        self._tasks[task.uid] = task
+        self._order.add(task.key)
+        self._by_key[task.key] = task
+        return task
+
+    def _remove_task(self, task):
+        del self._tasks[task.uid]
+        self._order.remove(task.key)
+        del self._by_key[task.key]
+
+    def _place_task(self, task, slackbalance):
+        """
+        Places the task on the timeline.  Returns the list of
+        (timeline, begin) for the slots added, and the new slack
+        balance.
+        """
+        due = task.due
         if due is None:
-            due = timeline_end
+            due = self.timeline_end
         end = _ensure_ts(due)
-        if timeline_end:
-            end = min(end, timeline_end)
-        duration = task.get_duration()
+        if self.timeline_end:
+            end = min(end, self.timeline_end)
+        duration = task.duration
         ## TODO: we should verify that duration is set and positive, otherwise the panic planning will panic
-        slackbalance -= duration*(24-hours_per_day)/hours_per_day
-        slot, slackbalance = timeline.find_opening(end, duration, slackbalance)
+        if self._capacity:
+            own = next((self._capacity[x] for x in task.categories if x in self._capacity), self._capacity[None])
+            return (_place(self.timeline, self._capacity, own, task.obj, min(end, self.horizon_end), duration, self.start), slackbalance)
+        added = []
+        slackbalance -= duration*(24-self.hours_per_day)/self.hours_per_day
+        slot, slackbalance = self.timeline.find_opening(end, duration, slackbalance)
         if 'end' in slot:
             end = min(end, slot['end'])
         begin = end - duration
-        timeline.add(begin, end, task)
+        if self.timeline.add(begin, end, task.obj):
+            added.append((self.timeline, begin))
         if slackbalance<timedelta(0):
-            timeline.pad_slack(begin, -slackbalance)
+            added.extend((self.timeline, x) for (x, y) in self.timeline.fill(begin, -slackbalance, 'slack'))
             slackbalance=timedelta(0)
-    return timeline
+        return (added, slackbalance)
+
+    def _place_from(self, first):
+        """
+        Takes the tasks from position first (in the order) and onwards
+        off the timeline, and places them again
+        """
+        while len(self._placed) > first:
+            (added, slackbalance) = self._placed.pop()
+            for (timeline, begin) in reversed(added):
+                timeline.remove(begin)
+        slackbalance = self._placed[-1][1] if self._placed else timedelta(0)
+        for key in self._order.islice(first):
+            (added, slackbalance) = self._place_task(self._by_key[key], slackbalance)
+            self._placed.append((added, slackbalance))
+
+    def replan(self):
+        """
+        Plans all the tasks from scratch, i.e. after changing hours_per_day
+        """
+        self._place_from(0)
+
+    def update(self, objs):
+        """
+        Updates the plan after the tasks have been changed (postponed,
+        reprioritized, completed, etc).  The changed tasks and the
+        tasks placed after them are placed again.  Tasks not in the
+        plan are ignored.
+        """
+        first = len(self._order)
+        changed = []
+        for obj in objs:
+            task = self._tasks.get(str(_component(obj)['UID']))
+            if task is not None:
+                first = min(first, self._order.index(task.key))
+                self._remove_task(task)
+                changed.append((obj, task.key[2]))
+        for (obj, seq) in changed:
+            task = self._add_task(obj, seq)
+            if task is not None:
+                first = min(first, self._order.index(task.key))
+        self._place_from(first)
+
+def timeline_suggestion(ctx, hours_per_day=4, timeline_end=None, compact=False, working_hours=None, holidays=()):
+    """
+    With compact, an ArrayTimeLine is used rather than a TimeLine.
+
+    The events are merged into busy intervals before the tasks are
+    placed (see busy_intervals), overlapping events are given in the
+    overlaps attribute of the timeline.
+
+    Without working_hours, the limited time per day is modelled by
+    padding the timeline with slack, hours_per_day hours per day are
+    left for the tasks.  working_hours is a dict from
+    parse_working_hours, the tasks are then placed in the working
+    hours (for their category) until timeline_end, except for the
+    time taken by the holidays (a list of events).
+    """
+    return Planner(ctx.obj['objs'], hours_per_day, timeline_end, compact, working_hours, holidays).timeline
@@ -0,0 +1,242 @@
+"""Client side evaluation of search filters
+
+The select command takes lots of filter options.  Earlier all of them
+were passed on to the calendar server through calendar-query REPORTs,
+but server support for the various filters is uneven (and some of them
+aren't supported by the caldav library at all), so plann ended up
+doing client-side filtering in several places anyway.
+
+This module compiles the select filters into a list of predicates that
+can be evaluated over objects available locally, i.e. from the object
+cache.  It can also be used for weeding out false positives from a
+server side search.
+
+Semantics follow RFC 4791 (section 9.7.5 for text matches, section
+9.9 for time ranges), with a few deliberate deviations:
+
+* ``category`` and ``categories`` match whole categories rather than
+  doing a substring search in the comma-separated list
+* ``parent`` and ``child`` match on the UID in RELATED-TO
+* ``has_foo`` (``no_foo=False``) is supported
+"""
+
+import datetime
+
+import recurring_ical_events
+
+from plann.lib import attr_int, attr_time, attr_txt_many, attr_txt_one
+from plann.timespec import _ensure_ts
+
+## Properties the caldav library knows how to search for server side.
+## Ref caldav.Calendar.build_search_xml_query
+SERVER_SIDE_PROPS = {
+    'uid', 'summary', 'comment', 'class', 'category', 'description', 'location',
+    'status', 'due', 'dtstamp', 'dtstart', 'dtend', 'duration', 'priority'}
+
+## Keys that are not filters, or that are dealt with in local_search()
+NON_FILTER_KEYS = {'start', 'end', 'expand', 'timespan'}
+
+RECURRENCE_PROPS = ('RRULE', 'RDATE', 'EXRULE')
+
+def server_filters(filters):
+    """
+    Returns the subset of the filters that can safely be passed on to
+    caldav.Calendar.search.  Everything else has to be evaluated
+    client side.
+    """
+    ret = {}
+    for key, value in filters.items():
+        if key in ('todo', 'event'):
+            ## caldav raises NotImplementedError on todo=False
+            if value:
+                ret[key] = value
+        elif key in ('include_completed', 'start', 'end', 'expand'):
+            ret[key] = value
+        elif key.startswith('no_'):
+            ## caldav would do a no_foo search also on no_foo=False
+            if value and key[3:] in SERVER_SIDE_PROPS:
+                ret[key] = value
+        elif key in SERVER_SIDE_PROPS:
+            ret[key] = value
+    return ret
+
+def _prop_values(comp, attr):
+    """
+    Returns all the values of a property as a list of strings
+    """
+    if attr in ('parent', 'child'):
+        rels = comp.get('RELATED-TO', [])
+        if not isinstance(rels, list):
+            rels = [rels]
+        return [str(x) for x in rels if x.params.get('RELTYPE', 'PARENT') == attr.upper()]
+    if attr in ('category', 'categories'):
+        cats = comp.get('CATEGORIES', [])
+        if not isinstance(cats, list):
+            cats = [cats]
+        return [str(cat) for x in cats for cat in x.cats]
+    values = comp.get(attr.upper(), [])
+    if not isinstance(values, list):
+        values = [values]
+    return [x if isinstance(x, str) else x.to_ical().decode() for x in values]
+
+def is_pending(comp):
+    """
+    Same logic as in caldav.Calendar.search - a task with status
+    NEEDS-ACTION is pending even if it has a COMPLETED timestamp
+    """
+    status = comp.get('STATUS', 'NEEDS-ACTION')
+    return status == 'NEEDS-ACTION' or ('COMPLETED' not in comp and status not in ('COMPLETED', 'CANCELLED'))
+
+def compile_filters(todo=None, event=None, include_completed=False, categories=(), **kwargs):
+    """
+    Compiles the select filters into a list of predicates.  Each
+    predicate takes an icalendar component and returns True if it
+    matches.  Time ranges are not included, see time_range_predicate.
+    """
+    predicates = []
+    if todo is not None:
+        predicates.append(lambda comp: (comp.name == 'VTODO') == todo)
+    if event is not None:
+        predicates.append(lambda comp: (comp.name == 'VEVENT') == event)
+    if todo and not include_completed:
+        predicates.append(is_pending)
+    if categories:
+        wanted = {x.lower() for x in categories}
+        predicates.append(lambda comp: wanted <= {x.lower() for x in _prop_values(comp, 'categories')})
+
+    for key, value in kwargs.items():
+        if key in NON_FILTER_KEYS:
+            continue
+        if key.startswith('no_'):
+            attr = key[3:]
+            if attr not in attr_txt_one + attr_txt_many + attr_time + attr_int:
+                raise NotImplementedError(f"searching for {key} not supported")
+            ## default arguments, to avoid the late binding of attr and value
+            predicates.append(lambda comp, attr=attr, value=value: (not _prop_values(comp, attr)) == value)
+        elif key in ('category', 'parent', 'child'):
+            predicates.append(lambda comp, attr=key, value=value.lower(): value in [x.lower() for x in _prop_values(comp, attr)])
+        elif key in attr_txt_one + attr_txt_many + ['uid']:
+            predicates.append(lambda comp, attr=key, value=value.lower(): any(value in x.lower() for x in _prop_values(comp, attr)))
+        else:
+            raise NotImplementedError(f"searching for {key} not supported")
+    return predicates
+
+def time_range_predicate(start=None, end=None):
+    """
+    Returns a predicate checking if a non-recurring component overlaps
+    with the time range, as specified in RFC 4791 section 9.9.  Either
+    start or end may be None, meaning an open-ended range.
+    """
+    start = start and _ensure_ts(start)
+    end = end and _ensure_ts(end)
+
+    def start_lt(dt):
+        return start is None or start < dt
+    def start_le(dt):
+        return start is None or start <= dt
+    def end_gt(dt):
+        return end is None or end > dt
+    def end_ge(dt):
+        return end is None or end >= dt
+
+    def ts(comp, attr):
+        value = comp.get(attr)
+        return value and _ensure_ts(value)
+
+    def in_range(comp):
+        dtstart = ts(comp, 'DTSTART')
+        duration = comp.get('DURATION')
+        duration = duration and duration.dt
+        if comp.name == 'VEVENT':
+            dtend = ts(comp, 'DTEND')
+            if dtstart is None:
+                return False
+            if dtend is not None:
+                return start_lt(dtend) and end_gt(dtstart)
+            if duration is None and not isinstance(comp['DTSTART'].dt, datetime.datetime):
+                duration = datetime.timedelta(days=1)
+            if duration:
+                return start_lt(dtstart + duration) and end_gt(dtstart)
+            return start_le(dtstart) and end_gt(dtstart)
+        if comp.name == 'VTODO':
+            due = ts(comp, 'DUE')
+            completed = ts(comp, 'COMPLETED')
+            created = ts(comp, 'CREATED')
+            if dtstart is not None and duration is not None:
+                return start_le(dtstart + duration) and (end_gt(dtstart) or end_ge(dtstart + duration))
+            if dtstart is not None and due is not None:
+                return (start_lt(due) or start_le(dtstart)) and (end_gt(dtstart) or end_ge(due))
+            if dtstart is not None:
+                return start_le(dtstart) and end_gt(dtstart)
+            if due is not None:
+                return start_lt(due) and end_ge(due)
+            if completed is not None and created is not None:
+                return (start_le(created) or start_le(completed)) and (end_ge(created) or end_ge(completed))
+            if completed is not None:
+                return start_le(completed) and end_ge(completed)
+            if created is not None:
+                return end_gt(created)
+            return True
+        if comp.name == 'VJOURNAL':
+            if dtstart is None:
+                return False
+            if not isinstance(comp['DTSTART'].dt, datetime.datetime):
+                return start_lt(dtstart + datetime.timedelta(days=1)) and end_gt(dtstart)
+            return start_le(dtstart) and end_gt(dtstart)
+        return False
+
+    return in_range
+
+def _is_recurring(comp):
+    return any(x in comp for x in RECURRENCE_PROPS)
+
+def _has_occurrence(obj, start, end, in_range):
+    """
+    Checks if any recurrence of obj overlaps with the time range
+    """
+    occurrences = recurring_ical_events.of(obj.icalendar_instance, components=['VEVENT', 'VTODO', 'VJOURNAL'])
+    for occurrence in occurrences.after(_ensure_ts(start)):
+        ## occurrences are yielded chronologically, so the first one is the one to check
+        return in_range(occurrence)
+    return False
+
+def local_search(objs, expand=False, split_expanded=True, limit=None, **filters):
+    """
+    Client side equivalent of caldav.Calendar.search, working on a
+    list (or any iterable) of caldav objects.
+
+    If expand is set, recurring objects will be expanded into the
+    recurrences found in the time range - same as with
+    caldav.Calendar.search.  The objects are modified in place, so
+    don't pass objects that will be saved back to the server.
+
+    If limit is given, the search stops when limit objects are found.
+    """
+    start = filters.get('start')
+    end = filters.get('end')
+    if expand and (not start or not end):
+        raise ValueError("can't expand without a date range")
+    predicates = compile_filters(**filters)
+    in_range = time_range_predicate(start, end) if start or end else None
+
+    ret = []
+    for obj in objs:
+        if limit is not None and len(ret) >= limit:
+            return ret[:limit]
+        comp = obj.icalendar_component
+        if comp is None or not all(pred(comp) for pred in predicates):
+            continue
+        if in_range is None:
+            ret.append(obj)
+        elif _is_recurring(comp):
+            if expand:
+                obj.expand_rrule(_ensure_ts(start), _ensure_ts(end))
+                if split_expanded:
+                    ret.extend(obj.split_expanded())
+                elif obj.icalendar_component is not None:
+                    ret.append(obj)
+            elif _has_occurrence(obj, start, end, in_range):
+                ret.append(obj)
+        elif in_range(comp):
+            ret.append(obj)
+    return ret if limit is None else ret[:limit]
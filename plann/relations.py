@@ -0,0 +1,451 @@
+"""Relations between calendar objects (the RELATED-TO property)
+
+Related objects are referenced by UID only, so finding them through
+the caldav library means one search per related object.  The
+RelationGraph indexes the relations of a selection of objects, and
+fetches the related objects outside the selection in bulk.
+"""
+
+from collections import defaultdict
+
+import caldav
+from caldav.elements import dav
+
+from plann.bulk import object_url
+from plann.cache import _multiget, _uid_from_ical
+
+## Relation types where the other object should be done before this one
+parentlike = {'PARENT', 'FIRST', 'DEPENDS-ON', 'STARTTOFINISH'}
+## ... and the opposite
+childlike = {'CHILD', 'NEXT', 'FINISHTOSTART'}
+## Relation types that are the inverse of each other.  Other relation
+## types are only considered in the direction they are given.
+inverse = {'PARENT': 'CHILD', 'CHILD': 'PARENT', 'SIBLING': 'SIBLING'}
+
+def _uid(obj):
+    return str(obj.icalendar_component['UID'])
+
+def _reltypes(reltypes):
+    ## A single reltype may be given as a string
+    if isinstance(reltypes, str):
+        return {reltypes}
+    return reltypes
+
+def related_uids(obj, reltypes=None):
+    """
+    Returns a dict reltype -> set of UIDs, like
+    obj.get_relatives(reltypes, fetch_objects=False), without the
+    defaultdict.
+    """
+    reltypes = _reltypes(reltypes)
+    ret = defaultdict(set)
+    rels = obj.icalendar_component.get('RELATED-TO', [])
+    if not isinstance(rels, list):
+        rels = [rels]
+    for rel in rels:
+        reltype = rel.params.get('RELTYPE', 'PARENT')
+        if reltypes and reltype not in reltypes:
+            continue
+        ret[reltype].add(str(rel))
+    return dict(ret)
+
+def fetch_by_uids(calendar, uids):
+    """
+    Fetches the objects with the given UIDs from the calendar.
+    Returns a dict uid -> object, missing objects are not included.
+
+    Objects are usually stored at <uid>.ics (caldav and most clients
+    does this), so all of them are attempted fetched through one
+    calendar-multiget.  Objects not found there are searched for by
+    UID, one by one.
+    """
+    uids = set(uids)
+    found = {}
+    if not uids:
+        return found
+    urls = [str(object_url(calendar, uid).canonical()) for uid in uids]
+    for (url, data, etag) in _multiget(calendar, urls):
+        uid = _uid_from_ical(data)
+        if uid in uids:
+            comp_class = calendar._calendar_comp_class_by_data(data)
+            found[uid] = comp_class(client=calendar.client, url=url, data=data, parent=calendar, props={dav.GetEtag.tag: etag})
+    for uid in uids - set(found):
+        try:
+            found[uid] = calendar.object_by_uid(uid)
+        except caldav.error.NotFoundError:
+            pass
+    return found
+
+class RelationGraph:
+    """
+    An index over the RELATED-TO properties of a set of objects
+    (typically the selected objects), with the reverse edges, so that
+    relations can be looked up without asking the server.
+
+    Related objects not in the graph are fetched when asked for
+    through relatives(), in bulk - one calendar-multiget per calendar
+    for all the objects asked for at once - and added to the graph.
+    """
+    def __init__(self, objs=()):
+        self.by_uid = {}
+        ## id(obj) -> uid for the objects in the graph, as looking up the
+        ## UID through the caldav library is quite expensive
+        self._uids = {}
+        ## uid -> reltype -> uids, as given in the RELATED-TO properties
+        self.edges = {}
+        ## uid -> reltype -> uids of the objects pointing to it
+        self.reverse = defaultdict(lambda: defaultdict(set))
+        ## UIDs not found on the server
+        self.missing = set()
+        for obj in objs:
+            self.add(obj)
+
+    def __contains__(self, uid):
+        return uid in self.by_uid
+
+    def get(self, uid):
+        return self.by_uid.get(uid)
+
+    def uid(self, obj):
+        """
+        The UID of obj.  For convenience, a UID is returned as it is.
+        """
+        if isinstance(obj, str):
+            return obj
+        return self._uids.get(id(obj)) or _uid(obj)
+
+    def add(self, obj):
+        """
+        Adds the object to the graph, unless there already is an object
+        with the same UID (i.e. another recurrence) in it.  Returns the
+        object in the graph.
+        """
+        uid = self.uid(obj)
+        if uid not in self.by_uid:
+            self.by_uid[uid] = obj
+            self._uids[id(obj)] = uid
+            self._index(uid, obj)
+        return self.by_uid[uid]
+
+    def update(self, obj):
+        """
+        Reindexes the relations of an object that has been changed
+        """
+        uid = self.uid(obj)
+        for (reltype, others) in self.edges.pop(uid, {}).items():
+            for other in others:
+                self.reverse[other][reltype].discard(uid)
+        if uid in self.by_uid:
+            self._uids.pop(id(self.by_uid[uid]), None)
+        self.by_uid[uid] = obj
+        self._uids[id(obj)] = uid
+        self._index(uid, obj)
+
+    def _index(self, uid, obj):
+        self.edges[uid] = related_uids(obj)
+        for (reltype, others) in self.edges[uid].items():
+            for other in others:
+                self.reverse[other][reltype].add(uid)
+
+    def related(self, obj, reltypes=None):
+        """
+        The relations given in the RELATED-TO properties of obj (an
+        object or the UID of an object in the graph), as a dict reltype
+        -> set of UIDs
+        """
+        reltypes = _reltypes(reltypes)
+        uid = self.uid(obj)
+        if uid not in self.edges:
+            return {} if isinstance(obj, str) else related_uids(obj, reltypes)
+        return {k: set(v) for (k, v) in self.edges[uid].items() if not reltypes or k in reltypes}
+
+    def relations(self, obj, reltypes=None):
+        """
+        Like related, but also including relations only given from the
+        other end - i.e. if another object in the graph has obj as a
+        CHILD, it's included as a PARENT even if obj doesn't point
+        back to it.
+        """
+        reltypes = _reltypes(reltypes)
+        ret = defaultdict(set, self.related(obj, reltypes))
+        for (reltype, others) in self.reverse.get(self.uid(obj), {}).items():
+            back = inverse.get(reltype)
+            if back and others and (not reltypes or back in reltypes):
+                ret[back].update(others)
+        return dict(ret)
+
+    def relatives(self, objs, reltypes=None):
+        """
+        Returns one list of related objects for each of the objs,
+        following the RELATED-TO properties.  Related objects not in
+        the graph are fetched, all at once.  Objects not found are
+        left out.
+        """
+        uids = [sorted(set().union(*self.related(obj, reltypes).values())) for obj in objs]
+        to_fetch = defaultdict(set)
+        for (obj, uids_) in zip(objs, uids):
+            if obj.parent is None:
+                continue
+            for uid in uids_:
+                if uid not in self.by_uid and uid not in self.missing:
+                    to_fetch[obj.parent].add(uid)
+        for (calendar, uids_) in to_fetch.items():
+            found = fetch_by_uids(calendar, uids_)
+            for obj in found.values():
+                self.add(obj)
+            self.missing.update(uids_ - set(found))
+        return [[self.by_uid[uid] for uid in x if uid in self.by_uid] for x in uids]
+
+    def relatives_by_type(self, obj, reltypes=None):
+        """
+        Returns a dict reltype -> list of related objects, like
+        obj.get_relatives(reltypes) in the caldav library
+        """
+        self.relatives([obj], reltypes)
+        return {reltype: [self.by_uid[uid] for uid in sorted(uids) if uid in self.by_uid] for (reltype, uids) in self.related(obj, reltypes).items()}
+
+    def roots(self, obj):
+        """
+        The topmost ancestors of obj, found level by level.  Returns an
+        empty list if there is a relationship loop above obj.
+        """
+        roots = []
+        seen = {self.uid(obj)}
+        level = [obj]
+        while level:
+            next_level = []
+            for (x, parents) in zip(level, self.relatives(level, parentlike)):
+                if not parents:
+                    roots.append(x)
+                for parent in parents:
+                    if self.uid(parent) not in seen:
+                        seen.add(self.uid(parent))
+                        next_level.append(parent)
+            level = next_level
+        return roots
+
+    def expand(self, starts):
+        """
+        starts is a list of (obj, with_children).  Returns a list of the
+        objects and the children of those with with_children set,
+        breadth first.  Each object is only included once, so
+        relationship loops are harmless.
+        """
+        ordered = []
+        seen = set()
+        expanded = set()
+        level = []
+        for (obj, with_children) in starts:
+            if self.uid(obj) not in seen:
+                seen.add(self.uid(obj))
+                ordered.append(obj)
+            if with_children and self.uid(obj) not in expanded:
+                expanded.add(self.uid(obj))
+                level.append(obj)
+        while level:
+            next_level = []
+            for children in self.relatives(level, childlike):
+                for child in children:
+                    if self.uid(child) in expanded:
+                        continue
+                    expanded.add(self.uid(child))
+                    if self.uid(child) not in seen:
+                        seen.add(self.uid(child))
+                        ordered.append(child)
+                    next_level.append(child)
+            level = next_level
+        return ordered
+
+def _loops(graph):
+    """
+    Finds the relationship loops in the hierarchy given by the
+    parentlike and childlike relations in the graph - the strongly
+    connected components, through an iterative variant of Tarjan's
+    algorithm.  Returns a list of tuples of UIDs.
+    """
+    ## uid -> uids of the objects below it
+    below = defaultdict(set)
+    for (uid, edges) in graph.edges.items():
+        for (reltype, others) in edges.items():
+            for other in others:
+                if reltype in parentlike:
+                    below[other].add(uid)
+                elif reltype in childlike:
+                    below[uid].add(other)
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    loops = []
+    for start in list(below):
+        if start in index:
+            continue
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        work = [(start, iter(below[start]))]
+        while work:
+            (node, children) = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(below.get(child, ()))))
+                    break
+                if child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        x = stack.pop()
+                        on_stack.discard(x)
+                        component.append(x)
+                        if x == node:
+                            break
+                    if len(component) > 1 or node in below.get(node, ()):
+                        loops.append(tuple(sorted(component)))
+    return loops
+
+def check_relations(graph, objs=None):
+    """
+    Checks the relations of objs (default: all the objects in the
+    graph).  Related objects not in the graph are fetched in bulk
+    first.  Returns a list of issues, tuples (kind, uid, reltype,
+    other), where kind is one of:
+
+    * missing - other has no link back to uid
+    * mismatch - other links back to uid, but with the wrong reltype
+    * dangling - other was not found
+    * loop - uid is a tuple of UIDs in a relationship loop
+    """
+    objs = list(graph.by_uid.values()) if objs is None else list(objs)
+    graph.relatives(objs)
+    issues = []
+    mismatches = set()
+    for obj in objs:
+        uid = graph.uid(obj)
+        for (reltype, others) in sorted(graph.related(obj).items()):
+            for other in sorted(others):
+                if other not in graph:
+                    issues.append(('dangling', uid, reltype, other))
+                    continue
+                if reltype not in inverse:
+                    continue
+                back = {k for (k, v) in graph.edges[other].items() if uid in v}
+                if not back:
+                    issues.append(('missing', uid, reltype, other))
+                elif back != {inverse[reltype]} and frozenset((uid, other)) not in mismatches:
+                    ## Only reported once per pair
+                    mismatches.add(frozenset((uid, other)))
+                    issues.append(('mismatch', uid, reltype, other))
+    issues.extend(('loop', loop, None, None) for loop in _loops(graph))
+    return issues
+
+def fix_relations(graph, issues):
+    """
+    Fixes the missing and dangling issues from check_relations, by
+    adding the missing links back and removing the dangling links.
+    Other issues are ignored.  The objects are only changed in memory,
+    the changed objects are returned.
+    """
+    changed = {}
+    for (kind, uid, reltype, other) in issues:
+        if kind == 'missing':
+            obj = graph.get(other)
+            obj.icalendar_component.add('RELATED-TO', uid, parameters={'RELTYPE': inverse[reltype]})
+            changed[other] = obj
+        elif kind == 'dangling':
+            obj = graph.get(uid)
+            comp = obj.icalendar_component
+            rels = comp.pop('RELATED-TO', [])
+            if not isinstance(rels, list):
+                rels = [rels]
+            for rel in rels:
+                if str(rel) != other or rel.params.get('RELTYPE', 'PARENT') != reltype:
+                    comp.add('RELATED-TO', str(rel), parameters=dict(rel.params))
+            changed[uid] = obj
+    for obj in changed.values():
+        graph.update(obj)
+    return list(changed.values())
+
+def connected(graph, objs, reltypes, include=lambda obj: True):
+    """
+    Finds the objects connected to objs through the given relations
+    (in any direction), level by level, with the unknown relatives of
+    a whole level fetched at once.  Objects not matching include are
+    neither returned nor followed.  Returns a dict uid -> object.
+    """
+    found = {}
+    level = []
+    for obj in objs:
+        uid = graph.uid(obj)
+        if uid not in found:
+            found[uid] = obj
+            level.append(obj)
+    seen = set(found)
+    while level:
+        graph.relatives(level, reltypes)
+        next_level = []
+        for obj in level:
+            for others in graph.relations(obj, reltypes).values():
+                for uid in sorted(others):
+                    if uid in seen or uid not in graph:
+                        continue
+                    seen.add(uid)
+                    if include(graph.get(uid)):
+                        found[uid] = graph.get(uid)
+                        next_level.append(graph.get(uid))
+        level = next_level
+    return found
+
+def hierarchy(graph, uids, members=None, up='PARENT', down='CHILD', siblings=False, done=None):
+    """
+    Orders objects in the graph as a forest, following the up and
+    down relations between the members (a set of UIDs, default all
+    of uids).  Yields (uid, depth) pairs, every member at most once,
+    each object before the objects below it.
+
+    For every UID in uids not yet yielded, the hierarchy is climbed to
+    a top object (following the first relation up) and the tree below
+    it is yielded, depth first.  An object with several objects above
+    it is placed below the first one found.  A relationship loop is
+    broken up where it's found.  Every object is visited a bounded
+    number of times, so this is linear in the number of objects and
+    relations.  With siblings, the SIBLING relatives of objects below
+    the top are placed at the same depth after them.
+
+    done is a set of UIDs already yielded, it's updated - so the
+    forest may be yielded piecewise through several calls.
+    """
+    uids = list(dict.fromkeys(uids))
+    members = set(uids) if members is None else members
+    done = set() if done is None else done
+    def related(uid, reltype):
+        return [x for x in sorted(graph.relations(uid, reltype).get(reltype, ())) if x in members]
+    for uid in uids:
+        if uid in done:
+            continue
+        top = uid
+        path = {uid}
+        while True:
+            above = [x for x in related(top, up) if x not in done]
+            if not above or above[0] in path:
+                break
+            top = above[0]
+            path.add(top)
+        stack = [(top, 0)]
+        while stack:
+            (uid_, depth) = stack.pop()
+            if uid_ in done:
+                continue
+            done.add(uid_)
+            yield (uid_, depth)
+            if siblings and depth:
+                stack.extend(reversed([(x, depth) for x in related(uid_, 'SIBLING') if x not in done]))
+            stack.extend(reversed([(x, depth+1) for x in related(uid_, down) if x not in done]))
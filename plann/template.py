@@ -3,9 +3,15 @@ template string.
 
 This does not really belong in the calendar-cli package.  I was
 googling a bit, and didn't find anything like this out there ... but
-I'm sure there must exist something like this?"""
+I'm sure there must exist something like this?
 
+The template string is parsed once (and the parse results are cached
+across Template objects), rather than on every call to format.  This
+matters when listing or sorting thousands of objects."""
+
+import _string
 import datetime
+import functools
 import re
 import string
 
@@ -27,23 +33,151 @@ class NoValue:
 
 no_value = NoValue()
 
+## Same limit on nested format specs as in string.Formatter
+MAX_RECURSION_DEPTH = 2
+
+_formatter = string.Formatter()
+
+def _default_end(spec):
+    """
+    spec is a format spec starting with ?.  Returns the position of
+    the ? closing the default value, or None.  A ? within a nested
+    field (i.e. "?{foo:?bar?}?%F") does not count.
+    """
+    depth = 0
+    for i in range(1, len(spec)):
+        if spec[i] == '{':
+            depth += 1
+        elif spec[i] == '}':
+            depth -= 1
+        elif spec[i] == '?' and not depth:
+            return i
+    return None
+
+def _compile_spec(spec, recursion_depth, auto_arg_index):
+    """
+    A format spec without fields is kept as a string, otherwise it's
+    compiled into a list of ops
+    """
+    if recursion_depth < 0:
+        raise ValueError('Max string recursion exceeded')
+    if '{' in spec or '}' in spec:
+        return _compile_ops(spec, recursion_depth, auto_arg_index)
+    return spec
+
+def _compile_ops(template, recursion_depth, auto_arg_index):
+    """
+    Parses the template into a list of ops.  An op is either a literal
+    string or a tuple (first, rest, conversion, default, spec), where
+    first is the key to look up, rest is a tuple of (is_attr, key)
+    for further attribute or item lookups, and default and spec are
+    compiled format specs (default is None if no default is given).
+
+    auto_arg_index is a one-element list, so the numbering of {} is
+    shared with the nested specs (like in string.Formatter)
+    """
+    if recursion_depth < 0:
+        raise ValueError('Max string recursion exceeded')
+    ops = []
+    for (literal, field_name, spec, conversion) in _formatter.parse(template):
+        if literal:
+            ops.append(literal)
+        if field_name is None:
+            continue
+        if field_name == '':
+            field_name = str(auto_arg_index[0])
+            auto_arg_index[0] += 1
+        if conversion not in (None, 'r', 's', 'a'):
+            raise ValueError(f"Unknown conversion specifier {conversion}")
+        (first, rest) = _string.formatter_field_name_split(field_name)
+        default = None
+        if spec.startswith('?'):
+            end = _default_end(spec)
+            if end is not None:
+                default = _compile_spec(spec[1:end], recursion_depth-1, auto_arg_index)
+                spec = spec[end+1:]
+        ops.append((first, tuple(rest), conversion, default, _compile_spec(spec, recursion_depth-1, auto_arg_index)))
+    return ops
+
+@functools.lru_cache(maxsize=1024)
+def _compile(template):
+    return tuple(_compile_ops(template, MAX_RECURSION_DEPTH, [0]))
+
+def _unwrap(value):
+    if hasattr(value, 'dt'):
+        value = value.dt
+        if not tz.show_native_timezone and isinstance(value, datetime.datetime):
+            value = value.astimezone()
+    return value
+
+def _format_value(value, format_spec):
+    try:
+        return format(value, format_spec)
+    except Exception:
+        return format(value, "")
+
+def _render_spec(spec, args, kwargs):
+    if spec.__class__ is str:
+        return spec
+    return _render(spec, args, kwargs)
+
+def _render(ops, args, kwargs):
+    result = []
+    for op in ops:
+        if op.__class__ is str:
+            result.append(op)
+            continue
+        (first, rest, conversion, default, spec) = op
+        try:
+            value = args[first] if isinstance(first, int) else kwargs[first]
+        except (IndexError, KeyError):
+            value = no_value
+        else:
+            value = _unwrap(value)
+        for (is_attr, key) in rest:
+            if is_attr:
+                ## timestamps are already unwrapped, so {DTSTART.dt} is the same as {DTSTART}
+                if key == 'dt' and isinstance(value, datetime.date):
+                    continue
+                value = getattr(value, key)
+            else:
+                value = value[key]
+        if conversion == 'r':
+            value = repr(value)
+        elif conversion == 's':
+            value = str(value)
+        elif conversion == 'a':
+            value = ascii(value)
+        format_spec = _render_spec(spec, args, kwargs)
+        if default is not None:
+            if value is no_value:
+                value = _render_spec(default, args, kwargs)
+        elif format_spec.startswith('?'):
+            ## The default value was inserted through a nested field
+            rx = re.match(r'\?([^\?]*)\?(.*)', format_spec)
+            if rx:
+                format_spec = rx.group(2)
+                if value is no_value:
+                    value = rx.group(1)
+        result.append(_format_value(value, format_spec))
+    return "".join(result)
+
 class Template(string.Formatter):
     def __init__(self, template):
         self.template = template
+        self._ops = _compile(template)
 
     def format(self, *pargs, **kwargs):
-        return super().format(self.template, *pargs, **kwargs)
+        return _render(self._ops, pargs, kwargs)
 
+    ## get_value and format_field are used if the Template is used as
+    ## an ordinary string.Formatter, i.e. through vformat
     def get_value(self, key, args, kwds):
         try:
             ret = string.Formatter.get_value(self, key, args, kwds)
         except Exception:
             return no_value
-        if hasattr(ret, 'dt'):
-            ret = ret.dt
-            if not tz.show_native_timezone and isinstance(ret, datetime.datetime):
-                ret = ret.astimezone()
-        return ret
+        return _unwrap(ret)
 
     def format_field(self, value, format_spec):
         rx = re.match(r'\?([^\?]*)\?(.*)', format_spec)
@@ -51,7 +185,4 @@ class Template(string.Formatter):
             format_spec = rx.group(2)
             if value is no_value:
                 value = rx.group(1)
-        try:
-            return string.Formatter.format_field(self, value, format_spec)
-        except Exception:
-            return string.Formatter.format_field(self, value, "")
+        return _format_value(value, format_spec)
@@ -0,0 +1,122 @@
+"""Benchmark for the panic planning (select check-for-panic)
+
+Not run as part of the test suite.  Usage:
+
+    python -m tests.benchmark_panic [number of tasks ...]
+
+Generates the given number of tasks (default 1000 and 10000) with
+random due dates during the next year, and times timeline_suggestion,
+which is what check-for-panic spends its time on - also with working
+hours ('09:00-17:00 mon-fri') over the year.  The parsing of the
+tasks, done once when they are selected, is timed separately.  The free slots are
+searched through the gap index of the TimeLine, so the time spent
+should grow about linearly with the number of tasks.
+
+The memory used by the timeline itself is also measured, for the
+TimeLine and the compact ArrayTimeLine, and the merging of the given
+number of weekly meetings over three years into busy intervals is
+timed.
+"""
+
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from caldav import Event, Todo
+
+from plann.panic_planning import ArrayTimeLine, TimeLine, busy_intervals, parse_working_hours, timeline_suggestion
+
+
+def _tasks(num, rnd):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    tasks = []
+    for i in range(num):
+        due = now + timedelta(minutes=rnd.randrange(60, 60*24*365))
+        duration = timedelta(minutes=rnd.choice((15, 30, 60, 120, 240)))
+        tasks.append(Todo(client=None, url=f"https://example.com/task{i}.ics", data=f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//plann//benchmark//EN
+BEGIN:VTODO
+UID:task{i}
+DTSTAMP:{now:%Y%m%dT%H%M%SZ}
+DTSTART:{due-duration:%Y%m%dT%H%M%SZ}
+DUE:{due:%Y%m%dT%H%M%SZ}
+PRIORITY:{rnd.randrange(1, 10)}
+SUMMARY:task {i}
+END:VTODO
+END:VCALENDAR
+"""))
+    return tasks
+
+def benchmark(num, seed=1):
+    ctx = mock.Mock()
+    ctx.obj = {'objs': _tasks(num, random.Random(seed))}
+    ## The objects are parsed when selected (the filters are evaluated
+    ## client side), so the parsing is timed separately
+    started = time.perf_counter()
+    for obj in ctx.obj['objs']:
+        obj.icalendar_instance
+    elapsed = time.perf_counter() - started
+    print(f"{num} tasks parsed: {elapsed:.2f}s")
+    working_hours = parse_working_hours(['09:00-17:00 mon-fri'])
+    for (compact, hours) in ((False, None), (True, None), (False, working_hours)):
+        started = time.perf_counter()
+        timeline = timeline_suggestion(ctx, hours_per_day=4, compact=compact, working_hours=hours)
+        elapsed = time.perf_counter() - started
+        mode = ' (compact)' if compact else ' (working hours)' if hours else ''
+        print(f"{num} tasks{mode}: {elapsed:.2f}s, {elapsed/num*1000:.3f} ms per task, {timeline.count()} tasks on the timeline")
+
+def benchmark_memory(num, seed=1):
+    """
+    Memory used by a timeline with num objects, one hour each, at
+    random times during the next year
+    """
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    for cls in (TimeLine, ArrayTimeLine):
+        rnd = random.Random(seed)
+        tracemalloc.start()
+        timeline = cls()
+        for i in range(num):
+            begin = now + timedelta(hours=rnd.randrange(0, 24*365*10))
+            try:
+                timeline.add(begin, begin + timedelta(hours=1), i)
+            except AssertionError:
+                ## overlapping
+                pass
+        (size, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{cls.__name__} with {len(timeline)} slots: {size/len(timeline):.0f} bytes per slot")
+
+def benchmark_busy(num, seed=1):
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(hour=8, minute=0, second=0, microsecond=0)
+    events = []
+    for i in range(num):
+        begin = now + timedelta(days=rnd.randrange(7), minutes=15*rnd.randrange(40))
+        end = begin + timedelta(minutes=rnd.choice((30, 60)))
+        events.append(Event(client=None, url=f"https://example.com/meeting{i}.ics", data=f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//plann//benchmark//EN
+BEGIN:VEVENT
+UID:meeting{i}
+DTSTAMP:{now:%Y%m%dT%H%M%SZ}
+DTSTART:{begin:%Y%m%dT%H%M%SZ}
+DTEND:{end:%Y%m%dT%H%M%SZ}
+RRULE:FREQ=WEEKLY
+SUMMARY:meeting {i}
+END:VEVENT
+END:VCALENDAR
+"""))
+    started = time.perf_counter()
+    (intervals, overlaps) = busy_intervals(events, now, now + timedelta(days=3*365))
+    elapsed = time.perf_counter() - started
+    print(f"{num} weekly meetings over three years: {elapsed:.2f}s, {len(intervals)} busy intervals, {len(overlaps)} overlaps")
+
+if __name__ == '__main__':
+    for num in [int(x) for x in sys.argv[1:]] or [1000, 10000]:
+        benchmark(num)
+        benchmark_memory(num)
+        benchmark_busy(num)
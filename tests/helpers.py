@@ -0,0 +1,34 @@
+"""Helpers shared by the tests"""
+
+from caldav import Event, Todo
+
+_COMPONENTS = {Todo: 'VTODO', Event: 'VEVENT'}
+
+def calendar_object(cls, uid, extra="", summary=None, **kwargs):
+    """
+    A caldav object of the given class (Todo or Event) with the UID,
+    the SUMMARY (if given) and the extra properties, one per line.
+    Other keyword arguments (i.e. url or parent) are passed on to the
+    object.
+    """
+    component = _COMPONENTS[cls]
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//Example Corp.//CalDAV Client//EN",
+        f"BEGIN:{component}",
+        f"UID:{uid}",
+        "DTSTAMP:20230101T100000Z",
+    ]
+    if summary is not None:
+        lines.append(f"SUMMARY:{summary}")
+    if extra:
+        lines.append(extra.rstrip("\n"))
+    lines += [f"END:{component}", "END:VCALENDAR"]
+    return cls(data="\n".join(lines), **kwargs)
+
+def todo(uid, extra="", **kwargs):
+    return calendar_object(Todo, uid, extra, **kwargs)
+
+def event(uid, extra="", **kwargs):
+    return calendar_object(Event, uid, extra, **kwargs)
@@ -0,0 +1,142 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+from caldav.elements import dav
+from caldav.lib.url import URL
+
+from plann.bulk import BulkWriter, UploadJournal, object_url
+from plann.ics import object_uid
+
+
+def _ical(uid):
+    return f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nBEGIN:VEVENT\r\nUID:{uid}\r\nDTSTART:20230101T100000Z\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+
+def _calendar(url, statuses=None):
+    """
+    A calendar with a fake client.  statuses maps uids to the list of
+    statuses the server should reply for consecutive requests (default
+    201 for PUT and 204 for DELETE)
+    """
+    statuses = statuses or {}
+    calendar = MagicMock()
+    calendar.url = URL.objectify(url)
+    calendar.puts = []
+    def request(url, method, data, headers):
+        calendar.puts.append((str(url), headers))
+        uid = str(url).split('/')[-1][:-4]
+        response = MagicMock()
+        response.status = statuses[uid].pop(0) if statuses.get(uid) else {'PUT': 201, 'DELETE': 204}[method]
+        response.headers = {}
+        return response
+    calendar.client.request.side_effect = request
+    return calendar
+
+def _uploader(calendars, **kwargs):
+    uploader = BulkWriter(calendars, progress=False, **kwargs)
+    uploader._sleep = lambda delay: None
+    return uploader
+
+def test_object_url():
+    calendar = _calendar('http://example.com/cal/')
+    assert str(object_url(calendar, 'a/b c')) == 'http://example.com/cal/a%252Fb%20c.ics'
+
+def test_upload_retries_and_failures():
+    calendar = _calendar('http://example.com/cal/', {'retry': [503, 429, 204], 'bad': [400], 'down': [500]*10})
+    report = _uploader([calendar], retries=3).upload(_ical(uid) for uid in ('ok', 'retry', 'bad', 'down'))
+    assert report.stored == 2
+    assert sorted(x[1] for x in report.failures) == ['bad', 'down']
+    assert len(calendar.puts) == 1+3+1+4
+    assert all('If-None-Match' not in headers for (url, headers) in calendar.puts)
+
+def test_skip_existing_and_multi_add():
+    cal1 = _calendar('http://example.com/cal1/', {'old': [412]})
+    cal2 = _calendar('http://example.com/cal2/')
+    report = _uploader([cal1, cal2], overwrite=False).upload(_ical(uid) for uid in ('new', 'old'))
+    assert (report.stored, report.skipped, report.failures) == (3, 1, [])
+    assert all(headers['If-None-Match'] == '*' for (url, headers) in cal1.puts + cal2.puts)
+
+def test_update_without_etag():
+    ## An existing object without a known ETag should be overwritten, not skipped
+    calendar = _calendar('http://example.com/cal/', {'failing': [412]})
+    url = object_url(calendar, 'old')
+    report = _uploader([calendar], overwrite=False).run([
+        ('put', calendar, 'old', _ical('old'), url, None),
+        ('put', calendar, 'failing', _ical('failing'), object_url(calendar, 'failing'), None)])
+    assert (report.stored, report.skipped, [x[1] for x in report.failures]) == (1, 0, ['failing'])
+    assert all('If-None-Match' not in headers for (url, headers) in calendar.puts)
+
+def test_concurrency_per_server():
+    active = {'now': 0, 'max': 0}
+    lock = threading.Lock()
+    calendar = _calendar('http://example.com/cal/')
+    def request(url, method, data, headers):
+        with lock:
+            active['now'] += 1
+            active['max'] = max(active['max'], active['now'])
+        time.sleep(0.01)
+        with lock:
+            active['now'] -= 1
+        return MagicMock(status=201)
+    calendar.client.request.side_effect = request
+    report = _uploader([calendar], concurrency=3).upload(_ical(i) for i in range(30))
+    assert report.stored == 30
+    assert 1 < active['max'] <= 3
+
+def test_journal_resume(tmp_path):
+    filename = str(tmp_path / 'journal')
+    calendar = _calendar('http://example.com/cal/', {'bad': [400]})
+    with UploadJournal(filename) as journal:
+        report = _uploader([calendar], journal=journal).upload(_ical(uid) for uid in ('a', 'b\tc', 'bad'))
+    assert report.stored == 2
+
+    ## Resuming, only the failed object should be uploaded
+    calendar = _calendar('http://example.com/cal/')
+    with UploadJournal(filename, resume=True) as journal:
+        assert ('http://example.com/cal/', 'b\tc') in journal
+        report = _uploader([calendar], journal=journal).upload(_ical(uid) for uid in ('a', 'b\tc', 'bad'))
+    assert (report.stored, report.skipped) == (1, 2)
+    assert [url for (url, headers) in calendar.puts] == ['http://example.com/cal/bad.ics']
+
+    ## Another calendar is not in the journal
+    other = _calendar('http://example.com/other/')
+    with UploadJournal(filename, resume=True) as journal:
+        report = _uploader([other], journal=journal).upload(_ical(uid) for uid in ('a', 'bad'))
+    assert report.stored == 2
+
+    ## Without resume, a new journal is started
+    UploadJournal(filename).close()
+    with UploadJournal(filename, resume=True) as journal:
+        assert not journal.stored
+
+def test_upload_without_uid(tmp_path):
+    data = "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nBEGIN:VTODO\r\nSUMMARY:no uid\r\nEND:VTODO\r\nEND:VCALENDAR\r\n"
+    filename = str(tmp_path / 'journal')
+    calendar = _calendar('http://example.com/cal/')
+    with UploadJournal(filename) as journal:
+        report = _uploader([calendar], journal=journal).upload([data])
+    assert report.stored == 1
+    (url, method, sent, headers) = calendar.client.request.call_args.args
+    assert 'BEGIN:VTODO' in sent and url.endswith(f"/{object_uid(sent)}.ics")
+
+    ## The same UID is given on resume, so the object is not uploaded once more
+    calendar = _calendar('http://example.com/cal/')
+    with UploadJournal(filename, resume=True) as journal:
+        report = _uploader([calendar], journal=journal).upload([data])
+    assert (report.stored, report.skipped, calendar.puts) == (0, 1, [])
+
+def test_delete():
+    calendar = _calendar('http://example.com/cal/', {'gone': [404], 'changed': [412], 'locked': [423, 204]})
+    objs = []
+    for uid in ('a', 'gone', 'changed', 'locked'):
+        obj = MagicMock()
+        obj.parent = calendar
+        obj.url = calendar.url.join(f"{uid}.ics")
+        obj.data = _ical(uid)
+        obj.props = {dav.GetEtag.tag: f'"{uid}-etag"'}
+        objs.append(obj)
+    report = _uploader([calendar]).delete(objs)
+    assert (report.deleted, report.skipped) == (2, 1)
+    assert [x[1] for x in report.failures] == ['changed']
+    assert all(headers['If-Match'].endswith('-etag"') for (url, headers) in calendar.puts)
+    assert str(report) == "2 deleted, 1 skipped, 1 failed"
@@ -0,0 +1,166 @@
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+from caldav.lib.url import URL
+
+from plann.commands import _dismiss_panic, _edit, _object_cache, _select, _server_search, _sort_key_func
+from plann.lib import _parallel_map
+from plann.panic_planning import Planner
+from plann.timespec import _now
+from tests.helpers import todo as _todo
+
+
+def _uids(objs):
+    return [str(x.icalendar_component['UID']) for x in objs]
+
+def test_sort_key_func():
+    todos = [
+        _todo('a', 'PRIORITY:2\nSUMMARY:b\nDUE:20230110T100000Z'),
+        _todo('b', 'PRIORITY:1\nSUMMARY:b\nDUE;VALUE=DATE:20230109'),
+        _todo('c', 'PRIORITY:2\nSUMMARY:a'),
+        _todo('d', 'SUMMARY:c\nDUE:20230108T100000Z'),
+    ]
+    assert _uids(sorted(todos, key=_sort_key_func(['PRIORITY']))) == ['d', 'b', 'a', 'c']
+    assert _uids(sorted(todos, key=_sort_key_func(['-PRIORITY', 'SUMMARY']))) == ['c', 'a', 'b', 'd']
+    assert _uids(sorted(todos, key=_sort_key_func(['SUMMARY', '-PRIORITY']))) == ['c', 'a', 'b', 'd']
+    assert _uids(sorted(todos, key=_sort_key_func(['-SUMMARY', 'PRIORITY']))) == ['d', 'b', 'a', 'c']
+    ## date and datetime mixed
+    assert _uids(sorted(todos, key=_sort_key_func(['DUE']))) == ['c', 'd', 'b', 'a']
+    ## templates
+    assert _uids(sorted(todos, key=_sort_key_func(['{PRIORITY:?9?}{SUMMARY}']))) == ['b', 'c', 'a', 'd']
+    assert _uids(sorted(todos, key=_sort_key_func(['-{PRIORITY:?9?}', 'SUMMARY']))) == ['d', 'c', 'a', 'b']
+
+def test_select_limit_offset():
+    todos = [_todo(f"t{i}", f"PRIORITY:{i%5}\nSUMMARY:task {i}") for i in range(20)]
+    calendar = MagicMock()
+    calendar.search.return_value = todos
+    calendar.supported_components = None
+    ctx = MagicMock()
+    ctx.obj = {'calendars': [calendar]}
+    sort_key = ['-PRIORITY', 'SUMMARY']
+    expected = _uids(sorted(todos, key=_sort_key_func(sort_key)))
+
+    _select(ctx, todo=True, sort_key=sort_key)
+    assert _uids(ctx.obj['objs']) == expected
+    _select(ctx, todo=True, sort_key=sort_key, limit=4)
+    assert _uids(ctx.obj['objs']) == expected[:4]
+    _select(ctx, todo=True, sort_key=sort_key, limit=4, offset=3)
+    assert _uids(ctx.obj['objs']) == expected[3:7]
+    _select(ctx, todo=True, sort_key=sort_key, offset=18)
+    assert _uids(ctx.obj['objs']) == expected[18:]
+    _select(ctx, todo=True, limit=3, offset=1)
+    assert _uids(ctx.obj['objs']) == ['t1', 't2', 't3']
+
+def test_select_stream():
+    todos = [_todo(f"t{i}", f"SUMMARY:task {i}") for i in range(3)]
+    calendars = [MagicMock(), MagicMock()]
+    calendars[0].search.return_value = todos[:2]
+    calendars[1].search.side_effect = RuntimeError("the first calendar should be listed before this")
+    for calendar in calendars:
+        calendar.supported_components = None
+    ctx = MagicMock()
+    ctx.obj = {'calendars': calendars, 'parallelism': 1}
+
+    _select(ctx, todo=True, sort_key=[''], stream=True)
+    objs = ctx.obj['objs']
+    assert _uids([next(objs), next(objs)]) == ['t0', 't1']
+    with pytest.raises(RuntimeError):
+        next(objs)
+
+    ## Sorting needs the full selection
+    calendars[1].search.side_effect = None
+    calendars[1].search.return_value = todos[2:]
+    _select(ctx, todo=True, sort_key=['-SUMMARY'], stream=True)
+    assert _uids(ctx.obj['objs']) == ['t2', 't1', 't0']
+
+def test_object_cache_shared():
+    calendars = [MagicMock(), MagicMock()]
+    calendars[0].url = URL('http://example.com/cal/')
+    calendars[1].url = URL('http://example.com:80/cal/')
+    ctx = MagicMock()
+    ctx.obj = {'cache': True}
+    def slow_cache(*largs):
+        ## gives the other thread a chance to create a cache as well
+        time.sleep(0.1)
+        return MagicMock()
+    with patch('plann.commands.ObjectCache', side_effect=slow_cache) as object_cache:
+        caches = _parallel_map(lambda c: _object_cache(ctx, c), calendars, parallelism=2)
+    assert object_cache.call_count == 1
+    assert caches[0] is caches[1]
+    assert caches[0].sync.call_count == 2
+
+def test_server_search_expands_pending_tasks():
+    ## A daily task - the three searches for pending tasks return the same object
+    def search(**kwargs):
+        assert 'expand' not in kwargs
+        return [_todo('daily', 'DTSTART:20250106T100000Z\nDUE:20250106T110000Z\nRRULE:FREQ=DAILY', url='http://example.com/cal/daily.ics')]
+    calendar = MagicMock()
+    calendar.search.side_effect = search
+    start = datetime(2025, 1, 6, tzinfo=timezone.utc)
+    end = datetime(2025, 1, 10, tzinfo=timezone.utc)
+    found = _server_search(calendar, todo=True, start=start, end=end, expand=True)
+    assert calendar.search.call_count == 3
+    assert [str(x.icalendar_component['RECURRENCE-ID'].dt.date()) for x in found] == ['2025-01-06', '2025-01-07', '2025-01-08', '2025-01-09']
+    assert len(_server_search(calendar, todo=True, start=start, end=end)) == 1
+
+def test_edit_saves_changed_only():
+    todos = [
+        _todo('a', 'CATEGORIES:foo'),
+        _todo('b', 'CATEGORIES:bar'),
+        _todo('c', 'CATEGORIES:foo,bar'),
+    ]
+    for todo in todos:
+        todo.save = MagicMock()
+    ctx = MagicMock()
+    ctx.obj = {'objs': todos}
+    _edit(ctx, add_category=['foo'])
+    assert [x.save.called for x in todos] == [False, True, False]
+
+    _edit(ctx, cancel=True)
+    assert all(x.icalendar_component['STATUS'] == 'CANCELLED' for x in todos)
+    assert [x.save.call_count for x in todos] == [1, 2, 1]
+
+def test_edit_saves_once():
+    def _todos():
+        todos = [_todo(uid, "DTSTART:20300101T100000\nDUE:20300101T120000") for uid in ('a', 'b')]
+        for todo in todos:
+            todo.save = MagicMock()
+        return todos
+    ## caldav saves the object when completing it
+    todos = _todos()
+    ctx = MagicMock()
+    ctx.obj = {'objs': todos}
+    _edit(ctx, add_category=['foo'], complete=True, postpone='1d')
+    assert all(x.icalendar_component['STATUS'] == 'COMPLETED' for x in todos)
+    assert all(x.icalendar_component['DUE'].dt == datetime(2030, 1, 2, 12, tzinfo=timezone.utc) for x in todos)
+    assert [x.save.call_count for x in todos] == [1, 1]
+
+    ## ... the interactive commands may also save the object
+    for command in ('complete', 'postpone 1d', 'cancel'):
+        todos = _todos()
+        ctx.obj = {'objs': todos}
+        with patch('click.prompt', return_value=command):
+            _edit(ctx, add_category=['foo'], interactive=True)
+        assert all('foo' in x.icalendar_component['CATEGORIES'].cats for x in todos)
+        assert [x.save.call_count for x in todos] == [1, 1]
+
+def test_dismiss_panic_updates_plan():
+    ## Four hours of work due in two hours - and a task that can wait
+    now = _now()
+    late = _todo('late', f"PRIORITY:5\nDTSTART:{now-timedelta(hours=2):%Y%m%dT%H%M%S}\nDUE:{now+timedelta(hours=2):%Y%m%dT%H%M%S}")
+    later = _todo('later', f"PRIORITY:5\nDTSTART:{now+timedelta(days=10):%Y%m%dT%H%M%S}\nDUE:{now+timedelta(days=10, hours=1):%Y%m%dT%H%M%S}")
+    for todo in (late, later):
+        todo.save = MagicMock()
+    planner = Planner([late, later], hours_per_day=24)
+    assert planner.timeline[0]['begin'] < now
+    with patch('click.prompt', side_effect=['1d', '0h']) as prompt, patch.object(planner, 'update', wraps=planner.update) as update:
+        assert _dismiss_panic(MagicMock(), 24, planner=planner) is planner
+    ## The later task is only offered to be postponed
+    assert [x.kwargs['default'] for x in prompt.call_args_list] == ['2h', '0h']
+    late.save.assert_called_once()
+    update.assert_called_once_with([late])
+    ## The plan is updated, no need to panic any longer
+    assert planner.timeline[0]['begin'] >= now
+    assert planner.timeline.count() == 2
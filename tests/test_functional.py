@@ -9,14 +9,23 @@ import os
 import tempfile
 import threading
 import time
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock, patch
 
 import aiohttp
 import aiohttp.web
+import caldav
+import click
 import niquests as requests
+import pytest
 from xandikos.web import XandikosApp, XandikosBackend
 
+import plann.cache
+from plann.bulk import BulkWriter, object_etag
+from plann.cache import DiscoveryCache, ObjectCache
 from plann.cli import _add_todo, _check_for_panic, _list, _select
+from plann.commands import _check_relations, _copy_to, _object_cache
+from plann.ics import split_vcalendars
 from plann.interactive import (
     _interactive_edit,
     _interactive_relation_edit,
@@ -24,8 +33,9 @@ from plann.interactive import (
     _mass_reprioritize,
     command_edit,
 )
-from plann.lib import _adjust_ical_relations, _adjust_relations, find_calendars
+from plann.lib import _adjust_ical_relations, _adjust_relations, find_calendars, find_calendars_multi
 from plann.panic_planning import timeline_suggestion
+from plann.relations import fetch_by_uids
 from tests.test_panic import datetime_
 
 
@@ -166,6 +176,9 @@ def test_plann():
         ctx.obj = dict()
         ctx.obj['calendars'] = find_calendars(conn_details, raise_errors=True)
 
+        ## Discovery for several config sections is done concurrently
+        assert len(find_calendars_multi([conn_details, conn_details], raise_errors=True)) == 2*len(ctx.obj['calendars'])
+
         def dag(obj, reltype, observed=None):
             if not hasattr(obj, 'get_relatives'):
                 obj = ctx.obj['calendars'][0].object_by_uid(obj)
@@ -429,5 +442,263 @@ def test_plann():
     finally:
         stop_xandikos_server(conn_details)
 
+def test_object_cache():
+    conn_details = start_xandikos_server()
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            ctx = MagicMock()
+            ctx.obj = dict()
+            ctx.obj['calendars'] = find_calendars(conn_details, raise_errors=True)
+            ctx.obj['cache'] = True
+            ctx.obj['cache_dir'] = cache_dir
+
+            _add_todo(ctx, summary=['cache me'], set_uid='cached1')
+            _add_todo(ctx, summary=['cache me too'], set_uid='cached2')
+
+            ## First run populates the cache
+            _select(ctx, all=True)
+            assert len(ctx.obj['objs']) == 2
+            assert len(os.listdir(cache_dir)) == 1
+
+            ## A new process should be able to use the cache file,
+            ## and only changes should be fetched from the server
+            ctx.obj.pop('object_caches')
+            _add_todo(ctx, summary=['cache me as well'], set_uid='cached3')
+            cache = _object_cache(ctx, ctx.obj['calendars'][0])
+            assert len(cache.entries) == 3
+            assert cache.sync(force=True) == (0, 0)
+
+            _select(ctx, uid=['cached2'])
+            assert len(ctx.obj['objs']) == 1
+            assert ctx.obj['objs'][0].icalendar_component['SUMMARY'] == 'cache me too'
+
+            ## Changes and deletions should be picked up
+            ctx.obj['objs'][0].icalendar_component['SUMMARY'] = 'cached and changed'
+            ctx.obj['objs'][0].save()
+            ctx.obj['calendars'][0].object_by_uid('cached1').delete()
+            assert cache.sync() == (1, 1)
+            _select(ctx, all=True)
+            assert {str(x.icalendar_component['SUMMARY']) for x in ctx.obj['objs']} == {'cached and changed', 'cache me as well'}
+
+            ## With max_staleness, the server should not be contacted
+            cache.max_staleness = timedelta(hours=1)
+            with patch.object(ctx.obj['calendars'][0], 'objects_by_sync_token') as _sync:
+                _select(ctx, all=True)
+                assert not _sync.called
+            assert len(ctx.obj['objs']) == 2
+
+            ## ... unless plann itself has changed the calendar since the last sync
+            with patch('plann.cache.default_cache_dir', return_value=cache_dir):
+                _add_todo(ctx, summary=['cache me later'], set_uid='cached4')
+            _select(ctx, all=True)
+            assert len(ctx.obj['objs']) == 3
+            with patch.object(ctx.obj['calendars'][0], 'objects_by_sync_token') as _sync:
+                _select(ctx, all=True)
+                assert not _sync.called
+
+            ## Filtered searches should be evaluated over the cache
+            with patch.object(ctx.obj['calendars'][0], 'search') as _search:
+                _select(ctx, todo=True, summary='changed')
+                assert not _search.called
+            assert len(ctx.obj['objs']) == 1
+    finally:
+        stop_xandikos_server(conn_details)
+
+def test_object_cache_without_sync_token():
+    conn_details = start_xandikos_server()
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            ctx = MagicMock()
+            ctx.obj = dict()
+            ctx.obj['calendars'] = find_calendars(conn_details, raise_errors=True)
+            calendar = ctx.obj['calendars'][0]
+            _add_todo(ctx, summary=['cache me'], set_uid='nosync1')
+            _add_todo(ctx, summary=['cache me too'], set_uid='nosync2')
+
+            ## A server not supporting sync-collection
+            with patch.object(calendar, 'objects_by_sync_token', side_effect=caldav.error.ReportError('not supported')):
+                cache = ObjectCache(calendar, cache_dir)
+                assert cache.sync() == (2, 0)
+                assert cache.sync_token is None
+                assert {x['uid'] for x in cache.entries.values()} == {'nosync1', 'nosync2'}
+
+                ## Only changed objects should be fetched
+                assert cache.sync(force=True) == (0, 0)
+                obj = calendar.object_by_uid('nosync2')
+                obj.icalendar_component['SUMMARY'] = 'changed'
+                obj.save()
+                calendar.object_by_uid('nosync1').delete()
+                with patch('plann.cache._multiget', wraps=plann.cache._multiget) as _multiget:
+                    assert cache.sync(force=True) == (1, 1)
+                    assert len(list(_multiget.call_args.args[1])) == 1
+                assert [x.icalendar_component['SUMMARY'] for x in cache.objects()] == ['changed']
+    finally:
+        stop_xandikos_server(conn_details)
+
+def test_discovery_cache():
+    conn_details = start_xandikos_server()
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            discovery_cache = DiscoveryCache(cache_dir, ttl=timedelta(hours=1))
+            calendars = find_calendars(conn_details, raise_errors=True, discovery_cache=discovery_cache)
+            assert calendars
+            assert 'VTODO' in calendars[0].supported_components
+
+            ## Warm run, the server should not be contacted
+            discovery_cache = DiscoveryCache(cache_dir, ttl=timedelta(hours=1))
+            with patch('plann.lib._dav_principal') as _principal:
+                cached = find_calendars(conn_details, raise_errors=True, discovery_cache=discovery_cache)
+                assert not _principal.called
+            assert [str(x.url) for x in cached] == [str(x.url) for x in calendars]
+            assert cached[0].supported_components == calendars[0].supported_components
+
+            ctx = MagicMock()
+            ctx.obj = dict()
+            ctx.obj['calendars'] = cached
+            ctx.obj['discovery_cache'] = discovery_cache
+            _add_todo(ctx, summary=['discover me'])
+            _select(ctx, todo=True)
+            assert len(ctx.obj['objs']) == 1
+
+            ## Calendars not supporting the component type are skipped
+            cached[0].supported_components = ['VEVENT']
+            with patch.object(cached[0], 'search') as _search:
+                _select(ctx, todo=True)
+                assert not _search.called
+
+            ## A deleted calendar should invalidate the cache entry
+            cached[0].supported_components = None
+            cached[0].delete()
+            _select(ctx, todo=True)
+            assert not ctx.obj['objs']
+            assert DiscoveryCache(cache_dir, ttl=timedelta(hours=1)).entries == {}
+    finally:
+        stop_xandikos_server(conn_details)
+
+def test_bulk_upload():
+    conn_details = start_xandikos_server()
+    try:
+        calendar = find_calendars(conn_details, raise_errors=True)[0]
+        data = "BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:-//plann//test//EN\n"
+        for i in range(20):
+            data += f"BEGIN:VTODO\nUID:bulk-{i}\nDTSTAMP:20230101T100000Z\nSUMMARY:bulk task {i}\nEND:VTODO\n"
+        data += "END:VCALENDAR\n"
+        report = BulkWriter([calendar], concurrency=4, progress=False).upload(split_vcalendars(data.split("\n")))
+        assert (report.stored, report.failures) == (20, [])
+        assert len(calendar.todos()) == 20
+
+        ## Uploading the same data again with If-None-Match, nothing should be stored
+        report = BulkWriter([calendar], overwrite=False, progress=False).upload(split_vcalendars(data.split("\n")))
+        assert (report.stored, report.skipped, report.failures) == (0, 20, [])
+        assert str(calendar.todo_by_uid('bulk-3').icalendar_component['SUMMARY']) == 'bulk task 3'
+
+        ## Objects may be fetched by UID in bulk
+        found = fetch_by_uids(calendar, ['bulk-1', 'bulk-2', 'nonexistent'])
+        assert sorted(found) == ['bulk-1', 'bulk-2']
+        assert str(found['bulk-2'].icalendar_component['SUMMARY']) == 'bulk task 2'
+
+        ## Bulk delete, an object changed after it was selected should not be deleted
+        ctx = MagicMock()
+        ctx.obj = dict()
+        ctx.obj['calendars'] = [calendar]
+        _select(ctx, todo=True)
+        assert all(object_etag(x) for x in ctx.obj['objs'])
+        changed = calendar.todo_by_uid('bulk-3')
+        changed.icalendar_component['SUMMARY'] = 'changed'
+        changed.save()
+        report = BulkWriter([calendar], progress=False).delete(ctx.obj['objs'])
+        assert (report.deleted, [x[1] for x in report.failures]) == (19, ['bulk-3'])
+        assert [str(x.icalendar_component['UID']) for x in calendar.todos()] == ['bulk-3']
+    finally:
+        stop_xandikos_server(conn_details)
+
+def test_copy_to():
+    conn_details = start_xandikos_server()
+    try:
+        source = find_calendars(conn_details, raise_errors=True)[0]
+        target = source.client.principal().make_calendar(name="copy target", cal_id="copytarget")
+        ctx = MagicMock()
+        ctx.obj = dict()
+        ctx.obj['calendars'] = [source]
+        _add_todo(ctx, summary=['copy me'])
+        _add_todo(ctx, summary=['copy me too'])
+        _add_todo(ctx, summary=['change me'])
+        target.save_todo(summary='not in source', uid='vanished')
+        target.save_event(summary='not selected', uid='event', dtstart=datetime(2025, 1, 6, 10), dtend=datetime(2025, 1, 6, 11))
+        _select(ctx, todo=True)
+
+        actions = _copy_to(ctx, [target], delete_vanished=True, dry_run=True)
+        assert sorted(x[0] for x in actions) == ['delete', 'put', 'put', 'put']
+        assert len(target.todos()) == 1
+
+        report = _copy_to(ctx, [target], progress=False)
+        assert (report.stored, report.deleted, report.failures) == (3, 0, [])
+        assert len(target.todos()) == 4
+
+        ## Nothing changed - nothing should be uploaded
+        report = _copy_to(ctx, [target], progress=False)
+        assert (report.stored, report.skipped) == (0, 3)
+
+        ## One changed object is uploaded, the vanished one deleted
+        changed = [x for x in ctx.obj['objs'] if 'change' in x.data][0]
+        changed.icalendar_component['SUMMARY'] = 'changed'
+        changed.save()
+        _select(ctx, todo=True)
+        report = _copy_to(ctx, [target], delete_vanished=True, progress=False)
+        assert (report.stored, report.deleted, report.skipped, report.failures) == (1, 1, 2, [])
+        assert sorted(str(x.icalendar_component['SUMMARY']) for x in target.todos()) == ['changed', 'copy me', 'copy me too']
+        ## The event was not matched by the selection, and is kept
+        assert [str(x.icalendar_component['UID']) for x in target.events()] == ['event']
+
+        ## With an expanded selection, the recurring object should be
+        ## copied rather than the recurrences
+        source.save_event(summary='weekly', uid='weekly', dtstart=datetime(2025, 1, 6, 10), dtend=datetime(2025, 1, 6, 11), rrule={'FREQ': 'WEEKLY'})
+        _select(ctx, event=True, start='2025-01-01', end='2025-02-01')
+        assert len(ctx.obj['objs']) == 4
+        report = _copy_to(ctx, [target], progress=False)
+        assert (report.stored, report.failures) == (1, [])
+        copied = target.event_by_uid('weekly').icalendar_component
+        assert 'RRULE' in copied and 'RECURRENCE-ID' not in copied
+        assert _copy_to(ctx, [target], progress=False).skipped == 1
+
+        ## Objects in the target can't be matched against a selection by uid
+        _select(ctx, uid=[str(changed.icalendar_component['UID'])])
+        with pytest.raises(click.Abort):
+            _copy_to(ctx, [target], delete_vanished=True)
+
+        ## Copying a calendar to itself is not allowed
+        with pytest.raises(click.Abort):
+            _copy_to(ctx, [source])
+    finally:
+        stop_xandikos_server(conn_details)
+
+def test_check_relations():
+    conn_details = start_xandikos_server()
+    try:
+        calendar = find_calendars(conn_details, raise_errors=True)[0]
+        ctx = MagicMock()
+        ctx.obj = dict()
+        ctx.obj['calendars'] = [calendar]
+        def todo(uid, related_to):
+            ## One-way relations can't be made through the caldav library
+            calendar.save_todo(f"BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:-//plann//test//EN\nBEGIN:VTODO\nUID:{uid}\nDTSTAMP:20230101T100000Z\nSUMMARY:{uid}\n{related_to}END:VTODO\nEND:VCALENDAR\n")
+        todo('parent', 'RELATED-TO;RELTYPE=CHILD:child\n')
+        todo('child', '')
+        todo('orphan', 'RELATED-TO;RELTYPE=PARENT:nonexistent\n')
+        _select(ctx, all=True)
+
+        (graph, issues, report) = _check_relations(ctx)
+        assert sorted(x[0] for x in issues) == ['dangling', 'missing']
+        assert report is None
+
+        (graph, issues, report) = _check_relations(ctx, fix=True, remove_dangling=True, progress=False)
+        assert (report.stored, report.failures) == (2, [])
+        _select(ctx, all=True)
+        (graph, issues, report) = _check_relations(ctx)
+        assert not issues
+        assert calendar.todo_by_uid('child').get_relatives(fetch_objects=False) == {'PARENT': {'parent'}}
+    finally:
+        stop_xandikos_server(conn_details)
+
 ## TODO:
 ## Things to be tested: lib._procrastinate, cli._select, cli._cats, cli._list, cli._interactive_edit, cli._set_something, cli._interactive_ical_edit, cli._edit, cli._check_for_panic, _add_todo, _agenda, _check_due,
@@ -0,0 +1,129 @@
+import logging
+
+import icalendar
+from caldav import Event, Todo
+
+from plann.ics import (
+    add_uid,
+    as_vcalendar,
+    components,
+    generated_uid,
+    insert_before_end,
+    object_uid,
+    same_content,
+    sequence,
+    split_vcalendars,
+    vcalendar_chunks,
+)
+
+vtimezone = """BEGIN:VTIMEZONE
+TZID:Europe/Oslo
+BEGIN:STANDARD
+DTSTART:19701025T030000
+TZOFFSETFROM:+0200
+TZOFFSETTO:+0100
+END:STANDARD
+END:VTIMEZONE
+"""
+
+def _obj(cls, uid, comp='VEVENT', tz=True):
+    obj = cls()
+    obj.data = f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//Example Corp.//CalDAV Client//EN
+{vtimezone if tz else ''}BEGIN:{comp}
+UID:{uid}
+DTSTAMP:20230101T100000Z
+DTSTART;TZID=Europe/Oslo:20230102T100000
+SUMMARY:A long summary that will be folded when serialized by the icalendar library, as lines should be max 75 octets
+END:{comp}
+END:VCALENDAR
+"""
+    return obj
+
+def test_components():
+    comps = list(components(_obj(Event, 'e1').data))
+    assert [x[0] for x in comps] == ['VTIMEZONE', 'VEVENT']
+    assert comps[0][1].startswith("BEGIN:VTIMEZONE\r\n")
+    assert comps[0][1].endswith("END:VTIMEZONE\r\n")
+    assert "BEGIN:STANDARD" in comps[0][1]
+
+def test_vcalendar_chunks():
+    objs = [_obj(Event, 'e1'), _obj(Todo, 't1', 'VTODO'), _obj(Event, 'e2', tz=False)]
+    ics = "".join(vcalendar_chunks(objs))
+    assert ics.startswith("BEGIN:VCALENDAR\r\n")
+    assert ics.endswith("END:VCALENDAR\r\n")
+    assert ics.count("BEGIN:VCALENDAR") == 1
+    assert ics.count("BEGIN:VTIMEZONE") == 1
+    assert ics.count("BEGIN:VEVENT") == 2
+    assert ics.count("BEGIN:VTODO") == 1
+    ## The objects should not be modified
+    assert objs[0].data.count("BEGIN:VEVENT") == 1
+
+    ics = "".join(vcalendar_chunks(objs, filter=lambda x: isinstance(x, Todo)))
+    assert "UID:t1" in ics
+    assert "UID:e1" not in ics
+
+def test_split_vcalendars(caplog):
+    ics = "".join(vcalendar_chunks([_obj(Event, 'e1'), _obj(Todo, 't1', 'VTODO', tz=False)]))
+    ## a recurrence exception should be kept together with the master
+    ics = ics.replace("END:VCALENDAR", """BEGIN:VEVENT
+UID:t1
+RECURRENCE-ID:20230102T100000Z
+SUMMARY:exception
+END:VEVENT
+BEGIN:VEVENT
+UID:very-long-uid-which-is-fol
+ ded
+BEGIN:VALARM
+UID:alarm-uid
+ACTION:DISPLAY
+END:VALARM
+END:VEVENT
+BEGIN:VEVENT
+UID:e1
+SUMMARY:not adjacent
+END:VEVENT
+END:VCALENDAR""")
+    ## and one more VCALENDAR
+    ics += "\n" + _obj(Event, 'e3').data
+    with caplog.at_level(logging.WARNING):
+        icals = list(split_vcalendars(ics.splitlines(keepends=True)))
+    assert 'e1 found in non-adjacent' in caplog.text
+    cals = [icalendar.Calendar.from_ical(x) for x in icals]
+    uids = [[str(y['UID']) for y in x.subcomponents if y.name != 'VTIMEZONE'] for x in cals]
+    assert uids == [['e1'], ['t1', 't1'], ['very-long-uid-which-is-folded'], ['e1'], ['e3']]
+    ## VTIMEZONEs only where needed
+    assert [len([y for y in x.subcomponents if y.name == 'VTIMEZONE']) for x in cals] == [1, 1, 0, 0, 1]
+    assert all(x['PRODID'] for x in cals)
+
+def test_split_non_vcalendar():
+    assert list(split_vcalendars(["", "BEGIN:VEVENT", "UID:x", "END:VEVENT"])) == ["BEGIN:VEVENT\nUID:x\nEND:VEVENT"]
+    assert list(split_vcalendars([])) == []
+
+def test_objects_without_uid():
+    ics = "BEGIN:VCALENDAR\nVERSION:2.0\nBEGIN:VTODO\nSUMMARY:a\nEND:VTODO\nBEGIN:VJOURNAL\nSUMMARY:b\nEND:VJOURNAL\nEND:VCALENDAR\n"
+    icals = list(split_vcalendars(ics.splitlines()))
+    assert len(icals) == 2
+    uids = [generated_uid(x) for x in icals]
+    assert uids[0] != uids[1] and uids[0] == generated_uid(icals[0])
+    with_uid = add_uid(icals[1], uids[1])
+    assert object_uid(with_uid) == uids[1]
+    assert [name for (name, block) in components(with_uid)] == ['VJOURNAL']
+    bare = as_vcalendar("BEGIN:VEVENT\nSUMMARY:c\nEND:VEVENT")
+    assert as_vcalendar(bare) == bare
+    assert object_uid(add_uid(bare, 'c')) == 'c'
+
+def test_insert_before_end():
+    assert list(insert_before_end(["BEGIN:VTODO", "END:VTODO"], "CATEGORIES:foo\nPRIORITY:1")) == ["BEGIN:VTODO", "CATEGORIES:foo", "PRIORITY:1", "END:VTODO"]
+
+def test_same_content_and_sequence():
+    data = _obj(Event, 'e1').data
+    ## Property order and VTIMEZONEs does not matter
+    reordered = _obj(Event, 'e1', tz=False).data.replace("UID:e1\n", "").replace("END:VEVENT", "UID:e1\nEND:VEVENT")
+    assert same_content(data, reordered)
+    assert same_content(data, data.replace("DTSTAMP:20230101T100000Z", "DTSTAMP:20240101T100000Z"))
+    assert not same_content(data, data.replace("UID:e1", "UID:e2"))
+    assert sequence(data) == 0
+    assert sequence(data.replace("UID:e1", "UID:e1\nSEQUENCE:3")) == 3
+    assert object_uid(data) == 'e1'
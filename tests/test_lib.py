@@ -1,3 +1,4 @@
+import threading
 from datetime import datetime, timedelta, timezone
 from unittest.mock import patch
 
@@ -5,8 +6,13 @@ import pytest
 from caldav import Calendar, Todo
 
 from plann.lib import (
+    LazyDict,
     _add_category,
     _adjust_ical_relations,
+    _dav_client,
+    _list,
+    _parallel_imap,
+    _parallel_map,
     _procrastinate,
     _set_something,
     _split_vcal,
@@ -14,6 +20,7 @@ from plann.lib import (
     add_time_tracking,
     add_time_tracking_timew,
 )
+from tests.helpers import calendar_object
 
 utc=timezone.utc
 todo = """BEGIN:VCALENDAR
@@ -33,6 +40,73 @@ END:VCALENDAR"""
 
 ## find_calendars tested in test_functional.py
 
+def test_lazy_dict():
+    calls = []
+    def discover():
+        calls.append(1)
+        return ['cal1', 'cal2']
+    d = LazyDict(foo='bar')
+    d.lazy['calendars'] = discover
+    assert d['foo'] == 'bar'
+    assert not calls
+    assert d.get('missing', 3) == 3
+    assert d['calendars'] == ['cal1', 'cal2']
+    assert d.get('calendars') == ['cal1', 'cal2']
+    assert len(calls) == 1
+    with pytest.raises(KeyError):
+        d['missing']
+
+def test_parallel_map():
+    barrier = threading.Barrier(4, timeout=5)
+    def slow_square(x):
+        ## would time out if the calls weren't done concurrently
+        barrier.wait()
+        return x*x
+    assert _parallel_map(slow_square, range(4), parallelism=4) == [0, 1, 4, 9]
+    assert _parallel_map(lambda x: x+1, [3, 1, 2], parallelism=1) == [4, 2, 3]
+    def fail(x):
+        raise ValueError(x)
+    with pytest.raises(ValueError):
+        _parallel_map(fail, range(3))
+
+def test_parallel_imap():
+    started = []
+    def square(x):
+        started.append(x)
+        return x*x
+    results = _parallel_imap(square, range(4), parallelism=1)
+    assert next(results) == 0
+    ## Nothing more is done before it's needed
+    assert started == [0]
+    assert list(results) == [1, 4, 9]
+    assert list(_parallel_imap(square, range(4), parallelism=4)) == [0, 1, 4, 9]
+
+def test_dav_client_shared():
+    params = {'url': 'https://example.com/dav/', 'username': 'alice', 'password': 'secret'}
+    with patch.dict('plann.lib._dav_clients', clear=True), patch('caldav.DAVClient', side_effect=lambda **kwargs: object()) as client:
+        shared = _dav_client(params)
+        assert _dav_client(dict(reversed(params.items()))) is shared
+        ## Other credentials or connection settings should give another client
+        assert _dav_client({**params, 'password': 'other'}) is not shared
+        assert _dav_client({**params, 'ssl_verify_cert': False}) is not shared
+        assert client.call_count == 3
+
+def test_list_streaming():
+    def objs():
+        for summary in ('first', 'second'):
+            t = Todo(parent=Calendar(url='http://example.com/cal/'))
+            t.data = todo.replace('Fix a party', summary).replace('UID:', f'UID:{summary}-')
+            yield t
+        raise RuntimeError("the first line should be output before this")
+    with patch('click.echo_via_pager') as pager:
+        _list(objs(), template="{SUMMARY}")
+        lines = pager.call_args[0][0]
+        assert next(lines) == "first\n"
+        assert next(lines) == "second\n"
+        with pytest.raises(RuntimeError):
+            next(lines)
+    assert _list([], echo=False) == []
+
 def test_summary():
     t = Todo()
     t.data = todo
@@ -100,6 +174,51 @@ def test_procrastinate_without_relations():
             timearg = set_due_mocked.call_args[0][0]
             assert(timearg.astimezone(utc) == future+timedelta(days=10))
 
+def _task(uid, due, extra=""):
+    return calendar_object(Todo, uid, f"DUE:{due}\n{extra}", summary=f"task {uid}", parent=Calendar())
+
+def test_procrastinate_family():
+    parent = _task('p', '20530110T100000Z', 'PRIORITY:5\nRELATED-TO;RELTYPE=CHILD:c1\nRELATED-TO;RELTYPE=CHILD:c2')
+    c1 = _task('c1', '20530105T100000Z', 'PRIORITY:3\nRELATED-TO;RELTYPE=PARENT:p\nRELATED-TO;RELTYPE=CHILD:gc')
+    c2 = _task('c2', '20530106T100000Z', 'RELATED-TO;RELTYPE=PARENT:p')
+    gc = _task('gc', '20530104T100000Z', 'RELATED-TO;RELTYPE=PARENT:c1')
+    def fetch_by_uids(calendar, uids):
+        return {x: y for (x, y) in {'p': parent, 'c1': c1, 'c2': c2, 'gc': gc}.items() if x in uids}
+    def dues(plan):
+        return {str(obj.icalendar_component['UID']): new_due.strftime('%F') for (obj, old_due, new_due) in plan}
+
+    with patch('plann.relations.fetch_by_uids', side_effect=fetch_by_uids) as fetch:
+        ## The relatives are fetched in bulk, one fetch per level
+        plan = _procrastinate([parent, c1], '1d', with_children=True, dry_run=True)
+        assert dues(plan) == {'p': '2053-01-11', 'c1': '2053-01-06', 'c2': '2053-01-07', 'gc': '2053-01-05'}
+        assert [set(x.args[1]) for x in fetch.call_args_list] == [{'c2'}, {'gc'}]
+        assert c1.icalendar_component['DUE'].dt.day == 5
+
+        ## Whole family tree, starting from the grandchild
+        assert len(_procrastinate([gc], '1d', with_family=True, dry_run=True)) == 4
+
+        ## The child can't be postponed past the parent due ...
+        errors = []
+        assert not _procrastinate([c1], '10d', err_callback=errors.append, dry_run=True)
+        assert 'could not be postponed due to parent' in errors[0]
+
+        ## ... unless the parent is postponed as well
+        plan = _procrastinate([c1], '10d', check_dependent='interactive', err_callback=errors.append, dry_run=True)
+        assert dues(plan) == {'p': '2053-01-15', 'c1': '2053-01-15'}
+
+        with patch.object(Todo, 'save') as save:
+            plan = _procrastinate([c2], '1d')
+            assert c2.icalendar_component['DUE'].dt.day == 7
+            assert save.call_count == 1
+
+def test_procrastinate_loop():
+    a = _task('a', '20530110T100000Z', 'RELATED-TO;RELTYPE=PARENT:b\nRELATED-TO;RELTYPE=CHILD:b')
+    b = _task('b', '20530110T100000Z', 'RELATED-TO;RELTYPE=PARENT:a\nRELATED-TO;RELTYPE=CHILD:a')
+    errors = []
+    plan = _procrastinate([a, b], '1d', with_family=True, check_dependent=False, err_callback=errors.append, dry_run=True)
+    assert len(plan) == 2
+    assert 'loop' in errors[0]
+
 def test_adjust_ical_relations():
     t = Todo()
     t.data = todo
@@ -131,9 +250,6 @@ def test_adjust_ical_relations():
     assert(rels['PARENT'] == {'PARENT-A0', 'PARENT-A2', 'PARENT-B0', 'PARENT-B2'})
     assert(rels['CHILD'] == {'CHILD-A0', 'CHILD-A1', 'CHILD-A2'})
 
-#def test_split_vcals():
-## TODO
-
 def test_split_vcal():
     ## This VCALENDAR contains three events, but only two separate
     ## event components as one of the events is a recurrence object.
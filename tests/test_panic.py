@@ -1,10 +1,13 @@
-from datetime import datetime, timedelta
+import random
+from datetime import datetime, timedelta, timezone
 from unittest import mock
 
+import pytest
 from caldav import Event, Todo
 from caldav.lib.vcal import create_ical
 
 from plann import panic_planning
+from tests.helpers import event
 
 
 def datetime_(*largs, **kwargs):
@@ -78,6 +81,219 @@ def test_timeline_add():
     assert timeline[2]['obj'] == '14'
     assert timeline[3]['begin'] == t(15)
 
+def _find_opening_by_walking(timeline, last_possibility, duration, slack_balance=timedelta(0)):
+    ## The original implementation, stepping backwards one slot at the time
+    end = last_possibility-duration
+    while True:
+        foo = timeline.get(end)
+        if len(foo) == 2:
+            if 'end' in foo and 'begin' in foo:
+                foodur = foo['end']-foo['begin']
+                if foodur > duration:
+                    return (foo, slack_balance)
+                slack_balance += foodur
+        if 'begin' not in foo or 'end' not in foo:
+            return (foo, slack_balance)
+        end = foo['begin']-timedelta(seconds=1)
+
+def test_find_opening_random():
+    rnd = random.Random(42)
+    start = datetime_(year=2025, month=1, day=1)
+    for attempt in range(20):
+        timeline = panic_planning.TimeLine()
+        for i in range(200):
+            begin = start + timedelta(minutes=rnd.randrange(0, 60*24*30))
+            try:
+                timeline.add(begin, begin + timedelta(minutes=rnd.randrange(1, 600)), i)
+            except AssertionError:
+                ## overlapping
+                pass
+        ## The gap index should match the free slots on the timeline
+        gaps = [(x['begin'], y['begin']) for (x, y) in zip(timeline, timeline[1:]) if 'obj' not in x]
+        assert len(timeline._gaps) == len(gaps)
+        for i in range(50):
+            last_possibility = start + timedelta(minutes=rnd.randrange(-600, 60*24*32))
+            duration = timedelta(minutes=rnd.randrange(1, 900))
+            assert timeline.find_opening(last_possibility, duration) == _find_opening_by_walking(timeline, last_possibility, duration)
+        timeline.pad_slack(start + timedelta(days=20), timedelta(days=3))
+        assert sum((y['begin']-x['begin'] for (x, y) in zip(timeline, timeline[1:]) if x.get('obj') == 'slack'), timedelta(0)) == timedelta(days=3)
+
+def test_array_timeline():
+    ## The ArrayTimeLine should behave exactly like the TimeLine
+    rnd = random.Random(7)
+    start = datetime_(year=2025, month=1, day=1)
+    for attempt in range(10):
+        timeline = panic_planning.TimeLine()
+        compact = panic_planning.ArrayTimeLine()
+        for i in range(200):
+            begin = start + timedelta(minutes=rnd.randrange(0, 60*24*30))
+            end = begin + timedelta(minutes=rnd.randrange(1, 600))
+            obj = rnd.choice((i, None, 'slack'))
+            results = []
+            for tl in (timeline, compact):
+                try:
+                    tl.add(begin, end, obj)
+                    results.append('added')
+                except AssertionError:
+                    ## overlapping
+                    results.append('overlap')
+            assert results[0] == results[1]
+        assert list(compact) == list(timeline)
+        assert (len(compact), compact.count(), compact.slack()) == (len(timeline), timeline.count(), timeline.slack())
+        assert compact[-1] == timeline[-1] and compact[1:3] == timeline[1:3]
+        for i in range(50):
+            ts = start + timedelta(minutes=rnd.randrange(-600, 60*24*32))
+            assert compact.get(ts) == timeline.get(ts)
+            duration = timedelta(minutes=rnd.randrange(1, 900))
+            assert compact.find_opening(ts, duration) == timeline.find_opening(ts, duration)
+        timeline.pad_slack(start + timedelta(days=20), timedelta(days=3))
+        compact.pad_slack(start + timedelta(days=20), timedelta(days=3))
+        assert list(compact) == list(timeline)
+        assert compact.slack() == timeline.slack()
+
+def _event(uid, dtstart, dtend, extra=""):
+    return event(uid, f"DTSTART:{dtstart}\nDTEND:{dtend}\n{extra}", summary=uid, url=f"https://example.com/{uid}.ics")
+
+def test_busy_intervals():
+    def t(day, hour, minute=0):
+        return datetime(2025, 3, day, hour, minute, tzinfo=timezone.utc)
+    a = _event('a', '20250303T100000Z', '20250303T120000Z')
+    b = _event('b', '20250303T110000Z', '20250303T130000Z')
+    c = _event('c', '20250303T113000Z', '20250303T114500Z')
+    d = _event('d', '20250303T130000Z', '20250303T140000Z')
+    cancelled = _event('x', '20250303T080000Z', '20250303T090000Z', "STATUS:CANCELLED\n")
+    ## Weekly on mondays, the second occurrence is excepted
+    weekly = _event('w', '20250303T150000Z', '20250303T160000Z', "RRULE:FREQ=WEEKLY;COUNT=1000\nEXDATE:20250310T150000Z\n")
+    (intervals, overlaps) = panic_planning.busy_intervals([d, cancelled, c, b, a, weekly], t(1, 0), t(31, 0))
+    assert intervals == [
+        (t(3, 10), t(3, 12), a), (t(3, 12), t(3, 13), b), (t(3, 13), t(3, 14), d),
+        (t(3, 15), t(3, 16), weekly), (t(17, 15), t(17, 16), weekly),
+        (t(24, 15), t(24, 16), weekly)]
+    assert overlaps == [
+        (t(3, 11), t(3, 11, 30), (a, b)),
+        (t(3, 11, 30), t(3, 11, 45), (a, b, c)),
+        (t(3, 11, 45), t(3, 12), (a, b))]
+
+    ## The overlapping events take the right amount of time on the timeline
+    ctx = mock.Mock()
+    ctx.obj = {'objs': [a, b, c, d, weekly]}
+    with mock.patch('plann.panic_planning._now', return_value=t(1, 0)):
+        timeline = panic_planning.timeline_suggestion(ctx, timeline_end=t(31, 0))
+    assert [(x['begin'], x.get('obj')) for x in timeline][:4] == [(t(3, 10), a), (t(3, 12), b), (t(3, 13), d), (t(3, 14), None)]
+    ## The weekly event is counted once
+    assert timeline.count() == 4
+    assert len(timeline.overlaps) == 3
+
+def test_expand_plain():
+    ## The dateutil shortcut should give the same occurrences as recurring_ical_events
+    def recurring(rules):
+        return event('r', f"DTSTART;TZID=Europe/Oslo:20250103T100000\nDTEND;TZID=Europe/Oslo:20250103T113000\n{rules}", url="https://example.com/r.ics")
+    start = datetime(2025, 1, 10, 10, 30, tzinfo=timezone.utc)
+    end = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    for rules in (
+            "RRULE:FREQ=WEEKLY\n",
+            "RRULE:FREQ=DAILY;COUNT=100;BYDAY=MO,WE\nEXDATE;TZID=Europe/Oslo:20250113T100000,20250115T100000\nEXDATE:20250120T090000Z\n",
+            "RRULE:FREQ=MONTHLY;UNTIL=20251010T000000Z\nRDATE:20250105T120000Z\n"):
+        obj = recurring(rules)
+        comp = obj.icalendar_component
+        spans = panic_planning._expand_plain(obj, comp, start, end)
+        expected = [panic_planning._span(x) for x in panic_planning.recurring_ical_events.of(obj.icalendar_instance).between(start, end)]
+        assert spans and sorted(spans) == sorted(expected)
+    ## UNTIL given as a date is left to recurring_ical_events
+    obj = recurring("RRULE:FREQ=WEEKLY;UNTIL=20250601\n")
+    assert panic_planning._expand_plain(obj, obj.icalendar_component, start, end) is None
+
+def test_parse_working_hours():
+    h = timedelta(hours=1)
+    assert panic_planning.parse_working_hours(['09:00-17:00 mon-fri']) == {None: [(day, 9*h, 17*h) for day in range(5)]}
+    assert panic_planning.parse_working_hours(['Home=18:00-22:00 fri-sun, 22:00-02:00', '08:00-12:00 Tuesday']) == {
+        'home': [(4, 18*h, 22*h), (5, 18*h, 22*h), (6, 18*h, 22*h)] + [(day, 22*h, 26*h) for day in range(7)],
+        None: [(1, 8*h, 12*h)]}
+    for spec in ('09:00 mon', '09:00-25:00', '9-17', '09:00-17:00 someday'):
+        with pytest.raises(ValueError):
+            panic_planning.parse_working_hours([spec])
+
+def test_available_time():
+    start = datetime_(year=2025, month=3, day=5, hour=12)
+    windows = panic_planning.parse_working_hours(['09:00-17:00 mon-fri'])[None]
+    holiday = _event('holiday', '20250307', '20250308')
+    holiday.icalendar_component['DTSTART'].params['VALUE'] = 'DATE'
+    available = panic_planning.available_time(windows, start, start + timedelta(days=7), [holiday])
+    assert available == [
+        (start, datetime_(year=2025, month=3, day=5, hour=17)),
+        (datetime_(year=2025, month=3, day=6, hour=9), datetime_(year=2025, month=3, day=6, hour=17)),
+        (datetime_(year=2025, month=3, day=10, hour=9), datetime_(year=2025, month=3, day=10, hour=17)),
+        (datetime_(year=2025, month=3, day=11, hour=9), datetime_(year=2025, month=3, day=11, hour=17)),
+        (datetime_(year=2025, month=3, day=12, hour=9), start + timedelta(days=7))]
+
+def test_timeline_suggestion_working_hours():
+    now = datetime_(year=2025, month=3, day=3, hour=8)
+    def t(day, hour):
+        return datetime_(year=2025, month=3, day=day, hour=hour)
+    def task(uid, due, hours, categories=None):
+        ical = create_ical(objtype='VTODO', uid=uid, summary=uid, dtstart=due-timedelta(hours=hours), due=due, categories=categories)
+        return Todo(client=None, url=f"https://example.com/{uid}", data=ical)
+    ## One hour meeting in the working hours monday, and one in the evening
+    meeting = _event('meeting', f"{t(3, 10).astimezone(timezone.utc):%Y%m%dT%H%M%SZ}", f"{t(3, 11).astimezone(timezone.utc):%Y%m%dT%H%M%SZ}")
+    evening = _event('evening', f"{t(3, 20).astimezone(timezone.utc):%Y%m%dT%H%M%SZ}", f"{t(3, 21).astimezone(timezone.utc):%Y%m%dT%H%M%SZ}")
+    ## Twelve hours to be done before wednesday lunch, and two hours in the evening
+    big = task('big', t(5, 12), 12)
+    home = task('home', t(4, 23), 2, ['home'])
+    late = task('late', t(3, 12), 5)
+    ctx = mock.Mock()
+    ctx.obj = {'objs': [meeting, evening, big, home, late]}
+    working_hours = panic_planning.parse_working_hours(['09:00-17:00 mon-fri', 'home=18:00-22:00'])
+    for compact in (False, True):
+        with mock.patch('plann.panic_planning._now', return_value=now):
+            timeline = panic_planning.timeline_suggestion(ctx, timeline_end=now+timedelta(days=30), working_hours=working_hours, compact=compact)
+        taken = {}
+        for (x, y) in zip(timeline, timeline[1:]):
+            if 'obj' in x:
+                taken.setdefault(x['obj'].icalendar_component['UID'], []).append((x['begin'], y['begin']))
+        ## big is split over the working hours before the due, the latest hours first
+        assert taken['big'] == [(t(3, 16), t(3, 17)), (t(4, 9), t(4, 17)), (t(5, 9), t(5, 12))]
+        assert taken['home'] == [(t(4, 20), t(4, 22))]
+        assert taken['meeting'] == [(t(3, 10), t(3, 11))]
+        ## late doesn't fit, the rest of it goes before the timeline
+        assert taken['late'] == [(t(3, 5), t(3, 8)), (t(3, 9), t(3, 10)), (t(3, 11), t(3, 12))]
+
+def test_planner_update():
+    ## Updating the plan should give the same result as planning from scratch
+    now = datetime_(year=2025, month=3, day=3, hour=8)
+    rnd = random.Random(3)
+    def task(i):
+        due = now + timedelta(hours=rnd.randrange(-24, 24*20))
+        ical = create_ical(objtype='VTODO', uid=f"t{i}", summary=f"t{i}", dtstart=due-timedelta(hours=rnd.randrange(1, 10)), due=due, priority=rnd.randrange(1, 10))
+        return Todo(client=None, url=f"https://example.com/t{i}", data=ical)
+    meeting = _event('meeting', f"{now.astimezone(timezone.utc)+timedelta(hours=30):%Y%m%dT%H%M%SZ}", f"{now.astimezone(timezone.utc)+timedelta(hours=32):%Y%m%dT%H%M%SZ}")
+    working_hours = panic_planning.parse_working_hours(['09:00-17:00 mon-fri'])
+    for kwargs in ({}, {'compact': True}, {'working_hours': working_hours}):
+        tasks = [task(i) for i in range(60)]
+        with mock.patch('plann.panic_planning._now', return_value=now):
+            planner = panic_planning.Planner([meeting, *tasks], timeline_end=now+timedelta(days=30), **kwargs)
+            for step in range(5):
+                changed = rnd.sample(tasks, 3)
+                (postponed, reprioritized, completed) = changed
+                postponed.set_due(postponed.get_due() + timedelta(days=2), move_dtstart=True)
+                reprioritized.icalendar_component['PRIORITY'] = rnd.randrange(1, 10)
+                completed.icalendar_component['STATUS'] = 'COMPLETED'
+                uids = [str(x.icalendar_component['UID']) for x in changed]
+                first = min(planner._order.index(planner._tasks[x].key) for x in uids)
+                with mock.patch.object(planner, '_place_task', wraps=planner._place_task) as place:
+                    planner.update(changed)
+                ## Only the changed tasks and the tasks after them are placed again
+                first = min([first] + [planner._order.index(planner._tasks[x].key) for x in uids if x in planner._tasks])
+                assert place.call_count == len(planner._order) - first
+                tasks.remove(completed)
+                expected = panic_planning.Planner([meeting, *tasks], timeline_end=now+timedelta(days=30), **kwargs)
+                assert list(planner.timeline) == list(expected.timeline)
+        ## Removing everything leaves an empty timeline
+        for (added, balance) in reversed(planner._placed):
+            for (timeline, begin) in reversed(added):
+                timeline.remove(begin)
+        planner._placed = []
+        assert list(planner.timeline) == list(panic_planning.Planner([meeting], timeline_end=now+timedelta(days=30), **kwargs).timeline)
+
 def create_obj(comp_class='VTODO', duehour=None, **data):
     if duehour:
         tomorrow = (datetime.now() + timedelta(days=1)).replace(minute=0, second=0)
@@ -96,6 +312,7 @@ def test_timeline_suggestion():
     ctx.obj = {'objs': [pri1, pri2, pri3]}
 
     timeline = panic_planning.timeline_suggestion(ctx, hours_per_day=23)
+    assert list(panic_planning.timeline_suggestion(ctx, hours_per_day=23, compact=True)) == list(timeline)
 
     ## Can we make asserts that are robust enough not to fail should the algorithm change completely?
     ## The only requirement is that it creates a timeline, isn't it?
@@ -0,0 +1,79 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from plann.query import compile_filters, local_search, server_filters, time_range_predicate
+from tests.helpers import event, todo
+
+utc = timezone.utc
+
+def _todo(uid, extra=""):
+    return todo(uid, extra, summary=f"Task {uid}")
+
+def _event(uid, extra=""):
+    return event(uid, extra, summary=f"Event {uid}")
+
+def _uids(objs):
+    return [x.icalendar_component['UID'] for x in objs]
+
+def test_server_filters():
+    filters = {'todo': True, 'event': False, 'no_due': True, 'no_dtstart': False, 'category': 'foo', 'parent': 'abc', 'categories': ('a',), 'timespan': 'x', 'start': 1}
+    assert server_filters(filters) == {'todo': True, 'no_due': True, 'category': 'foo', 'start': 1}
+
+def test_component_type_and_completed():
+    objs = [
+        _todo('pending'),
+        _todo('completed', 'STATUS:COMPLETED\nCOMPLETED:20230102T100000Z'),
+        _todo('cancelled', 'STATUS:CANCELLED'),
+        _todo('needs-action-with-completed', 'STATUS:NEEDS-ACTION\nCOMPLETED:20230102T100000Z'),
+        _event('event')]
+    assert _uids(local_search(objs, todo=True)) == ['pending', 'needs-action-with-completed']
+    assert len(local_search(objs, todo=True, include_completed=True)) == 4
+    assert _uids(local_search(objs, event=True)) == ['event']
+    assert _uids(local_search(objs, todo=False)) == ['event']
+    assert len(local_search(objs)) == 5
+
+def test_text_filters():
+    objs = [
+        _todo('t1', 'CATEGORIES:plann,keyboard\nLOCATION:Oslo office'),
+        _todo('t2', 'CATEGORIES:plannx\nRELATED-TO;RELTYPE=PARENT:t1'),
+        _todo('t3', 'RELATED-TO:t1\nPRIORITY:3')]
+    assert _uids(local_search(objs, location='OSLO')) == ['t1']
+    assert _uids(local_search(objs, category='plann')) == ['t1']
+    assert _uids(local_search(objs, categories=('keyboard', 'PLANN'))) == ['t1']
+    assert _uids(local_search(objs, parent='t1')) == ['t2', 't3']
+    assert _uids(local_search(objs, summary='task t')) == ['t1', 't2', 't3']
+    assert _uids(local_search(objs, no_category=True)) == ['t3']
+    assert _uids(local_search(objs, no_priority=False)) == ['t3']
+    assert _uids(local_search(objs, no_parent=True)) == ['t1']
+    with pytest.raises(NotImplementedError):
+        compile_filters(foo='bar')
+
+def test_time_range():
+    in_range = time_range_predicate(datetime(2023, 1, 10, tzinfo=utc), datetime(2023, 1, 11, tzinfo=utc))
+    def check(obj):
+        return in_range(obj.icalendar_component)
+    assert check(_event('e1', 'DTSTART:20230110T100000Z\nDTEND:20230110T110000Z'))
+    assert check(_event('e2', 'DTSTART:20230109T100000Z\nDTEND:20230112T110000Z'))
+    assert not check(_event('e3', 'DTSTART:20230109T100000Z\nDTEND:20230110T000000Z'))
+    assert check(_event('e4', 'DTSTART;VALUE=DATE:20230110'))
+    assert not check(_event('e5', 'DTSTART;VALUE=DATE:20230109'))
+    assert check(_todo('t1', 'DUE:20230110T100000Z'))
+    assert not check(_todo('t2', 'DUE:20230112T100000Z'))
+    assert check(_todo('t3', 'DTSTART:20230109T100000Z\nDUE:20230112T100000Z'))
+    assert check(_todo('t4'))
+
+    open_ended = time_range_predicate(start=datetime(2023, 1, 10, tzinfo=utc))
+    assert open_ended(_todo('t5', 'DUE:20240110T100000Z').icalendar_component)
+    assert not open_ended(_todo('t6', 'DUE:20220110T100000Z').icalendar_component)
+
+def test_recurrences():
+    objs = [
+        _event('weekly', 'DTSTART:20230102T100000Z\nDTEND:20230102T110000Z\nRRULE:FREQ=WEEKLY'),
+        _event('ended', 'DTSTART:20220103T100000Z\nDTEND:20220103T110000Z\nRRULE:FREQ=WEEKLY;COUNT=3')]
+    start = datetime(2023, 1, 1, tzinfo=utc)
+    end = datetime(2023, 1, 31, tzinfo=utc)
+    assert _uids(local_search(objs, start=start)) == ['weekly']
+    found = local_search(objs, start=start, end=end, expand=True)
+    assert _uids(found) == ['weekly']*5
+    assert all('RRULE' not in x.icalendar_component for x in found)
@@ -0,0 +1,130 @@
+from unittest.mock import patch
+
+from caldav import Calendar
+
+from plann.lib import _list
+from plann.relations import RelationGraph, _loops, check_relations, fix_relations, hierarchy, related_uids
+from tests.helpers import todo
+
+
+def _task(uid, relations=(), calendar=None):
+    rels = "\n".join(f"RELATED-TO;RELTYPE={reltype}:{other}" for (reltype, other) in relations)
+    return todo(uid, rels, summary=f"task {uid}", parent=calendar or Calendar())
+
+def test_related_uids():
+    t = _task('a', [('PARENT', 'p'), ('CHILD', 'c1'), ('CHILD', 'c2')])
+    assert related_uids(t) == {'PARENT': {'p'}, 'CHILD': {'c1', 'c2'}}
+    assert related_uids(t, 'CHILD') == {'CHILD': {'c1', 'c2'}}
+
+def test_graph_reverse_edges():
+    ## p knows about its child c, but c doesn't point back
+    p = _task('p', [('CHILD', 'c')])
+    c = _task('c')
+    s = _task('s', [('SIBLING', 'c')])
+    graph = RelationGraph([p, c, s])
+    assert 'c' in graph and graph.get('c') is c
+    assert graph.related(c) == {}
+    assert graph.relations(c) == {'PARENT': {'p'}, 'SIBLING': {'s'}}
+    assert graph.relations(c, {'CHILD'}) == {}
+    assert graph.relations(p, 'CHILD') == {'CHILD': {'c'}}
+
+    ## Reindexing after a change
+    p.icalendar_component.pop('RELATED-TO')
+    graph.update(p)
+    assert graph.relations(c) == {'SIBLING': {'s'}}
+
+def test_graph_fetches_in_bulk():
+    calendar = Calendar()
+    p = _task('p', [('CHILD', 'c1'), ('CHILD', 'c2')], calendar)
+    c1 = _task('c1', [('PARENT', 'p')], calendar)
+    c2 = _task('c2', [('PARENT', 'p'), ('CHILD', 'gone')], calendar)
+    def fetch_by_uids(calendar, uids):
+        return {x: y for (x, y) in {'p': p, 'c1': c1, 'c2': c2}.items() if x in uids}
+    with patch('plann.relations.fetch_by_uids', side_effect=fetch_by_uids) as fetch:
+        graph = RelationGraph([c1, c2])
+        assert graph.relatives([c1, c2]) == [[p], [p]]
+        assert graph.relatives_by_type(p) == {'CHILD': [c1, c2]}
+        assert graph.relatives([c2], 'CHILD') == [[]]
+        assert graph.relatives([c2], 'CHILD') == [[]]
+        ## p and the missing object were fetched at once, and only once
+        assert [set(x.args[1]) for x in fetch.call_args_list] == [{'p', 'gone'}]
+
+        ## Listing the selection top down only needs one fetch
+        fetch.reset_mock()
+        lines = _list([c2, c1], template="{SUMMARY}", top_down=True, echo=False)
+        assert lines == ['task p', '  task c1', '  task c2']
+        assert [set(x.args[1]) for x in fetch.call_args_list] == [{'p', 'gone'}]
+
+def test_loops():
+    a = _task('a', [('CHILD', 'b')])
+    b = _task('b', [('CHILD', 'c')])
+    c = _task('c', [('PARENT', 'b'), ('CHILD', 'a')])
+    d = _task('d', [('PARENT', 'a')])
+    e = _task('e', [('PARENT', 'e')])
+    assert sorted(_loops(RelationGraph([a, b, c, d, e]))) == [('a', 'b', 'c'), ('e',)]
+    assert not _loops(RelationGraph([a, b, d]))
+
+    ## Deep hierarchies should not hit the recursion limit
+    chain = [_task(f"t{i}", [('PARENT', f"t{i+1}")]) for i in range(2000)]
+    assert not _loops(RelationGraph(chain))
+
+def test_check_and_fix_relations():
+    p = _task('p', [('CHILD', 'c1'), ('CHILD', 'c2')])
+    c1 = _task('c1', [('PARENT', 'p')])
+    c2 = _task('c2', [('PARENT', 'gone')])
+    s = _task('s', [('CHILD', 'c1')])
+    graph = RelationGraph([p, c1, c2, s])
+    with patch('plann.relations.fetch_by_uids', return_value={}) as fetch:
+        issues = check_relations(graph)
+    assert fetch.call_count == 1
+    assert sorted(issues) == [
+        ('dangling', 'c2', 'PARENT', 'gone'),
+        ('missing', 'p', 'CHILD', 'c2'),
+        ('missing', 's', 'CHILD', 'c1'),
+    ]
+
+    changed = fix_relations(graph, issues)
+    assert sorted(str(x.icalendar_component['UID']) for x in changed) == ['c1', 'c2']
+    assert related_uids(c1) == {'PARENT': {'p', 's'}}
+    assert related_uids(c2) == {'PARENT': {'p'}}
+    assert not check_relations(graph)
+
+    ## A link back with the wrong reltype is reported once, and not fixed
+    a = _task('a', [('CHILD', 'b')])
+    b = _task('b', [('CHILD', 'a')])
+    graph = RelationGraph([a, b])
+    issues = check_relations(graph)
+    assert issues == [('mismatch', 'a', 'CHILD', 'b'), ('loop', ('a', 'b'), None, None)]
+    assert not fix_relations(graph, issues)
+
+def test_hierarchy():
+    ## p has the children c1 and c2, c2 also has the parent p2, s is a sibling of c1
+    p = _task('p', [('CHILD', 'c1'), ('CHILD', 'c2')])
+    p2 = _task('p2', [('CHILD', 'c2')])
+    c1 = _task('c1', [('PARENT', 'p'), ('SIBLING', 's')])
+    c2 = _task('c2', [('PARENT', 'p'), ('PARENT', 'p2'), ('CHILD', 'gc')])
+    gc = _task('gc', [('PARENT', 'c2')])
+    s = _task('s')
+    graph = RelationGraph([p, p2, c1, c2, gc, s])
+    assert [*hierarchy(graph, ['gc', 'p2', 's'], set(graph.by_uid), siblings=True)] == [
+        ('p', 0), ('c1', 1), ('s', 1), ('c2', 1), ('gc', 2), ('p2', 0)]
+    assert [*hierarchy(graph, ['p', 'gc'], up='CHILD', down='PARENT')] == [('p', 0), ('gc', 0)]
+    ## Bottom up, climbing from p to the first child
+    assert [*hierarchy(graph, ['p'], set(graph.by_uid), up='CHILD', down='PARENT')] == [('c1', 0), ('p', 1)]
+
+def test_list_deep_and_loops(caplog):
+    ## No limit on the depth
+    chain = [_task(f"t{i}", [('PARENT', f"t{i+1}")] if i < 999 else []) for i in range(1000)]
+    lines = _list(chain, template="{SUMMARY}", top_down=True, echo=False)
+    assert len(lines) == 1000
+    assert lines[0] == 'task t999'
+    assert lines[-1] == ' '*1998 + 'task t0'
+    lines = _list(chain, template="{SUMMARY}", bottom_up=True, echo=False)
+    assert (lines[0], lines[-1].strip()) == ('task t0', 'task t999')
+
+    a = _task('a', [('CHILD', 'b')])
+    b = _task('b', [('CHILD', 'c')])
+    c = _task('c', [('CHILD', 'a')])
+    lines = _list([b, a, c], template="{SUMMARY}", top_down=True, echo=False)
+    assert lines == ['task c', '  task a', '    task b']
+    assert 'Relationship loop found: task a, task b, task c' in caplog.text
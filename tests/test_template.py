@@ -1,5 +1,7 @@
 from datetime import date
 
+import pytest
+
 from plann.lib import tz
 from plann.template import Template
 
@@ -58,3 +60,20 @@ class TestTemplate:
 
 
 
+
+    def test_dt_attribute(self):
+        ## timestamps are unwrapped, but .dt is still accepted
+        template = Template("{date.dt:%F} {date:%F}")
+        text = template.format(date=self.date)
+        assert text == "1990-10-10 1990-10-10"
+
+    def test_nested_format_spec(self):
+        template = Template("{foo:{width}}|{bar:?{width}?>4}")
+        assert template.format(foo="x", width=3) == "x  |   3"
+
+    def test_too_deep_nesting(self):
+        with pytest.raises(ValueError):
+            Template("{a:?{b:?{c}?}?}")
+
+    def test_compiled_once(self):
+        assert Template("{foo:?bar?}")._ops is Template("{foo:?bar?}")._ops